@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" @package docstring
+Micro-benchmark of the source/destination diff engine.
+
+Builds synthetic indexes of 10k, 100k and 1M messages where 10% of the
+source is missing on the destination, 10% of the destination is stale,
+1% of messages have no Message-ID and 1% are duplicated, then times
+syncimap.diff_indexes() on lists of dicts and on CompactIndex, which
+takes a hash join up to --diffmemory keys and a sort-merge above. The
+old list based lookup is timed at 10k only, larger sizes would take
+hours.
+
+With --rss every size is diffed in a child process of its own, as a
+CompactIndex sort-merged in at most --diffmemory keys at a time and, up
+to 1M messages, as lists of dicts, and the peak RSS of the child is
+reported. Message keys are digests, as syncimap indexes them. The
+indexes themselves are not spilled: --diffmemory bounds the sort and
+join working set, the RSS still grows with the number of messages.
+
+Usage: python benchmarks/bench_diff.py [options] [sizes...]
+
+ --rss                 report the peak RSS of each diff instead.
+                       Default sizes are then 1000000 and 5000000.
+ --diffmemory <int>    keys the compact diff joins in memory, beyond which
+                       it sorts runs of them spilled to disk. Default is
+                       syncimap's.
+"""
+
+import getopt
+import hashlib
+import os
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from syncimap import CompactIndex, DIFF_MEMORY, diff_indexes
+
+# lists of dicts above this size take too much memory to be worth measuring
+DICTS_MAX = 1000000
+
+
+def make_entries(n, start, digest=False):
+	uid = 0
+	for i in range(start, start + n):
+		mid = '<%d.bench@example.com>' % i
+		if digest:
+			mid = hashlib.blake2b(mid.encode(), digest_size=16).hexdigest()
+		if i % 100 == 0:
+			mid = None
+		uid += 1
+		m = {'uid': str(uid).encode(), 'mid': mid, 'flags': '\\Seen', 'size': 1000 + i % 5000,
+			'date': '01-Jan-2020 00:00:00 +0000'}
+		yield m
+		if i % 100 == 1:
+			uid += 1
+			yield dict(m, uid=str(uid).encode())
+
+
+def make_index(n, start):
+	return list(make_entries(n, start))
+
+
+def legacy_diff(srcindex, dstindex):
+	srcmexids = [m['mid'] for m in srcindex]
+	dstmexids = [m['mid'] for m in dstindex]
+	todelete = [m for m in dstindex if not m['mid'] in srcmexids]
+	tocopy = [m for m in srcindex if not m['mid'] in dstmexids]
+	return tocopy, todelete
+
+
+def bench(n, limit):
+	src = make_index(n, 0)
+	dst = make_index(n, n // 10)
+	t0 = time.perf_counter()
+	tocopy, todelete, unchanged = diff_indexes(src, dst)
+	dt = time.perf_counter() - t0
+	print ("%9d entries  diff_indexes: %8.3f s  copy %d, delete %d, unchanged %d"
+		% (n, dt, len(tocopy), len(todelete), len(unchanged)))
+	src = CompactIndex(make_entries(n, 0, True))
+	dst = CompactIndex(make_entries(n, n // 10, True))
+	t0 = time.perf_counter()
+	tocopy, todelete, unchanged = diff_indexes(src, dst, limit=limit)
+	dt = time.perf_counter() - t0
+	print ("%9d entries  compact %s: %8.3f s  copy %d, delete %d, unchanged %d"
+		% (n, 'merge' if len(dst) > limit else 'join ', dt, len(tocopy), len(todelete), len(unchanged)))
+	if n <= 10000:
+		t0 = time.perf_counter()
+		legacy_diff(src, dst)
+		print ("%9d entries  list lookup:  %8.3f s" % (n, time.perf_counter() - t0))
+
+
+def child(kind, n, limit):
+	""" Diffs one pair of indexes of kind 'compact' or 'dicts' """
+	if kind == 'compact':
+		src = CompactIndex(make_entries(n, 0, True))
+		dst = CompactIndex(make_entries(n, n // 10, True))
+	else:
+		src = list(make_entries(n, 0, True))
+		dst = list(make_entries(n, n // 10, True))
+	t0 = time.perf_counter()
+	tocopy, todelete, unchanged = diff_indexes(src, dst, limit=limit)
+	# walk the results as a sync would
+	copied = sum(1 for m in tocopy)
+	deleted = sum(1 for m in todelete)
+	paired = sum(1 for p in unchanged)
+	print ("%.3f %d %d %d" % (time.perf_counter() - t0, copied, deleted, paired))
+
+
+def bench_rss(kind, n, limit):
+	cmd = [sys.executable, os.path.abspath(__file__), '--child', kind, '--diffmemory', str(limit), str(n)]
+	child = subprocess.Popen(cmd, stdout=subprocess.PIPE)
+	output = child.stdout.read().split()
+	pid, status, rusage = os.wait4(child.pid, 0)
+	if os.waitstatus_to_exitcode(status) != 0:
+		raise RuntimeError('%s diff of %d entries failed' % (kind, n))
+	dt, copied, deleted, paired = output
+	print ("%9d entries  %-7s  diff %8.3f s  peak RSS %7.1f MiB  copy %s, delete %s, unchanged %s"
+		% (n, kind, float(dt), rusage.ru_maxrss / 1024.0, copied.decode(), deleted.decode(), paired.decode()))
+
+
+def main(argv):
+	opts, args = getopt.getopt(argv, '', ['rss', 'diffmemory=', 'child='])
+	opts = dict(opts)
+	limit = int(opts.get('--diffmemory', DIFF_MEMORY))
+	sizes = [int(a) for a in args]
+	if '--child' in opts:
+		child(opts['--child'], sizes[0], limit)
+	elif '--rss' in opts:
+		for n in sizes or [1000000, 5000000]:
+			bench_rss('compact', n, limit)
+			if n <= DICTS_MAX:
+				bench_rss('dicts', n, limit)
+	else:
+		for n in sizes or [10000, 100000, 1000000]:
+			bench(n, limit)
+
+
+if __name__ == '__main__':
+	main(sys.argv[1:])
@@ -0,0 +1,227 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" @package docstring
+End to end benchmark of syncimap against two local fake IMAP servers.
+
+Starts two fakeimap servers, fills the source with synthetic folders of
+messages with log-normally distributed sizes, runs syncimap.py as a child
+process and reports messages/s, bytes/s, the commands (round trips) and
+bytes seen by the servers and the peak RSS of the syncimap process. With
+--runs 2 the second run measures an incremental sync with nothing to copy.
+
+Usage: python benchmarks/bench_sync.py [options] [-- syncimap options]
+
+ --folders   <int>     folders on the source, INBOX included. Default is 10.
+ --messages  <int>     messages per folder. Default is 500.
+ --size      <int>     median message size in bytes. Default is 4000.
+ --sigma     <float>   spread of the log-normal size distribution. Default is 1.0.
+ --maxsize   <int>     largest message size. Default is 10000000.
+ --present   <float>   fraction of the messages already on the destination.
+                       Default is 0.
+ --destinations <int>  destination servers, synced in one fan-out run.
+                       Default is 1.
+ --latency   <float>   milliseconds added to every command by both servers.
+ --bandwidth <int>     bytes/s per connection sent by the servers.
+ --throttle  <int>     every <int>th command of a connection gets NO [THROTTLED].
+ --drop      <int>     the servers close a connection instead of running its
+                       <int>th command.
+ --nocaps    <list>    comma separated capabilities the servers don't announce.
+ --runs      <int>     syncs in a row. Default is 1.
+ --seed      <int>     random seed of the synthetic mailboxes. Default is 1.
+ --log       <file>    syncimap output, default is to discard it.
+ --json                print one JSON object per run instead of a table.
+
+Example: python benchmarks/bench_sync.py --latency 2 --runs 2 -- --workers 4
+"""
+
+import base64
+import concurrent.futures
+import getopt
+import json
+import math
+import multiprocessing
+import os
+import random
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import fakeimap
+
+SYNCIMAP = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'syncimap.py')
+
+WORDS = ('lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod tempor incididunt '
+	'ut labore et dolore magna aliqua enim ad minim veniam quis nostrud exercitation ullamco '
+	'laboris nisi aliquip ex ea commodo consequat meeting invoice report attached regards').split()
+
+
+def encode5t(password):
+	""" the inverse of syncimap's decode5t() """
+	data = password.encode('utf-8')
+	for i in range(5):
+		data = base64.b64encode(data)[::-1]
+	return data.decode('ascii')
+
+
+def make_text(rnd, size):
+	""" returns about size bytes of text in CRLF terminated lines """
+	lines = []
+	total = 0
+	while total < size:
+		line = ' '.join(rnd.choice(WORDS) for i in range(12)).encode('ascii') + b'\r\n'
+		lines.append(line)
+		total += len(line)
+	return b''.join(lines)
+
+
+def make_message(rnd, text, n, size):
+	header = ('From: sender%d@example.com\r\nTo: bench@example.com\r\n'
+		'Subject: benchmark message %d\r\nDate: Mon, 2 Mar 2020 10:00:00 +0000\r\n'
+		'Message-ID: <%d.%d@bench.example.com>\r\n\r\n' % (n % 97, n, n, rnd.randint(0, 1 << 30))).encode('ascii')
+	size = max(size - len(header), 2)
+	# a random slice of a shared text block, repeated for large messages;
+	# it must not split a CRLF, bare CR or LF are not valid in a message
+	start = text.index(b'\r\n', rnd.randint(0, len(text) // 2)) + 2
+	body = text[start:start + size]
+	while len(body) < size:
+		body += text[:size - len(body)]
+	return header + body[:-2].rstrip(b'\r') + b'\r\n'
+
+
+def populate(src, dsts, options):
+	"""
+	Fills the source store, copying --present of it to the destinations
+	@return (messages, bytes) on the source
+	"""
+	rnd = random.Random(options['seed'])
+	text = make_text(rnd, 1 << 20)
+	count = 0
+	total = 0
+	for f in range(options['folders']):
+		name = 'INBOX' if f == 0 else 'Folder%02d' % f
+		smb = src.store.create(name)
+		dmbs = [dst.store.create(name) for dst in dsts]
+		for i in range(options['messages']):
+			size = int(min(options['maxsize'], rnd.lognormvariate(math.log(options['size']), options['sigma'])))
+			body = make_message(rnd, text, count, size)
+			flags = ['\\Seen'] if rnd.random() < 0.7 else []
+			date = 1500000000 + count * 60
+			smb.add(body, flags, date)
+			if rnd.random() < options['present']:
+				for dmb in dmbs:
+					dmb.add(body, flags, date)
+			count += 1
+			total += len(body)
+	return count, total
+
+
+def folder_contents(server):
+	return dict((name, sorted(m.body for m in mb.messages)) for (name, mb) in server.store.mailboxes.items())
+
+
+def spawn(cmd, logpath):
+	""" Runs cmd, @return (exit status, seconds, peak RSS in KiB) """
+	log = open(logpath, 'a') if logpath else subprocess.DEVNULL
+	try:
+		t0 = time.time()
+		child = subprocess.Popen(cmd, stdout=log, stderr=subprocess.STDOUT)
+		pid, status, rusage = os.wait4(child.pid, 0)
+		child.returncode = os.waitstatus_to_exitcode(status)
+		return child.returncode, time.time() - t0, rusage.ru_maxrss
+	finally:
+		if logpath:
+			log.close()
+
+
+def run_sync(launcher, src, dsts, extra, logpath):
+	"""
+	Runs syncimap once from the launcher process: a child's peak RSS counts
+	the memory of the process it was forked from, which must not be the one
+	holding the mailboxes
+	"""
+	password = encode5t('bench')
+	cmd = [sys.executable, SYNCIMAP,
+		'--host1', '127.0.0.1', '--port1', str(src.port), '--nossl1', '--user1', 'bench', '--password1', password,
+		'--exclude', '^$']
+	for dst in dsts:
+		cmd += ['--host2', '127.0.0.1', '--port2', str(dst.port), '--user2', 'bench', '--password2', password]
+	cmd += extra
+	return launcher.submit(spawn, cmd, logpath).result()
+
+
+def main(argv):
+	options = {'folders': 10, 'messages': 500, 'size': 4000, 'sigma': 1.0, 'maxsize': 10000000,
+		'present': 0.0, 'destinations': 1, 'runs': 1, 'seed': 1, 'json': False, 'log': None}
+	conf = {'capabilities': list(fakeimap.DEFAULT_CAPABILITIES)}
+	extra = []
+	if '--' in argv:
+		extra = argv[argv.index('--') + 1:]
+		argv = argv[:argv.index('--')]
+	opts, args = getopt.getopt(argv, '', ['folders=', 'messages=', 'size=', 'sigma=', 'maxsize=', 'present=',
+		'destinations=', 'latency=', 'bandwidth=', 'throttle=', 'drop=', 'nocaps=', 'runs=', 'seed=', 'log=', 'json'])
+	for option, value in opts:
+		name = option[2:]
+		if name in ('folders', 'messages', 'size', 'maxsize', 'destinations', 'runs', 'seed'):
+			options[name] = int(value)
+		elif name in ('sigma', 'present'):
+			options[name] = float(value)
+		elif name == 'latency':
+			conf['latency'] = float(value) / 1000
+		elif name == 'bandwidth':
+			conf['bandwidth'] = int(value)
+		elif name in ('throttle', 'drop'):
+			conf[name] = int(value)
+		elif name == 'nocaps':
+			drop = [c.strip().upper() for c in value.split(',')]
+			conf['capabilities'] = [c for c in conf['capabilities'] if c.upper() not in drop]
+		elif name == 'log':
+			options['log'] = value
+		elif name == 'json':
+			options['json'] = True
+
+	# started while this process is still small
+	launcher = concurrent.futures.ProcessPoolExecutor(1, multiprocessing.get_context('forkserver'))
+	launcher.submit(time.time).result()
+	src = fakeimap.Server(conf).start()
+	dsts = [fakeimap.Server(conf).start() for i in range(options['destinations'])]
+	servers = [src] + dsts
+	messages, size = populate(src, dsts, options)
+	if not options['json']:
+		print ("Source: %d folders, %d messages, %d bytes; %d destinations; syncimap options: %s"
+			% (options['folders'], messages, size, len(dsts), ' '.join(extra) or '-'))
+		print ("%3s %6s %8s %8s %9s %12s %9s %12s %12s %9s %s" % ('run', 'exit', 'seconds', 'copied', 'msgs/s',
+			'bytes/s', 'commands', 'bytes in', 'bytes out', 'RSS KiB', 'result'))
+	try:
+		for run in range(1, options['runs'] + 1):
+			before = sum(len(mb.messages) for dst in dsts for mb in dst.store.mailboxes.values())
+			before_bytes = sum(mb.size() for dst in dsts for mb in dst.store.mailboxes.values())
+			counters = [(s.stats.commands, s.stats.bytes_in, s.stats.bytes_out) for s in servers]
+			code, seconds, rss = run_sync(launcher, src, dsts, extra, options['log'])
+			# over every destination
+			copied = sum(len(mb.messages) for dst in dsts for mb in dst.store.mailboxes.values()) - before
+			copied_bytes = sum(mb.size() for dst in dsts for mb in dst.store.mailboxes.values()) - before_bytes
+			commands = sum(s.stats.commands - c[0] for (s, c) in zip(servers, counters))
+			bytes_in = sum(s.stats.bytes_in - c[1] for (s, c) in zip(servers, counters))
+			bytes_out = sum(s.stats.bytes_out - c[2] for (s, c) in zip(servers, counters))
+			same = all(folder_contents(src) == folder_contents(dst) for dst in dsts)
+			result = {'run': run, 'exit': code, 'seconds': round(seconds, 3), 'copied': copied,
+				'messages_per_second': round(copied / seconds, 1), 'bytes_per_second': round(copied_bytes / seconds),
+				'commands': commands, 'server_bytes_in': bytes_in, 'server_bytes_out': bytes_out,
+				'source_bytes_out': src.stats.bytes_out - counters[0][2], 'peak_rss_kib': rss, 'in_sync': same}
+			if options['json']:
+				print (json.dumps(dict(result, options=options, servers=conf, syncimap=extra)))
+			else:
+				print ("%3d %6d %8.2f %8d %9.1f %12d %9d %12d %12d %9d %s" % (run, code, seconds, copied,
+					result['messages_per_second'], result['bytes_per_second'], commands, bytes_in, bytes_out,
+					rss, 'in sync' if same else 'DIFFERENT'))
+	finally:
+		for s in servers:
+			s.stop()
+		launcher.shutdown()
+
+
+if __name__ == '__main__':
+	main(sys.argv[1:])
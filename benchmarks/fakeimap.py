@@ -0,0 +1,811 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" @package docstring
+Fake IMAP server
+
+Small in-process IMAP4rev1 stand-in used to benchmark syncimap without
+two real mail servers. Everything is kept in memory; latency, bandwidth,
+capabilities, throttling and dropped connections are configurable per server instance.
+
+Supports what syncimap uses: LOGIN, CAPABILITY, ENABLE, COMPRESS=DEFLATE,
+LIST (with LIST-STATUS), STATUS (with SIZE), SELECT/EXAMINE (with
+CONDSTORE/QRESYNC), SEARCH, FETCH (with CHANGEDSINCE/VANISHED and partial
+bodies), STORE, EXPUNGE, UID EXPUNGE and APPEND (with MULTIAPPEND, LITERAL+
+and APPENDUID).
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+"""
+
+import re
+import socket
+import socketserver
+import threading
+import time
+import zlib
+
+
+DEFAULT_CAPABILITIES = ['IMAP4rev1', 'UIDPLUS', 'MULTIAPPEND', 'LITERAL+', 'CONDSTORE', 'QRESYNC',
+	'ENABLE', 'LIST-STATUS', 'STATUS=SIZE', 'COMPRESS=DEFLATE']
+
+MONTHS = ['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec']
+
+
+class Message:
+	""" One stored message """
+
+	def __init__(self, uid, body, flags=(), internaldate=None, modseq=1):
+		self.uid = uid
+		self.body = body
+		self.flags = set(flags)
+		self.internaldate = internaldate or time.time()
+		self.modseq = modseq
+
+
+class Mailbox:
+	""" One folder with its UID bookkeeping """
+
+	def __init__(self, name, uidvalidity=None):
+		self.name = name
+		self.uidvalidity = uidvalidity or int(time.time()) % 100000000 + 1
+		self.uidnext = 1
+		self.highestmodseq = 1
+		self.messages = []
+		self.vanished = []
+
+	def add(self, body, flags=(), internaldate=None):
+		self.highestmodseq += 1
+		m = Message(self.uidnext, body, flags, internaldate, self.highestmodseq)
+		self.uidnext += 1
+		self.messages.append(m)
+		return m
+
+	def size(self):
+		return sum(len(m.body) for m in self.messages)
+
+
+class Store:
+	""" Mailbox store shared by every connection of one server """
+
+	def __init__(self, delimiter='.'):
+		self.delimiter = delimiter
+		self.mailboxes = {'INBOX': Mailbox('INBOX')}
+		self.lock = threading.RLock()
+
+	def get(self, name):
+		if name.upper() == 'INBOX':
+			name = 'INBOX'
+		return self.mailboxes.get(name)
+
+	def create(self, name):
+		if self.get(name) is None:
+			self.mailboxes[name] = Mailbox(name)
+		return self.get(name)
+
+
+class Stats:
+	""" Server side counters """
+
+	def __init__(self):
+		self.commands = 0
+		self.bytes_in = 0
+		self.bytes_out = 0
+		self.lock = threading.Lock()
+
+	def add(self, commands=0, bytes_in=0, bytes_out=0):
+		with self.lock:
+			self.commands += commands
+			self.bytes_in += bytes_in
+			self.bytes_out += bytes_out
+
+
+class BadCommand(Exception):
+	pass
+
+
+def format_date(t):
+	tm = time.gmtime(t)
+	return '%02d-%s-%04d %02d:%02d:%02d +0000' % (tm.tm_mday, MONTHS[tm.tm_mon - 1], tm.tm_year,
+		tm.tm_hour, tm.tm_min, tm.tm_sec)
+
+
+def parse_date(s):
+	m = re.match(r'\s*(\d+)-(\w+)-(\d+)(?: (\d+):(\d+):(\d+) ([+-]\d{4}))?', s)
+	if not m:
+		return time.time()
+	d, mon, y, hh, mm, ss, zone = m.groups()
+	t = time.mktime((int(y), MONTHS.index(mon.capitalize()) + 1, int(d), int(hh or 0), int(mm or 0),
+		int(ss or 0), 0, 0, 0)) - time.timezone
+	if zone:
+		off = (int(zone[1:3]) * 60 + int(zone[3:5])) * 60
+		t -= off if zone[0] == '+' else -off
+	return t
+
+
+def quote(s):
+	return '"' + s.replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+
+def tokenize(data):
+	"""
+	Splits a command (literals already inlined as {n}\\r\\n<bytes>) into tokens.
+	Parenthesized lists become python lists, literals and quoted strings bytes.
+	"""
+	pos = 0
+	stack = [[]]
+	n = len(data)
+	while pos < n:
+		c = data[pos:pos + 1]
+		if c in (b' ', b'\r', b'\n'):
+			pos += 1
+		elif c == b'(':
+			stack.append([])
+			pos += 1
+		elif c == b')':
+			lst = stack.pop()
+			stack[-1].append(lst)
+			pos += 1
+		elif c == b'"':
+			out = b''
+			pos += 1
+			while data[pos:pos + 1] != b'"':
+				if data[pos:pos + 1] == b'\\':
+					pos += 1
+				out += data[pos:pos + 1]
+				pos += 1
+			pos += 1
+			stack[-1].append(out)
+		elif c == b'{':
+			m = re.compile(rb'\{(\d+)\+?\}\r\n').match(data, pos)
+			size = int(m.group(1))
+			pos = m.end()
+			stack[-1].append(data[pos:pos + size])
+			pos += size
+		else:
+			start = pos
+			depth = 0
+			while pos < n:
+				c = data[pos:pos + 1]
+				if c == b'[':
+					depth += 1
+				elif c == b']':
+					depth -= 1
+				elif depth == 0 and c in (b' ', b'(', b')', b'\r', b'\n'):
+					break
+				pos += 1
+			stack[-1].append(data[start:pos].decode('latin-1'))
+	return stack[0]
+
+
+def parse_set(s, maxval):
+	""" Expands a sequence set into a python set of ints """
+	out = set()
+	if s == '$':
+		return out
+	for part in s.split(','):
+		if ':' in part:
+			a, b = part.split(':')
+			a = maxval if a == '*' else int(a)
+			b = maxval if b == '*' else int(b)
+			if a > b:
+				a, b = b, a
+			out.update(range(a, b + 1))
+		else:
+			out.add(maxval if part == '*' else int(part))
+	return out
+
+
+def compress_set(nums):
+	nums = sorted(nums)
+	out = []
+	i = 0
+	while i < len(nums):
+		j = i
+		while j + 1 < len(nums) and nums[j + 1] == nums[j] + 1:
+			j += 1
+		out.append(str(nums[i]) if i == j else '%d:%d' % (nums[i], nums[j]))
+		i = j + 1
+	return ','.join(out)
+
+
+class Handler(socketserver.BaseRequestHandler):
+	""" One client session """
+
+	def setup(self):
+		self.server_conf = self.server.conf
+		self.store = self.server.store
+		self.stats = self.server.stats
+		self.sock = self.request
+		self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+		self.inbuf = b''
+		self.compressor = None
+		self.decompressor = None
+		self.selected = None
+		self.readonly = False
+		self.condstore = False
+		self.qresync = False
+		self.count = 0
+
+	# -- raw I/O -------------------------------------------------
+
+	def _fill(self):
+		data = self.sock.recv(65536)
+		if not data:
+			raise EOFError()
+		self.stats.add(bytes_in=len(data))
+		if self.decompressor:
+			data = self.decompressor.decompress(data)
+		self.inbuf += data
+
+	def readline(self):
+		while b'\r\n' not in self.inbuf:
+			self._fill()
+		i = self.inbuf.index(b'\r\n') + 2
+		line, self.inbuf = self.inbuf[:i], self.inbuf[i:]
+		return line
+
+	def read(self, size):
+		while len(self.inbuf) < size:
+			self._fill()
+		data, self.inbuf = self.inbuf[:size], self.inbuf[size:]
+		return data
+
+	def send(self, data):
+		if isinstance(data, str):
+			data = data.encode('utf-8')
+		if self.compressor:
+			data = self.compressor.compress(data) + self.compressor.flush(zlib.Z_SYNC_FLUSH)
+		bandwidth = self.server_conf.get('bandwidth')
+		if bandwidth:
+			time.sleep(len(data) / float(bandwidth))
+		self.stats.add(bytes_out=len(data))
+		self.sock.sendall(data)
+
+	def read_command(self):
+		""" Reads one complete command, literals included """
+		data = self.readline()
+		while True:
+			m = re.search(rb'\{(\d+)(\+?)\}\r\n$', data)
+			if not m:
+				return data
+			if not m.group(2):
+				self.send(b'+ Ready for literal data\r\n')
+			data += self.read(int(m.group(1)))
+			data += self.readline()
+
+	# -- session -------------------------------------------------
+
+	def handle(self):
+		self.send('* OK [CAPABILITY %s] %s\r\n' % (' '.join(self.server_conf['capabilities']),
+			self.server_conf.get('banner', 'Fake IMAP server ready')))
+		try:
+			while True:
+				raw = self.read_command()
+				self.stats.add(commands=1)
+				latency = self.server_conf.get('latency')
+				if latency:
+					time.sleep(latency)
+				try:
+					tokens = tokenize(raw)
+					if len(tokens) < 2 or not isinstance(tokens[1], str):
+						raise ValueError()
+				except Exception:
+					self.send(raw.split(b' ', 1)[0] + b' BAD parse error\r\n')
+					continue
+				tag, cmd, args = tokens[0], tokens[1].upper(), tokens[2:]
+				self.count += 1
+				throttle = self.server_conf.get('throttle')
+				if throttle and cmd not in ('LOGIN', 'LOGOUT', 'CAPABILITY') and self.count % throttle == 0:
+					self.send('%s NO [THROTTLED] Too many commands, slow down\r\n' % tag)
+					continue
+				drop = self.server_conf.get('drop')
+				if drop and cmd not in ('LOGIN', 'LOGOUT', 'CAPABILITY') and self.count % drop == 0:
+					break
+				try:
+					with self.store.lock:
+						done = self.dispatch(tag, cmd, args, raw)
+				except (BadCommand, IndexError, ValueError, TypeError, AttributeError) as e:
+					self.send('%s BAD %s\r\n' % (tag, e))
+					continue
+				if done:
+					break
+		except (EOFError, ConnectionError, OSError):
+			pass
+		except Exception:
+			import traceback
+			traceback.print_exc()
+
+	def dispatch(self, tag, cmd, args, raw):
+		uid = False
+		if cmd == 'UID':
+			uid = True
+			cmd, args = args[0].upper(), args[1:]
+		handler = getattr(self, 'cmd_' + cmd.replace('-', '_'), None)
+		if handler is None:
+			raise BadCommand('Unknown command ' + cmd)
+		if uid:
+			result = handler(args, uid=True)
+		else:
+			result = handler(args)
+		if result is True:
+			self.send('%s OK LOGOUT completed\r\n' % tag)
+			return True
+		if result is None:
+			result = 'OK %s completed' % cmd
+		self.send('%s %s\r\n' % (tag, result))
+		if cmd == 'COMPRESS' and result.startswith('OK'):
+			self.compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+			self.decompressor = zlib.decompressobj(-15)
+			if self.inbuf:
+				self.inbuf = self.decompressor.decompress(self.inbuf)
+		return False
+
+	def astr(self, tok):
+		if isinstance(tok, bytes):
+			return tok.decode('utf-8')
+		return tok
+
+	def require_selected(self):
+		if self.selected is None:
+			raise BadCommand('No mailbox selected')
+		return self.selected
+
+	# -- commands ------------------------------------------------
+
+	def cmd_CAPABILITY(self, args):
+		self.send('* CAPABILITY %s\r\n' % ' '.join(self.server_conf['capabilities']))
+
+	def cmd_NOOP(self, args):
+		pass
+
+	def cmd_LOGIN(self, args):
+		users = self.server_conf.get('users')
+		if users is not None and users.get(self.astr(args[0])) != self.astr(args[1]):
+			return 'NO [AUTHENTICATIONFAILED] Invalid credentials'
+
+	def cmd_LOGOUT(self, args):
+		self.send(b'* BYE Logging out\r\n')
+		return True
+
+	def cmd_ENABLE(self, args):
+		enabled = []
+		for a in args:
+			a = self.astr(a).upper()
+			if a in ('CONDSTORE', 'QRESYNC') and a in self.server_conf['capabilities']:
+				self.condstore = True
+				if a == 'QRESYNC':
+					self.qresync = True
+				enabled.append(a)
+		self.send('* ENABLED %s\r\n' % ' '.join(enabled))
+
+	def cmd_COMPRESS(self, args):
+		if 'COMPRESS=DEFLATE' not in self.server_conf['capabilities']:
+			return 'NO Compression not supported'
+		if self.compressor:
+			return 'NO [COMPRESSIONACTIVE] Already compressing'
+		return 'OK DEFLATE active'
+
+	def cmd_NAMESPACE(self, args):
+		self.send('* NAMESPACE (("" "%s")) NIL NIL\r\n' % self.store.delimiter)
+
+	def list_line(self, mb):
+		return '* LIST () "%s" %s\r\n' % (self.store.delimiter, quote(mb.name))
+
+	def status_items(self, mb, items):
+		out = []
+		for item in items:
+			item = item.upper()
+			if item == 'MESSAGES':
+				out.append('MESSAGES %d' % len(mb.messages))
+			elif item == 'UIDNEXT':
+				out.append('UIDNEXT %d' % mb.uidnext)
+			elif item == 'UIDVALIDITY':
+				out.append('UIDVALIDITY %d' % mb.uidvalidity)
+			elif item == 'UNSEEN':
+				out.append('UNSEEN %d' % len([m for m in mb.messages if '\\Seen' not in m.flags]))
+			elif item == 'RECENT':
+				out.append('RECENT 0')
+			elif item == 'SIZE' and 'STATUS=SIZE' in self.server_conf['capabilities']:
+				out.append('SIZE %d' % mb.size())
+			elif item == 'HIGHESTMODSEQ' and 'CONDSTORE' in self.server_conf['capabilities']:
+				out.append('HIGHESTMODSEQ %d' % mb.highestmodseq)
+			else:
+				raise BadCommand('Unknown status item ' + item)
+		return '* STATUS %s (%s)\r\n' % (quote(mb.name), ' '.join(out))
+
+	def cmd_LIST(self, args):
+		pattern = self.astr(args[1]) if len(args) > 1 else '*'
+		status = None
+		if len(args) > 3 and self.astr(args[2]).upper() == 'RETURN':
+			for i, item in enumerate(args[3]):
+				if not isinstance(item, list) and self.astr(item).upper() == 'STATUS':
+					if 'LIST-STATUS' not in self.server_conf['capabilities']:
+						raise BadCommand('LIST-STATUS not supported')
+					status = [self.astr(x) for x in args[3][i + 1]]
+		regex = re.compile('^' + re.escape(pattern).replace(r'\*', '.*').replace('%', '[^.]*') + '$')
+		for name in sorted(self.store.mailboxes):
+			if regex.match(name):
+				mb = self.store.mailboxes[name]
+				self.send(self.list_line(mb))
+				if status:
+					self.send(self.status_items(mb, status))
+
+	cmd_LSUB = cmd_LIST
+
+	def cmd_CREATE(self, args):
+		name = self.astr(args[0])
+		if self.store.get(name) is not None:
+			return 'NO [ALREADYEXISTS] Mailbox exists'
+		self.store.create(name)
+
+	def cmd_STATUS(self, args):
+		mb = self.store.get(self.astr(args[0]))
+		if mb is None:
+			return 'NO [NONEXISTENT] Mailbox does not exist'
+		self.send(self.status_items(mb, [self.astr(x) for x in args[1]]))
+
+	def cmd_SELECT(self, args, readonly=False):
+		name = self.astr(args[0])
+		mb = self.store.get(name)
+		if mb is None:
+			self.selected = None
+			return 'NO [NONEXISTENT] Mailbox does not exist'
+		self.selected = mb
+		self.readonly = readonly
+		params = args[1] if len(args) > 1 else []
+		if params and self.astr(params[0]).upper() in ('CONDSTORE', 'QRESYNC'):
+			self.condstore = True
+		self.send('* %d EXISTS\r\n* 0 RECENT\r\n' % len(mb.messages))
+		self.send('* FLAGS (\\Answered \\Flagged \\Deleted \\Seen \\Draft)\r\n')
+		self.send('* OK [UIDVALIDITY %d] UIDs valid\r\n* OK [UIDNEXT %d] Predicted next UID\r\n'
+			% (mb.uidvalidity, mb.uidnext))
+		if 'CONDSTORE' in self.server_conf['capabilities']:
+			self.send('* OK [HIGHESTMODSEQ %d] Highest\r\n' % mb.highestmodseq)
+		if params and self.astr(params[0]).upper() == 'QRESYNC' and self.qresync:
+			q = params[1]
+			if int(self.astr(q[0])) == mb.uidvalidity:
+				since = int(self.astr(q[1]))
+				gone = [u for (u, ms) in mb.vanished if ms > since]
+				if gone:
+					self.send('* VANISHED (EARLIER) %s\r\n' % compress_set(gone))
+				for seq, m in enumerate(mb.messages, 1):
+					if m.modseq > since:
+						self.send('* %d FETCH (UID %d FLAGS (%s) MODSEQ (%d))\r\n'
+							% (seq, m.uid, ' '.join(sorted(m.flags)), m.modseq))
+		return 'OK [%s] %s completed' % ('READ-ONLY' if readonly else 'READ-WRITE',
+			'EXAMINE' if readonly else 'SELECT')
+
+	def cmd_EXAMINE(self, args):
+		return self.cmd_SELECT(args, readonly=True)
+
+	def cmd_CLOSE(self, args):
+		mb = self.require_selected()
+		if not self.readonly:
+			self.expunge(mb, None, silent=True)
+		self.selected = None
+
+	def cmd_UNSELECT(self, args):
+		self.selected = None
+
+	def cmd_CHECK(self, args):
+		pass
+
+	def resolve(self, mb, setstr, uid):
+		""" Returns [(seq, message)] for a sequence or UID set """
+		if uid:
+			maxuid = mb.messages[-1].uid if mb.messages else 0
+			wanted = parse_set(setstr, maxuid)
+			if '*' in setstr and mb.messages:
+				wanted.add(maxuid)
+			return [(i, m) for i, m in enumerate(mb.messages, 1) if m.uid in wanted]
+		wanted = parse_set(setstr, len(mb.messages))
+		return [(i, mb.messages[i - 1]) for i in sorted(wanted) if 0 < i <= len(mb.messages)]
+
+	def cmd_SEARCH(self, args, uid=False):
+		mb = self.require_selected()
+		crit = []
+		for a in args:
+			if isinstance(a, list):
+				crit.extend(a)
+			else:
+				crit.append(a)
+		result = []
+		for seq, m in enumerate(mb.messages, 1):
+			if self.match(mb, seq, m, list(crit)):
+				result.append(m.uid if uid else seq)
+		self.send('* SEARCH%s\r\n' % ''.join(' %d' % r for r in result))
+
+	def match(self, mb, seq, m, crit):
+		while crit:
+			key = self.astr(crit.pop(0))
+			if isinstance(key, list):
+				if not self.match(mb, seq, m, list(key)):
+					return False
+				continue
+			key = key.upper()
+			if key in ('ALL', 'CHARSET'):
+				if key == 'CHARSET':
+					crit.pop(0)
+			elif key == 'UNDELETED':
+				if '\\Deleted' in m.flags:
+					return False
+			elif key == 'DELETED':
+				if '\\Deleted' not in m.flags:
+					return False
+			elif key == 'SMALLER':
+				if not len(m.body) < int(self.astr(crit.pop(0))):
+					return False
+			elif key == 'LARGER':
+				if not len(m.body) > int(self.astr(crit.pop(0))):
+					return False
+			elif key in ('SENTSINCE', 'SINCE'):
+				if m.internaldate < parse_date(self.astr(crit.pop(0))):
+					return False
+			elif key in ('SENTBEFORE', 'BEFORE'):
+				if m.internaldate >= parse_date(self.astr(crit.pop(0))):
+					return False
+			elif key == 'UID':
+				maxuid = mb.messages[-1].uid if mb.messages else 0
+				if m.uid not in parse_set(self.astr(crit.pop(0)), maxuid):
+					return False
+			elif key == 'MODSEQ':
+				if m.modseq < int(self.astr(crit.pop(0))):
+					return False
+			elif key == 'NOT':
+				sub = crit.pop(0)
+				if self.match(mb, seq, m, [sub] if not isinstance(sub, list) else list(sub)):
+					return False
+			elif re.match(r'^[\d:,*]+$', key):
+				if seq not in parse_set(key, len(mb.messages)):
+					return False
+			else:
+				raise BadCommand('Unsupported search key ' + key)
+		return True
+
+	def fetch_items(self, spec):
+		""" Normalizes the fetch attribute list """
+		if isinstance(spec, list):
+			items = [self.astr(x) for x in spec]
+		else:
+			items = [self.astr(spec)]
+		out = []
+		for item in items:
+			if isinstance(item, list):
+				continue
+			u = item.upper()
+			if u == 'ALL':
+				out.extend(['FLAGS', 'INTERNALDATE', 'RFC822.SIZE'])
+			elif u == 'FAST':
+				out.extend(['FLAGS', 'INTERNALDATE', 'RFC822.SIZE'])
+			else:
+				out.append(item)
+		return out
+
+	def section(self, m, section):
+		""" Returns the bytes of a BODY[section] """
+		body = m.body
+		sec = section.upper()
+		if sec == '':
+			return body
+		i = body.find(b'\r\n\r\n')
+		header = body if i < 0 else body[:i + 4]
+		if sec == 'HEADER':
+			return header
+		if sec == 'TEXT':
+			return b'' if i < 0 else body[i + 4:]
+		fm = re.match(r'HEADER\.FIELDS(\.NOT)?\s*\((.*)\)', sec)
+		if fm:
+			names = [n.upper() for n in fm.group(2).split()]
+			unfolded = re.split(rb'\r\n(?![ \t])', header)
+			keep = []
+			for h in unfolded:
+				if b':' not in h:
+					continue
+				name = h.split(b':', 1)[0].strip().decode('latin-1').upper()
+				if (name in names) != bool(fm.group(1)):
+					keep.append(h + b'\r\n')
+			return b''.join(keep) + b'\r\n'
+		raise BadCommand('Unsupported section ' + section)
+
+	def cmd_FETCH(self, args, uid=False):
+		mb = self.require_selected()
+		setstr = self.astr(args[0])
+		items = self.fetch_items(args[1])
+		changedsince = None
+		vanished = False
+		if len(args) > 2 and isinstance(args[2], list):
+			mods = [self.astr(x) for x in args[2]]
+			for i, mod in enumerate(mods):
+				if mod.upper() == 'CHANGEDSINCE':
+					changedsince = int(mods[i + 1])
+				elif mod.upper() == 'VANISHED':
+					vanished = True
+		if uid and 'UID' not in [i.upper() for i in items]:
+			items.insert(0, 'UID')
+		if changedsince is not None and 'MODSEQ' not in [i.upper() for i in items]:
+			items.append('MODSEQ')
+		targets = self.resolve(mb, setstr, uid)
+		if vanished and uid:
+			maxuid = mb.messages[-1].uid if mb.messages else 0
+			wanted = parse_set(setstr, max(maxuid, mb.uidnext))
+			gone = [u for (u, ms) in mb.vanished if u in wanted and ms > (changedsince or 0)]
+			if gone:
+				self.send('* VANISHED (EARLIER) %s\r\n' % compress_set(gone))
+		for seq, m in targets:
+			if changedsince is not None and m.modseq <= changedsince:
+				continue
+			parts = []
+			setseen = False
+			for item in items:
+				u = item.upper()
+				if u == 'UID':
+					parts.append(b'UID %d' % m.uid)
+				elif u == 'FLAGS':
+					parts.append(('FLAGS (%s)' % ' '.join(sorted(m.flags))).encode())
+				elif u == 'RFC822.SIZE':
+					parts.append(b'RFC822.SIZE %d' % len(m.body))
+				elif u == 'INTERNALDATE':
+					parts.append(('INTERNALDATE "%s"' % format_date(m.internaldate)).encode())
+				elif u == 'MODSEQ':
+					parts.append(b'MODSEQ (%d)' % m.modseq)
+				elif u in ('RFC822', 'RFC822.HEADER', 'RFC822.TEXT') or u.startswith('BODY[') or u.startswith('BODY.PEEK['):
+					if u == 'RFC822':
+						name, data = 'RFC822', m.body
+						setseen = True
+					elif u == 'RFC822.HEADER':
+						name, data = 'RFC822.HEADER', self.section(m, 'HEADER')
+					elif u == 'RFC822.TEXT':
+						name, data = 'RFC822.TEXT', self.section(m, 'TEXT')
+						setseen = True
+					else:
+						bm = re.match(r'BODY(\.PEEK)?\[(.*)\](?:<(\d+)\.(\d+)>)?$', item, re.I)
+						if not bm:
+							raise BadCommand('Bad fetch item ' + item)
+						data = self.section(m, bm.group(2))
+						name = 'BODY[%s]' % bm.group(2)
+						if bm.group(3) is not None:
+							off = int(bm.group(3))
+							data = data[off:off + int(bm.group(4))]
+							name += '<%d>' % off
+						if not bm.group(1):
+							setseen = True
+					parts.append(name.encode() + b' {%d}\r\n' % len(data) + data)
+				else:
+					raise BadCommand('Unsupported fetch item ' + item)
+			if setseen and not self.readonly and '\\Seen' not in m.flags:
+				m.flags.add('\\Seen')
+			self.send(b'* %d FETCH (' % seq + b' '.join(parts) + b')\r\n')
+
+	def cmd_STORE(self, args, uid=False):
+		mb = self.require_selected()
+		setstr = self.astr(args[0])
+		rest = args[1:]
+		unchangedsince = None
+		if isinstance(rest[0], list):
+			mods = [self.astr(x) for x in rest[0]]
+			if mods and mods[0].upper() == 'UNCHANGEDSINCE':
+				unchangedsince = int(mods[1])
+			rest = rest[1:]
+		op = self.astr(rest[0]).upper()
+		flags = rest[1] if isinstance(rest[1], list) else [self.astr(x) for x in rest[1:]]
+		flags = set(self.astr(f) for f in flags)
+		silent = op.endswith('.SILENT')
+		modified = []
+		for seq, m in self.resolve(mb, setstr, uid):
+			if unchangedsince is not None and m.modseq > unchangedsince:
+				modified.append(m.uid if uid else seq)
+				continue
+			old = set(m.flags)
+			if op.startswith('+'):
+				m.flags |= flags
+			elif op.startswith('-'):
+				m.flags -= flags
+			else:
+				m.flags = set(flags)
+			if m.flags != old:
+				mb.highestmodseq += 1
+				m.modseq = mb.highestmodseq
+			if not silent:
+				extra = ' UID %d' % m.uid if uid else ''
+				self.send('* %d FETCH (FLAGS (%s)%s)\r\n' % (seq, ' '.join(sorted(m.flags)), extra))
+		if modified:
+			return 'OK [MODIFIED %s] Conditional STORE failed' % compress_set(modified)
+
+	def expunge(self, mb, uids, silent=False):
+		keep = []
+		seq = 0
+		for m in mb.messages:
+			seq += 1
+			if '\\Deleted' in m.flags and (uids is None or m.uid in uids):
+				mb.highestmodseq += 1
+				mb.vanished.append((m.uid, mb.highestmodseq))
+				if not silent:
+					if self.qresync:
+						self.send('* VANISHED %d\r\n' % m.uid)
+					else:
+						self.send('* %d EXPUNGE\r\n' % seq)
+				seq -= 1
+			else:
+				keep.append(m)
+		mb.messages = keep
+
+	def cmd_EXPUNGE(self, args, uid=False):
+		mb = self.require_selected()
+		if self.readonly:
+			return 'NO Mailbox is read-only'
+		uids = None
+		if uid:
+			if 'UIDPLUS' not in self.server_conf['capabilities']:
+				raise BadCommand('UID EXPUNGE not supported')
+			maxuid = mb.messages[-1].uid if mb.messages else 0
+			uids = parse_set(self.astr(args[0]), maxuid)
+		self.expunge(mb, uids)
+
+	def cmd_APPEND(self, args):
+		name = self.astr(args[0])
+		mb = self.store.get(name)
+		if mb is None:
+			return 'NO [TRYCREATE] Mailbox does not exist'
+		rest = args[1:]
+		messages = []
+		while rest:
+			flags = ()
+			date = None
+			if isinstance(rest[0], list):
+				flags = [self.astr(f) for f in rest[0]]
+				rest = rest[1:]
+			if isinstance(rest[0], bytes) and re.match(rb'^\s*\d+-\w+-\d+', rest[0]) and len(rest) > 1:
+				date = parse_date(rest[0].decode())
+				rest = rest[1:]
+			messages.append((flags, date, rest[0]))
+			rest = rest[1:]
+		if len(messages) > 1 and 'MULTIAPPEND' not in self.server_conf['capabilities']:
+			raise BadCommand('MULTIAPPEND not supported')
+		uids = []
+		for flags, date, body in messages:
+			uids.append(mb.add(body, [f for f in flags if f != '\\Recent'], date).uid)
+		if self.selected is mb:
+			self.send('* %d EXISTS\r\n' % len(mb.messages))
+		if 'UIDPLUS' in self.server_conf['capabilities']:
+			return 'OK [APPENDUID %d %s] APPEND completed' % (mb.uidvalidity, compress_set(uids))
+
+
+class Server(socketserver.ThreadingMixIn, socketserver.TCPServer):
+	"""
+	Threaded fake IMAP server listening on localhost.
+
+	@param conf: dict with optional 'capabilities', 'latency' (seconds per
+		command), 'bandwidth' (bytes/s per connection), 'throttle' (answer
+		every Nth command with NO [THROTTLED]), 'drop' (close the connection
+		instead of running every Nth command), 'users' and 'banner'
+	"""
+	daemon_threads = True
+	allow_reuse_address = True
+
+	def __init__(self, conf=None, port=0):
+		self.conf = dict(conf or {})
+		self.conf.setdefault('capabilities', list(DEFAULT_CAPABILITIES))
+		self.store = Store()
+		self.stats = Stats()
+		socketserver.TCPServer.__init__(self, ('127.0.0.1', port), Handler)
+		self.port = self.server_address[1]
+		self.thread = None
+
+	def start(self):
+		self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+		self.thread.start()
+		return self
+
+	def stop(self):
+		self.shutdown()
+		self.server_close()
+
+
+if __name__ == '__main__':
+	import sys
+	srv = Server(port=int(sys.argv[1]) if len(sys.argv) > 1 else 1143)
+	print ("Fake IMAP server on 127.0.0.1:%d" % srv.port)
+	srv.serve_forever()
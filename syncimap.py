@@ -29,10 +29,3100 @@ Also inspired by the code imapsync.pl, http://www.linux-france.org/prj/imapsync/
 """
 
 import imaplib
+import sqlite3
+import ssl
 import sys
 import re
-import email
-import base64,getopt,socket,time,datetime
+import base64,getopt,getpass,socket,time,datetime
+import os,tempfile,io,zlib,lzma,hashlib,shutil
+import email.header,email.errors
+import csv,json,contextlib
+import threading,queue,collections,asyncio
+import concurrent.futures,multiprocessing
+import array,bisect,heapq,itertools
+
+
+FETCH_START_RE = re.compile(rb'^(\d+) \(')
+FETCH_UID_RE = re.compile(rb'UID (\d+)')
+FETCH_FLAGS_RE = re.compile(rb'FLAGS \(([^)]*)\)')
+FETCH_SIZE_RE = re.compile(rb'RFC822\.SIZE (\d+)')
+FETCH_DATE_RE = re.compile(rb'INTERNALDATE "([^"]*)"')
+APPENDUID_RE = re.compile(rb'\[APPENDUID (\d+) ([\d:,]+)\]', re.I)
+STATUS_RE = re.compile(rb'^("(?:[^"\\\\]|\\\\.)*"|[^ ]+) \((.*)\)')
+
+MESSAGE_ID_RE = re.compile(rb'^message-id:[ \t]*(.*(?:\r?\n[ \t]+.*)*)', re.I | re.M)
+INDEX_FETCH = '(UID FLAGS RFC822.SIZE INTERNALDATE BODY.PEEK[HEADER.FIELDS (%s)])'
+
+# block size used when copying spooled messages to a socket
+STREAM_CHUNK = 65536
+
+# a command refused with NO [THROTTLED] or [UNAVAILABLE] is resent this many times
+THROTTLE_RETRIES = 10
+THROTTLE_RE = re.compile(rb'\[(THROTTLED|UNAVAILABLE)\b', re.I)
+# Exchange says how long to wait: "Suggested Backoff Time: 1234 milliseconds"
+BACKOFF_RE = re.compile(rb'backoff time: *(\d+) *milliseconds', re.I)
+
+# a folder copy is checkpointed to the journal every so many messages or seconds
+JOURNAL_MESSAGES = 500
+JOURNAL_SECONDS = 10
+
+# keys of messages a diff hash-joins in memory, more are sorted in runs spilled to disk
+DIFF_MEMORY = 1000000
+
+# an archive starts a new segment file past this many bytes
+ARCHIVE_SEGMENT = 1 << 30
+
+# prefixes of the hosts which are local stores, without port or password
+LOCAL_STORES = ('maildir:', 'archive:')
+
+# imaplib only knows the commands of RFC 3501 and a few extensions
+imaplib.Commands.setdefault('COMPRESS', ('AUTH', 'SELECTED'))
+
+
+def literal_size(literal):
+	""" returns the length of a bytes or file literal """
+	if isinstance(literal, bytes):
+		return len(literal)
+	literal.seek(0, os.SEEK_END)
+	return literal.tell()
+
+
+def literal_head(literal, length=65536):
+	""" returns the first length bytes of a bytes or file literal """
+	if isinstance(literal, bytes):
+		return literal[:length]
+	literal.seek(0)
+	return literal.read(length)
+
+
+def uid_ranges(uids):
+	""" returns the sorted UIDs as a list of [first, last] runs """
+	nums = sorted(set(int(u) for u in uids))
+	ranges = []
+	for n in nums:
+		if ranges and ranges[-1][1] == n - 1:
+			ranges[-1][1] = n
+		else:
+			ranges.append([n, n])
+	return ranges
+
+
+def uid_set(uids):
+	"""
+	Compresses a list of UIDs into an IMAP sequence set, e.g. 1:500,732,900:1200
+	"""
+	return ','.join(str(a) if a == b else '%d:%d' % (a, b) for a, b in uid_ranges(uids))
+
+
+def uid_set_chunks(uids, limit=4000):
+	"""
+	Compresses a list of UIDs into as few sequence sets as possible, each
+	at most limit characters long to keep command lines within server limits
+	"""
+	sets = []
+	current = ''
+	for a, b in uid_ranges(uids):
+		item = str(a) if a == b else '%d:%d' % (a, b)
+		if current and len(current) + len(item) + 1 > limit:
+			sets.append(current)
+			current = ''
+		current = current + ',' + item if current else item
+	if current:
+		sets.append(current)
+	return sets
+
+
+def parse_substitution(expr, binary=False):
+	"""
+	compiles a perl substitution such as s/"Junk"//g, as taken by
+	--regexflag and --regexmess
+	@param binary: compile it for bytes instead of str
+	@return (regex, replacement template, count) for regex.sub()
+	"""
+	if len(expr) < 2 or expr[0] != 's':
+		raise ValueError('not a s/regex/replacement/ expression: %s' % expr)
+	delim = re.escape(expr[1])
+	parts = re.split(r'(?<!\\)' + delim, expr[2:])
+	if len(parts) != 3 or not re.match(r'^[gimsx]*$', parts[2]):
+		raise ValueError('not a s/regex/replacement/ expression: %s' % expr)
+	pattern, replacement, modifiers = [re.sub(r'\\(' + delim + ')', r'\1', p) for p in parts]
+	flags = 0
+	for modifier, flag in (('i', re.I), ('m', re.M), ('s', re.S), ('x', re.X)):
+		if modifier in modifiers:
+			flags |= flag
+	replacement = re.sub(r'\$\{?(\d+)\}?', r'\\g<\1>', replacement).replace('$&', r'\g<0>')
+	if binary:
+		pattern, replacement = pattern.encode('utf-8'), replacement.encode('utf-8')
+	return re.compile(pattern, flags), replacement, 0 if 'g' in modifiers else 1
+
+
+def perl_substitution(expr):
+	""" returns a function applying a perl substitution to a string """
+	regex, replacement, count = parse_substitution(expr)
+	return lambda value: regex.sub(replacement, value, count)
+
+
+def fetch_batches(messages, budget, count):
+	"""
+	Yields index entries, in order, in batches of at most count messages
+	and budget bytes; a message larger than budget makes a batch of its own
+	"""
+	current = []
+	size = 0
+	for m in messages:
+		if current and (size + m['size'] > budget or len(current) >= count):
+			yield current
+			current = []
+			size = 0
+		current.append(m)
+		size += m['size']
+	if current:
+		yield current
+
+
+def parse_uids(data, chunk=1 << 20):
+	"""
+	returns the UIDs of a SEARCH reply as an array, split chunk bytes at a
+	time rather than into one list of them all
+	"""
+	uids = array.array('I')
+	start = 0
+	while start < len(data):
+		end = data.find(b' ', start + chunk)
+		if end < 0:
+			end = len(data)
+		uids.extend(map(int, data[start:end].split()))
+		start = end
+	return uids
+
+
+def parse_uid_set(s):
+	"""
+	Expands an IMAP sequence set of UIDs such as 1:3,7 into a list of ints
+	"""
+	uids = []
+	for part in s.split(','):
+		if ':' in part:
+			a, b = sorted(int(x) for x in part.split(':'))
+			uids.extend(range(a, b + 1))
+		elif part:
+			uids.append(int(part))
+	return uids
+
+
+def parse_fetch_response(data):
+	"""
+	Parses the untagged FETCH responses of one command in a single pass.
+
+	imaplib returns a message with a literal as a (head, literal) tuple
+	followed by the rest of the line as bytes, so attributes may appear
+	on either side of the literal.
+	@return a list of dict{ 'uid', 'flags', 'size', 'date', 'header' }
+	"""
+	messages = []
+	current = None
+	for item in data:
+		if item is None:
+			continue
+		if isinstance(item, tuple):
+			head, literal = item
+		else:
+			head, literal = item, None
+		m = FETCH_START_RE.match(head)
+		if m:
+			current = {'uid': None, 'flags': '', 'size': 0, 'date': None, 'header': b''}
+			messages.append(current)
+			head = head[m.end():]
+		if current is None:
+			continue
+		m = FETCH_UID_RE.search(head)
+		if m:
+			current['uid'] = m.group(1)
+		m = FETCH_FLAGS_RE.search(head)
+		if m:
+			flags = [f for f in m.group(1).decode('UTF-8').split() if f != '\\Recent']
+			current['flags'] = ' '.join(flags)
+		m = FETCH_SIZE_RE.search(head)
+		if m:
+			current['size'] = int(m.group(1))
+		m = FETCH_DATE_RE.search(head)
+		if m:
+			current['date'] = m.group(1).decode('UTF-8')
+		if literal is not None:
+			current['header'] = literal
+	return messages
+
+
+def parse_status(data):
+	"""
+	Parses untagged STATUS responses, e.g. "INBOX" (MESSAGES 3 UIDNEXT 9)
+	@return dict{ mailbox: dict{ item: int } }
+	"""
+	statuses = {}
+	name = None
+	for d in data:
+		if isinstance(d, tuple):
+			# mailbox name sent as a literal, the items follow
+			name = d[1]
+			continue
+		if d is None:
+			continue
+		if name is None:
+			m = STATUS_RE.match(d)
+			if not m:
+				continue
+			name, items = m.groups()
+		else:
+			items = d.strip()[1:-1]
+		name = name.decode('utf-8')
+		if name.startswith('"'):
+			name = re.sub(r'\\(.)', r'\1', name[1:-1])
+		values = items.split()
+		statuses[name] = dict((values[i].decode('ascii').upper(), int(values[i+1])) for i in range(0, len(values) - 1, 2))
+		name = None
+	return statuses
+
+
+def status_key(status):
+	""" returns the STATUS values telling whether a folder changed """
+	return (status.get('MESSAGES'), status.get('UIDNEXT'), status.get('UIDVALIDITY'), status.get('HIGHESTMODSEQ'))
+
+
+def destination_key(config):
+	"""
+	returns the destination account config['host2'] stands for, which keys
+	what the state cache records of a source folder about its sync
+	"""
+	return '%s:%s %s' % (config['host2'], config['port2'], config['user2'])
+
+
+def decode_words(value):
+	"""
+	returns a header value with its RFC 2047 encoded words decoded, as UTF-8
+	"""
+	try:
+		return str(email.header.make_header(email.header.decode_header(value.decode('ascii')))).encode('utf-8')
+	except (UnicodeError, LookupError, email.errors.HeaderParseError):
+		return value
+
+
+def message_id(message):
+	""" returns the Message-ID of a message or its header, '' without one """
+	mid = MESSAGE_ID_RE.search(re.split(rb'\r?\n\r?\n', message, 1)[0])
+	mid = ' '.join(mid.group(1).decode('utf-8', 'surrogateescape').split()) if mid else ''
+	return mid.replace('\t', ' ')
+
+
+def header_fields(message, fields):
+	""" returns the lines of a message header named in fields, as in a BODY[HEADER.FIELDS] reply """
+	header = re.split(rb'\r?\n\r?\n', message, 1)[0] + b'\n'
+	names = b'|'.join(re.escape(n.encode('ascii')) for n in fields)
+	lines = re.findall(rb'^(?:' + names + rb'):.*\n(?:[ \t].*\n)*', header, re.I | re.M)
+	return imaplib.MapCRLF.sub(imaplib.CRLF, b''.join(lines)) + b'\r\n'
+
+
+class MessageKey:
+	"""
+	Builds the comparison keys of messages: a fixed-width digest of the
+	unfolded values of the --useheader fields (Message-ID by default), plus
+	RFC822.SIZE with --no-skipsize and INTERNALDATE when it is one of the
+	--useheader names.
+
+	The header block returned by FETCH is scanned as bytes with a single
+	regular expression, no email.message object is built.
+	"""
+
+	def __init__(self, config):
+		names = config.get('useheader') or ['Message-ID']
+		if isinstance(names, str):
+			# a batch manifest column, comma separated
+			names = [n.strip() for n in names.split(',') if n.strip()]
+		self.date = any(n.upper() == 'INTERNALDATE' for n in names)
+		self.size = not config.get('skipsize', True) or any(n.upper() == 'RFC822.SIZE' for n in names)
+		self.headers = []
+		for n in names:
+			if n.upper() not in ('INTERNALDATE', 'RFC822.SIZE') and n.lower() not in self.headers:
+				self.headers.append(n.lower())
+		self.fields = [n.encode('ascii') for n in self.headers]
+		self.regex = re.compile(rb'^(' + b'|'.join(re.escape(f) for f in self.fields) + rb'):[ \t]*(.*(?:\r?\n[ \t]+.*)*)', re.I | re.M)
+		self.fetch = INDEX_FETCH % ' '.join(n.upper() for n in self.headers)
+		# recorded with cached indexes, which are stale under other keys
+		self.spec = ' '.join(self.headers + ['RFC822.SIZE'] * self.size + ['INTERNALDATE'] * self.date)
+
+	def __call__(self, header, size, date):
+		"""
+		@param header: raw header block holding the fields of self.fetch
+		@return hex digest, None when none of the header fields is present
+		"""
+		found = self.regex.findall(header)
+		if not found:
+			return None
+		parts = []
+		for name, value in found:
+			value = b' '.join(value.split())
+			if b'=?' in value:
+				value = decode_words(value)
+			parts.append(name.lower() + b':' + value)
+		if len(self.fields) > 1:
+			# servers may return the fields in any order, repeated ones keep theirs
+			parts.sort(key=lambda p: self.fields.index(p[:p.index(b':')]))
+		if self.size:
+			parts.append(b'%d' % size)
+		if self.date:
+			parts.append((date or '').encode('ascii'))
+		digest = hashlib.blake2b(b'\n'.join(parts), digest_size=16)
+		return digest.hexdigest()
+
+
+def message_key(m):
+	"""
+	returns the comparison key of an indexed message.
+	Messages without any of the key headers fall back to their size and
+	internal date, so they neither collide with each other nor all look identical.
+	"""
+	if m['mid'] is not None:
+		return m['mid']
+	return (m['size'], m['date'])
+
+
+def diff_indexes(srcindex, dstindex, key=message_key, limit=DIFF_MEMORY):
+	"""
+	Reconciles source and destination indexes in linear time.
+
+	Keys are treated as a multiset: a Message-ID present twice on the source
+	and once on the destination yields one copy, and surplus destination
+	duplicates are reported for deletion. Two CompactIndex go through
+	CompactIndex.diff(), in at most limit keys of memory, their key is
+	message_key().
+	@return (tocopy, todelete, unchanged) - source entries missing on the
+	destination, destination entries missing on the source and
+	(source, destination) pairs found on both sides
+	"""
+	if isinstance(srcindex, CompactIndex):
+		return srcindex.diff(dstindex, limit)
+	dstkeys = {}
+	for d in dstindex:
+		dstkeys.setdefault(key(d), []).append(d)
+	tocopy = []
+	unchanged = []
+	for m in srcindex:
+		bucket = dstkeys.get(key(m))
+		if bucket:
+			unchanged.append((m, bucket.pop()))
+		else:
+			tocopy.append(m)
+	todelete = [d for bucket in dstkeys.values() for d in bucket]
+	return tocopy, todelete, unchanged
+
+
+class CompactIndex:
+	"""
+	The index of a folder in arrays instead of one dict per message: UIDs,
+	sizes, flags as bitmasks over the flag names met, the 128-bit digest of
+	the comparison key as two fixed-width 64-bit words and the INTERNALDATE
+	packed in a 64-bit word. The odd key which is no digest and the date
+	which does not read back the same once packed go in one bytes heap. A
+	message costs about 60 bytes where its dict took a kilobyte, up to
+	about 110 with a key which is no digest and the slack of the arrays.
+	The whole index is kept in memory, whatever --diffmemory.
+
+	It reads like the list of dict{ 'uid', 'mid', 'flags', 'size', 'date' }
+	it stands for: entries are built on access, with their position in the
+	index as 'pos'.
+	"""
+
+	# kinds of key in keylens, else the length of the key in the heap
+	DIGEST = -2
+	NOKEY = -1
+	# kinds of date in datelens, else the length of the date in the heap
+	PACKED = -2
+	NODATE = -1
+	MONTHS = ('Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec')
+	DATE_RE = re.compile(r'( [1-9]|[0-3]\d)-([A-Z][a-z]{2})-(\d{4}) ([01]\d|2[0-3]):([0-5]\d):([0-5]\d) ([+-])(\d\d)([0-5]\d)\Z')
+
+	def __init__(self, entries=()):
+		self.uids = array.array('I')
+		self.sizes = array.array('Q')
+		self.flags = array.array('Q')
+		# the first 64 bits of a digest key, a hash of any other key
+		self.hi = array.array('Q')
+		self.lo = array.array('Q')
+		self.starts = array.array('Q')
+		self.dates = array.array('Q')
+		self.keylens = array.array('h')
+		self.datelens = array.array('b')
+		self.heap = bytearray()
+		self.flagnames = []
+		self.flagbits = {}
+		self.flagstrings = {}
+		self.datestrings = {}
+		self.zonestrings = {}
+		self.ascending = True
+		self.positions = None
+		self.extend(entries)
+
+	def __len__(self):
+		return len(self.uids)
+
+	def __iter__(self):
+		for i in range(len(self.uids)):
+			yield self[i]
+
+	def __getitem__(self, i):
+		start = self.starts[i]
+		keylen = self.keylens[i]
+		if keylen == self.DIGEST:
+			mid = '%016x%016x' % (self.hi[i], self.lo[i])
+		elif keylen == self.NOKEY:
+			mid = None
+		else:
+			mid = self.heap[start:start + keylen].decode('utf-8', 'surrogateescape')
+			start += keylen
+		datelen = self.datelens[i]
+		if datelen == self.PACKED:
+			date = self.__unpackDate(self.dates[i])
+		elif datelen == self.NODATE:
+			date = None
+		else:
+			date = self.heap[start:start + datelen].decode('ascii')
+		return {'uid': b'%d' % self.uids[i], 'mid': mid, 'flags': self.__flagString(self.flags[i]),
+			'size': self.sizes[i], 'date': date, 'pos': i}
+
+	def append(self, m):
+		uid = int(m['uid'])
+		if self.uids and uid <= self.uids[-1]:
+			self.ascending = False
+		self.positions = None
+		self.uids.append(uid)
+		self.sizes.append(m['size'])
+		# may turn self.flags into a list
+		mask = self.__mask(m['flags'])
+		self.flags.append(mask)
+		self.starts.append(len(self.heap))
+		mid = m['mid']
+		raw = None
+		if mid is not None and len(mid) == 32:
+			with contextlib.suppress(ValueError):
+				raw = bytes.fromhex(mid)
+		if raw is not None and raw.hex() == mid:
+			self.keylens.append(self.DIGEST)
+			self.hi.append(int.from_bytes(raw[:8], 'big'))
+			self.lo.append(int.from_bytes(raw[8:], 'big'))
+		else:
+			if mid is None:
+				self.keylens.append(self.NOKEY)
+			else:
+				data = mid.encode('utf-8', 'surrogateescape')
+				self.keylens.append(len(data))
+				self.heap += data
+			self.hi.append(hash(message_key(m)) & 0xffffffffffffffff)
+			self.lo.append(0)
+		packed = None if m['date'] is None else self.__packDate(m['date'])
+		if packed is not None:
+			self.datelens.append(self.PACKED)
+			self.dates.append(packed)
+		elif m['date'] is None:
+			self.datelens.append(self.NODATE)
+			self.dates.append(0)
+		else:
+			data = m['date'].encode('ascii')
+			self.datelens.append(len(data))
+			self.dates.append(0)
+			self.heap += data
+
+	def extend(self, entries):
+		for m in entries:
+			self.append(m)
+
+	def key(self, i):
+		""" returns what message_key() returns for entry i, as compact """
+		keylen = self.keylens[i]
+		if keylen == self.DIGEST:
+			return (self.hi[i], self.lo[i])
+		start = self.starts[i]
+		if keylen >= 0:
+			return bytes(self.heap[start:start + keylen])
+		datelen = self.datelens[i]
+		if datelen == self.PACKED:
+			return (self.sizes[i], self.dates[i])
+		return (self.sizes[i], None if datelen < 0 else bytes(self.heap[start:start + datelen]))
+
+	def position(self, uid):
+		""" returns the position of uid in the index, None when absent """
+		if self.ascending:
+			i = bisect.bisect_left(self.uids, uid)
+			return i if i < len(self.uids) and self.uids[i] == uid else None
+		if self.positions is None:
+			self.positions = dict((u, i) for (i, u) in enumerate(self.uids))
+		return self.positions.get(uid)
+
+	def set_flags(self, i, flags):
+		self.flags[i] = self.__mask(flags)
+
+	def __mask(self, flags):
+		mask = 0
+		for name in flags.split():
+			bit = self.flagbits.get(name)
+			if bit is None:
+				bit = self.flagbits[name] = len(self.flagnames)
+				self.flagnames.append(name)
+				if bit == 64:
+					# keywords beyond 64 names take Python ints
+					self.flags = list(self.flags)
+			mask |= 1 << bit
+		return mask
+
+	def __packDate(self, date):
+		""" returns the INTERNALDATE date as bit fields, None when it would not read back the same """
+		match = self.DATE_RE.match(date)
+		if match is None or match.group(2) not in self.MONTHS:
+			return None
+		day, month, year, hour, minute, second, sign, zhour, zminute = match.groups()
+		return (int(year) << 41 | self.MONTHS.index(month) << 37 | int(day) << 32 | (day[0] == ' ') << 31
+			| int(hour) << 26 | int(minute) << 20 | int(second) << 14 | (sign == '-') << 13
+			| int(zhour) << 6 | int(zminute))
+
+	def __unpackDate(self, packed):
+		# a folder spans few days and zones, their text is kept
+		day = self.datestrings.get(packed >> 31)
+		if day is None:
+			day = self.datestrings[packed >> 31] = '%s-%s-%04d' % (('%2d' if packed >> 31 & 1 else '%02d') % (packed >> 32 & 31),
+				self.MONTHS[packed >> 37 & 15], packed >> 41)
+		zone = self.zonestrings.get(packed & 0x3fff)
+		if zone is None:
+			zone = self.zonestrings[packed & 0x3fff] = '%s%02d%02d' % ('-' if packed >> 13 & 1 else '+', packed >> 6 & 127, packed & 63)
+		return '%s %02d:%02d:%02d %s' % (day, packed >> 26 & 31, packed >> 20 & 63, packed >> 14 & 63, zone)
+
+	def __flagString(self, mask):
+		flags = self.flagstrings.get(mask)
+		if flags is None:
+			flags = self.flagstrings[mask] = ' '.join(name for (bit, name) in enumerate(self.flagnames) if mask >> bit & 1)
+		return flags
+
+	def diff(self, other, limit=DIFF_MEMORY):
+		"""
+		Reconciles this source index with the destination index other, the
+		way diff_indexes() does: by a hash join over the keys of other when
+		it holds at most limit of them, else by a sort-merge of the key
+		hashes of both, sorted in runs of limit spilled to temporary files,
+		which are merged.
+		@return (tocopy, todelete, unchanged) as IndexSelection of self,
+		IndexSelection of other and IndexPairs
+		"""
+		tocopy = bytearray(len(self))
+		todelete = bytearray(len(other))
+		unchanged = IndexPairs(self, other, limit)
+		if len(other) <= limit:
+			self.__join(other, tocopy, todelete, unchanged)
+			return IndexSelection(self, tocopy), IndexSelection(other, todelete), unchanged
+		runs = self.__runs(0, limit) + other.__runs(1, limit)
+		group = []
+		current = None
+		for v in heapq.merge(*runs):
+			if v >> 33 != current:
+				self.__pair(other, group, tocopy, todelete, unchanged)
+				group = []
+				current = v >> 33
+			group.append(v & 0x1ffffffff)
+		self.__pair(other, group, tocopy, todelete, unchanged)
+		return IndexSelection(self, tocopy), IndexSelection(other, todelete), unchanged
+
+	def __keys(self):
+		""" yields the keys of the entries, a digest as one int """
+		digest = self.DIGEST
+		for i, (hi, lo, keylen) in enumerate(zip(self.hi, self.lo, self.keylens)):
+			yield hi << 64 | lo if keylen == digest else self.key(i)
+
+	def __join(self, other, tocopy, todelete, unchanged):
+		""" pairs the entries of self and other in a dict of the keys of other """
+		first = {}
+		more = {}
+		for j, k in enumerate(other.__keys()):
+			if k in first:
+				more.setdefault(k, []).append(j)
+			else:
+				first[k] = j
+		for i, k in enumerate(self.__keys()):
+			j = first.pop(k, None)
+			if j is None:
+				tocopy[i] = 1
+				continue
+			unchanged.add(i, j)
+			if k in more:
+				first[k] = more[k].pop()
+				if not more[k]:
+					del more[k]
+		for j in first.values():
+			todelete[j] = 1
+		for js in more.values():
+			for j in js:
+				todelete[j] = 1
+
+	def __runs(self, side, limit):
+		""" returns iterators over sorted runs of hi << 33 | side << 32 | position, spilled to temporary files """
+		tag = side << 32
+		n = len(self)
+		runs = []
+		for first in range(0, n, limit):
+			run = sorted((self.hi[i] << 33) | tag | i for i in range(first, min(n, first + limit)))
+			f = tempfile.TemporaryFile()
+			for k in range(0, len(run), 65536):
+				f.write(b''.join(v.to_bytes(13, 'big') for v in run[k:k + 65536]))
+			del run
+			f.seek(0)
+			runs.append(read_run(f))
+		return runs
+
+	def __pair(self, other, group, tocopy, todelete, unchanged):
+		"""
+		Pairs the source and destination entries of a group sharing a key
+		hash, by key
+		"""
+		if len(group) == 2 and group[0] >> 32 == 0 and group[1] >> 32 == 1:
+			i = group[0]
+			j = group[1] & 0xffffffff
+			if self.keylens[i] == other.keylens[j] == self.DIGEST:
+				same = self.lo[i] == other.lo[j]
+			else:
+				same = self.key(i) == other.key(j)
+			if same:
+				unchanged.add(i, j)
+				return
+		keys = {}
+		for v in group:
+			side = v >> 32
+			pos = v & 0xffffffff
+			keys.setdefault((self, other)[side].key(pos), ([], []))[side].append(pos)
+		for (srcs, dsts) in keys.values():
+			for i, j in zip(srcs, dsts):
+				unchanged.add(i, j)
+			for i in srcs[len(dsts):]:
+				tocopy[i] = 1
+			for j in dsts[len(srcs):]:
+				todelete[j] = 1
+
+
+def read_run(f, records=65536):
+	""" yields the 13-byte big-endian integers of a sorted run file and closes it """
+	try:
+		while True:
+			block = f.read(13 * records)
+			if not block:
+				return
+			for k in range(0, len(block), 13):
+				yield int.from_bytes(block[k:k + 13], 'big')
+	finally:
+		f.close()
+
+
+class IndexSelection:
+	"""
+	The entries of a CompactIndex whose byte in mask is set, in index order:
+	one byte a message however many are selected
+	"""
+
+	NONZERO_RE = re.compile(rb'[^\x00]')
+
+	def __init__(self, index, mask=None):
+		self.index = index
+		self.mask = bytearray(len(index)) if mask is None else mask
+		self.count = len(self.mask) - self.mask.count(0)
+
+	def __len__(self):
+		return self.count
+
+	def __iter__(self):
+		for i in self.positions():
+			yield self.index[i]
+
+	def __contains__(self, m):
+		return bool(self.mask[m['pos']])
+
+	def positions(self):
+		for match in self.NONZERO_RE.finditer(self.mask):
+			yield match.start()
+
+	def select(self, predicate):
+		""" returns the IndexSelection of the entries predicate is true for """
+		mask = bytearray(len(self.mask))
+		for m in self:
+			if predicate(m):
+				mask[m['pos']] = 1
+		return IndexSelection(self.index, mask)
+
+	@staticmethod
+	def union(index, selections):
+		""" returns the IndexSelection of index entries in any of selections """
+		n = len(index)
+		mask = 0
+		for s in selections:
+			mask |= int.from_bytes(s.mask, 'little')
+		return IndexSelection(index, bytearray(mask.to_bytes(n, 'little')))
+
+
+class IndexPairs:
+	"""
+	(source entry, destination entry) pairs of two CompactIndex, kept as
+	pairs of positions, the pairs beyond limit spilled to a temporary file
+	"""
+
+	def __init__(self, src, dst, limit=DIFF_MEMORY):
+		self.src = src
+		self.dst = dst
+		self.limit = limit
+		self.buffer = array.array('I')
+		self.spill = None
+		self.count = 0
+
+	def __len__(self):
+		return self.count
+
+	def add(self, i, j):
+		self.buffer.append(i)
+		self.buffer.append(j)
+		self.count += 1
+		if len(self.buffer) >= 2 * self.limit:
+			if self.spill is None:
+				self.spill = tempfile.TemporaryFile()
+			self.spill.seek(0, os.SEEK_END)
+			self.buffer.tofile(self.spill)
+			self.buffer = array.array('I')
+
+	def __iter__(self):
+		if self.spill is not None:
+			self.spill.seek(0)
+			while True:
+				block = array.array('I')
+				block.frombytes(self.spill.read(8 * 65536))
+				if not block:
+					break
+				for k in range(0, len(block), 2):
+					yield self.src[block[k]], self.dst[block[k + 1]]
+		for k in range(0, len(self.buffer), 2):
+			yield self.src[self.buffer[k]], self.dst[self.buffer[k + 1]]
+
+
+class StateCache:
+	"""
+	Persistent per-folder index of UID -> Message-ID, size, flags, date.
+
+	Entries are keyed by host, user and folder and are only valid for the
+	UIDVALIDITY and the comparison key (MessageKey.spec) they were recorded
+	under; a different UIDVALIDITY or key drops them.
+	"""
+
+	SCHEMA = '''
+		CREATE TABLE IF NOT EXISTS folders (
+			id INTEGER PRIMARY KEY,
+			host TEXT, user TEXT, folder TEXT,
+			uidvalidity INTEGER, uidnext INTEGER, highestmodseq INTEGER,
+			UNIQUE (host, user, folder));
+		CREATE TABLE IF NOT EXISTS messages (
+			folder_id INTEGER, uid INTEGER,
+			mid TEXT, size INTEGER, flags TEXT, date TEXT,
+			PRIMARY KEY (folder_id, uid)) WITHOUT ROWID;
+		CREATE TABLE IF NOT EXISTS synced (
+			host TEXT, user TEXT, folder TEXT, dest TEXT,
+			messages INTEGER, uidnext INTEGER, uidvalidity INTEGER, highestmodseq INTEGER,
+			options TEXT,
+			PRIMARY KEY (host, user, folder, dest));
+		CREATE TABLE IF NOT EXISTS journal (
+			host TEXT, user TEXT, folder TEXT, dest TEXT, uidvalidity INTEGER, uid INTEGER,
+			PRIMARY KEY (host, user, folder, dest, uidvalidity, uid)) WITHOUT ROWID;
+	'''
+
+	def __init__(self, path, keyspec='message-id'):
+		self.keyspec = keyspec
+		self.lock = threading.Lock()
+		self.db = sqlite3.connect(path, check_same_thread=False)
+		self.db.executescript(self.SCHEMA)
+		columns = [row[1] for row in self.db.execute('PRAGMA table_info(folders)')]
+		if 'highestmodseq' not in columns:
+			self.db.execute('ALTER TABLE folders ADD COLUMN highestmodseq INTEGER')
+		if 'keyspec' not in columns:
+			self.db.execute('ALTER TABLE folders ADD COLUMN keyspec TEXT')
+		for table in ('synced', 'journal'):
+			columns = [row[1] for row in self.db.execute('PRAGMA table_info(%s)' % table)]
+			if 'dest' not in columns:
+				self.__addDest(table, columns)
+
+	def __addDest(self, table, columns):
+		"""
+		Moves the rows of a table from before fan-out into one keyed by
+		destination as well, under the destination ''
+		"""
+		with self.db:
+			self.db.execute('ALTER TABLE %s RENAME TO old_%s' % (table, table))
+		self.db.executescript(self.SCHEMA)
+		with self.db:
+			self.db.execute("INSERT INTO %s (%s, dest) SELECT %s, '' FROM old_%s" % (table,
+				', '.join(columns), ', '.join(columns), table))
+			self.db.execute('DROP TABLE old_%s' % table)
+
+	def __folder(self, host, user, folder):
+		row = self.db.execute('SELECT id, uidvalidity, highestmodseq, keyspec FROM folders WHERE host=? AND user=? AND folder=?',
+			(host, user, folder)).fetchone()
+		if row is not None and row[3] != self.keyspec:
+			# indexed under another key, only the row id is of any use
+			row = (row[0], None, None, row[3])
+		return row
+
+	def load(self, host, user, folder, uidvalidity):
+		"""
+		@return (CompactIndex in UID order, HIGHESTMODSEQ) recorded for this
+		UIDVALIDITY, (empty CompactIndex, None) when unknown
+		"""
+		with self.lock:
+			row = self.__folder(host, user, folder)
+			cached = CompactIndex()
+			if row is None or row[1] != uidvalidity:
+				return cached, None
+			cached.extend({'uid': uid, 'mid': mid, 'size': size, 'flags': flags, 'date': date}
+				for uid, mid, size, flags, date in self.db.execute(
+					'SELECT uid, mid, size, flags, date FROM messages WHERE folder_id=? ORDER BY uid', (row[0],)))
+			return cached, row[2]
+
+	def save(self, host, user, folder, uidvalidity, uidnext, highestmodseq, index):
+		""" Replaces the folder state with the given index """
+		with self.lock, self.db:
+			row = self.__folder(host, user, folder)
+			if row is None:
+				fid = self.db.execute('INSERT INTO folders (host, user, folder, uidvalidity, uidnext, highestmodseq, keyspec) VALUES (?,?,?,?,?,?,?)',
+					(host, user, folder, uidvalidity, uidnext, highestmodseq, self.keyspec)).lastrowid
+			else:
+				fid = row[0]
+				self.db.execute('UPDATE folders SET uidvalidity=?, uidnext=?, highestmodseq=?, keyspec=? WHERE id=?',
+					(uidvalidity, uidnext, highestmodseq, self.keyspec, fid))
+				self.db.execute('DELETE FROM messages WHERE folder_id=?', (fid,))
+			self.db.executemany('INSERT OR REPLACE INTO messages VALUES (?,?,?,?,?,?)',
+				((fid, int(m['uid']), m['mid'], m['size'], m['flags'], m['date']) for m in index))
+
+	def forget(self, host, user, folder):
+		""" Drops the folder state, the next run indexes the folder in full """
+		with self.lock, self.db:
+			row = self.__folder(host, user, folder)
+			if row is not None:
+				self.db.execute('DELETE FROM messages WHERE folder_id=?', (row[0],))
+				self.db.execute('DELETE FROM folders WHERE id=?', (row[0],))
+
+	def add_messages(self, host, user, folder, uidvalidity, index):
+		""" Adds index entries to a folder cached under this UIDVALIDITY """
+		with self.lock, self.db:
+			row = self.__folder(host, user, folder)
+			if row is None or row[1] != uidvalidity:
+				return
+			self.db.executemany('INSERT OR REPLACE INTO messages VALUES (?,?,?,?,?,?)',
+				((row[0], int(m['uid']), m['mid'], m['size'], m['flags'], m['date']) for m in index))
+
+	def journal(self, host, user, folder, dest, uidvalidity):
+		"""
+		@return the set of source UIDs an unfinished sync of the folder copied
+		to dest, rows from before fan-out included
+		"""
+		with self.lock:
+			return set(uid for (uid,) in self.db.execute(
+				"SELECT uid FROM journal WHERE host=? AND user=? AND folder=? AND dest IN (?, '') AND uidvalidity=?",
+				(host, user, folder, dest, uidvalidity)))
+
+	def add_journal(self, host, user, folder, dest, uidvalidity, uids):
+		""" Records source UIDs whose copy the destination dest confirmed """
+		with self.lock, self.db:
+			self.db.executemany('INSERT OR IGNORE INTO journal VALUES (?,?,?,?,?,?)',
+				((host, user, folder, dest, uidvalidity, int(uid)) for uid in uids))
+
+	def clear_journal(self, host, user, folder, dest):
+		""" Forgets the journal of a folder once its sync to dest completed """
+		with self.lock, self.db:
+			self.db.execute("DELETE FROM journal WHERE host=? AND user=? AND folder=? AND dest IN (?, '')",
+				(host, user, folder, dest))
+
+	def synced(self, host, user, folder, dest=''):
+		"""
+		@return (MESSAGES, UIDNEXT, UIDVALIDITY, HIGHESTMODSEQ, options) of the
+		folder after its last complete sync, to dest for a source folder,
+		None when unknown
+		"""
+		with self.lock:
+			return self.db.execute('SELECT messages, uidnext, uidvalidity, highestmodseq, options FROM synced WHERE host=? AND user=? AND folder=? AND dest=?',
+				(host, user, folder, dest)).fetchone()
+
+	def save_synced(self, host, user, folder, status, options, dest=''):
+		""" Records the STATUS of a folder right after a complete sync """
+		with self.lock, self.db:
+			self.db.execute('INSERT OR REPLACE INTO synced VALUES (?,?,?,?,?,?,?,?,?)',
+				(host, user, folder, dest) + status + (options,))
+
+	def close(self):
+		with self.lock:
+			self.db.close()
+
+
+class PipelinedIMAP4:
+	"""
+	imaplib.IMAP4 look-alike on top of an asyncio connection.
+
+	Commands are tagged and written as soon as they are submitted, so up to
+	depth commands can be in flight at once; uid_async() and append_async()
+	return concurrent.futures.Future objects, the blocking methods mirror
+	imaplib's return values. Untagged responses are attributed to the oldest
+	outstanding command, i.e. the server is assumed to answer in order.
+	"""
+
+	error = imaplib.IMAP4.error
+	abort = imaplib.IMAP4.abort
+	readonly = imaplib.IMAP4.readonly
+
+	# longest response line accepted, a SEARCH of a huge folder is one line
+	MAXLINE = 64 * 1024 * 1024
+
+	def __init__(self, host, port, secure=False, depth=8, timeout=None):
+		self.host = host
+		self.port = port
+		self.depth = max(1, int(depth))
+		self.timeout = timeout
+		self.state = 'LOGOUT'
+		self.is_readonly = False
+		self.capabilities = ()
+		self.deflate = None
+		self.metrics = None
+		self.throttle = None
+		self.received = self.accounted = 0
+		self.untagged_responses = {}
+		self.tagpre = b'P' + str(id(self) % 10000).encode()
+		self.tagnum = 0
+		self.pending = collections.OrderedDict()
+		self.lock = threading.Lock()
+		self.loop = asyncio.new_event_loop()
+		# named after its owner so that batch mode logs what it prints with the account
+		self.thread = threading.Thread(target=self.loop.run_forever, daemon=True,
+			name=threading.current_thread().name + '/imap')
+		self.thread.start()
+		try:
+			self.welcome = self.__call(self.__connect(secure))
+		except BaseException:
+			self.__stop()
+			raise
+		self.state = 'NONAUTH'
+		self.capability()
+
+	# -- event loop side -----------------------------------------
+
+	def __call(self, coro):
+		return asyncio.run_coroutine_threadsafe(coro, self.loop).result()
+
+	def __stop(self):
+		self.loop.call_soon_threadsafe(self.loop.stop)
+
+	async def __connect(self, secure):
+		context = None
+		if secure:
+			context = ssl.create_default_context()
+		self.reader, self.writer = await asyncio.wait_for(
+			asyncio.open_connection(self.host, self.port, ssl=context, limit=self.MAXLINE), self.timeout)
+		self.write_lock = asyncio.Lock()
+		self.window = asyncio.Semaphore(self.depth)
+		self.continuation = None
+		self.continued = None
+		self.inflater = None
+		welcome = await asyncio.wait_for(self.reader.readline(), self.timeout)
+		if not welcome.startswith((b'* OK', b'* PREAUTH')):
+			raise self.error('unexpected greeting: %r' % welcome)
+		self.reader_task = self.loop.create_task(self.__readLoop())
+		return welcome.rstrip(b'\r\n')
+
+	async def __close(self):
+		tasks = [t for t in (self.reader_task, self.inflater) if t is not None]
+		for task in tasks:
+			task.cancel()
+		self.writer.close()
+		for task in tasks:
+			try:
+				await task
+			except (asyncio.CancelledError, Exception):
+				pass
+
+	def __startDeflate(self):
+		"""
+		Switches both directions to DEFLATE, called by the read loop right
+		after the tagged OK of COMPRESS so no compressed byte is read raw
+		"""
+		self.deflate = Deflate()
+		self.writer = DeflateWriter(self.writer, self.deflate)
+		raw, self.reader = self.reader, asyncio.StreamReader(limit=self.MAXLINE)
+		self.inflater = self.loop.create_task(self.__inflate(raw, self.reader))
+
+	async def __inflate(self, raw, plain):
+		try:
+			while True:
+				data = await raw.read(STREAM_CHUNK)
+				if not data:
+					plain.feed_eof()
+					return
+				plain.feed_data(self.deflate.decompress(data))
+		except Exception as e:
+			plain.set_exception(e)
+
+	async def __readLine(self):
+		while True:
+			try:
+				line = await asyncio.wait_for(self.reader.readline(), self.timeout)
+			except asyncio.TimeoutError:
+				if self.pending:
+					raise
+				continue
+			if not line:
+				raise EOFError('EOF')
+			self.received += len(line)
+			await self.__pace(0, len(line))
+			return line.rstrip(b'\r\n')
+
+	async def __pace(self, commands, size):
+		if self.throttle is not None:
+			delay = self.throttle.delay(commands, size)
+			if delay:
+				await asyncio.sleep(delay)
+
+	async def __readLoop(self):
+		try:
+			while True:
+				line = await self.__readLine()
+				if imaplib.Continuation.match(line):
+					if self.continuation is not None and not self.continuation.done():
+						self.continuation.set_result(True)
+					continue
+				self.__dispatch(line)
+				while self.literals:
+					size = self.literals.pop()
+					literal = await self.reader.readexactly(size)
+					self.received += size
+					await self.__pace(0, size)
+					line = await self.__readLine()
+					self.__appendLiteral(literal, line)
+		except Exception as e:
+			err = self.abort('socket error: %s' % (e or e.__class__.__name__))
+			for record in self.pending.values():
+				if not record['done'].done():
+					record['done'].set_exception(err)
+			if self.continuation is not None and not self.continuation.done():
+				self.continuation.set_exception(err)
+			self.pending.clear()
+
+	def __untagged(self):
+		""" returns the dict collecting untagged responses right now """
+		for record in self.pending.values():
+			return record['untagged']
+		return self.untagged_responses
+
+	def __append(self, untagged, typ, dat):
+		with self.lock:
+			untagged.setdefault(typ, []).append(dat)
+
+	def __dispatch(self, line):
+		""" Parses one response line the way imaplib._get_response() does """
+		self.literals = []
+		m = re.match(rb'(?P<tag>[A-Za-z0-9]+) (?P<type>[A-Z]+) ?(?P<data>.*)', line)
+		if m and m.group('tag') in self.pending:
+			record = self.pending.pop(m.group('tag'))
+			typ, dat = m.group('type').decode('ascii'), m.group('data')
+			untagged = record['untagged']
+			code = imaplib.Response_code.match(dat)
+			if code:
+				self.__append(untagged, code.group('type').decode('ascii'), code.group('data'))
+			if record is self.continued and not self.continuation.done():
+				# refused before the literal was sent
+				self.continuation.set_result(False)
+			if record['name'] == 'COMPRESS' and typ == 'OK':
+				self.__startDeflate()
+			# responses come in order, what was read since the previous completion is this command's
+			record['bytes_in'] = self.received - self.accounted
+			self.accounted = self.received
+			record['done'].set_result((typ, [dat]))
+			return
+		dat2 = None
+		m = imaplib.Untagged_response.match(line)
+		if not m:
+			m = imaplib.Untagged_status.match(line)
+			if m:
+				dat2 = m.group('data2')
+		if not m:
+			raise self.abort('unexpected response: %r' % line)
+		typ = m.group('type').decode('ascii')
+		dat = m.group('data') or b''
+		if dat2:
+			dat = dat + b' ' + dat2
+		if typ == 'BYE' and not any(r['name'] == 'LOGOUT' for r in self.pending.values()):
+			raise EOFError(dat.decode('utf-8', 'replace'))
+		self.current = (self.__untagged(), typ)
+		lit = imaplib.Literal.match(dat)
+		if lit:
+			self.head = dat
+			self.literals.append(int(lit.group('size')))
+			return
+		self.__append(self.current[0], typ, dat)
+		code = imaplib.Response_code.match(dat)
+		if typ in ('OK', 'NO', 'BAD') and code:
+			self.__append(self.current[0], code.group('type').decode('ascii'), code.group('data'))
+
+	def __appendLiteral(self, literal, line):
+		untagged, typ = self.current
+		self.__append(untagged, typ, (self.head, literal))
+		lit = imaplib.Literal.match(line)
+		if lit:
+			self.head = line
+			self.literals.append(int(lit.group('size')))
+		else:
+			self.__append(untagged, typ, line)
+
+	async def __writeLiteral(self, literal):
+		""" Writes a bytes or file literal and its closing CRLF """
+		if isinstance(literal, bytes):
+			self.writer.write(literal + b'\r\n')
+			return
+		literal.seek(0)
+		while True:
+			chunk = literal.read(STREAM_CHUNK)
+			if not chunk:
+				break
+			self.writer.write(chunk)
+			await self.writer.drain()
+		self.writer.write(b'\r\n')
+
+	async def __execute(self, name, args, literal, result):
+		""" Runs a command, sending it again as long as the server throttles it """
+		attempt = 0
+		while True:
+			typ, dat = await self.__executeOnce(name, args, literal, result)
+			delay = None
+			if self.throttle is not None:
+				delay = self.throttle.backoff(typ, dat, attempt)
+			if delay is None:
+				return typ, dat
+			attempt += 1
+			await asyncio.sleep(delay)
+
+	async def __executeOnce(self, name, args, literal, result):
+		await self.window.acquire()
+		try:
+			tag = self.tagpre + str(self.tagnum).encode()
+			self.tagnum += 1
+			data = tag + b' ' + name.encode('ascii')
+			for arg in args:
+				if arg is None:
+					continue
+				if isinstance(arg, str):
+					arg = arg.encode('utf-8')
+				data = data + b' ' + arg
+			record = {'name': name, 'untagged': {}, 'done': self.loop.create_future(), 'bytes_in': 0}
+			t0 = time.time()
+			bytes_out = len(data) + 2
+			if literal is not None:
+				size = literal_size(literal)
+				bytes_out += size + len(b' {%d+}\r\n' % size)
+			await self.__pace(1, bytes_out)
+			async with self.write_lock:
+				if self.reader_task.done():
+					raise self.abort('socket error: connection closed')
+				self.pending[tag] = record
+				if literal is None:
+					self.writer.write(data + b'\r\n')
+				elif 'LITERAL+' in self.capabilities:
+					self.writer.write(data + b' {%d+}\r\n' % literal_size(literal))
+					await self.__writeLiteral(literal)
+				else:
+					self.continuation = self.loop.create_future()
+					self.continued = record
+					self.writer.write(data + b' {%d}\r\n' % literal_size(literal))
+					await self.writer.drain()
+					if await self.continuation:
+						await self.__writeLiteral(literal)
+					self.continuation = self.continued = None
+				await self.writer.drain()
+			typ, dat = await record['done']
+		finally:
+			self.window.release()
+		if self.metrics is not None:
+			label = name
+			if name == 'UID':
+				label = 'UID ' + args[0].upper()
+			self.metrics.command(label, time.time() - t0, record['bytes_in'], bytes_out, typ == 'OK')
+		if typ == 'BAD':
+			raise self.error('%s command error: %s %s' % (name, typ, dat))
+		untagged = record['untagged']
+		if result is not None and typ != 'NO':
+			dat = untagged.pop(result, [None])
+		with self.lock:
+			for key, value in untagged.items():
+				self.untagged_responses.setdefault(key, []).extend(value)
+		return typ, dat
+
+	# -- imaplib compatible interface ----------------------------
+
+	def submit(self, name, *args, literal=None, result=None):
+		"""
+		Sends a command without waiting for its completion.
+		@return a concurrent.futures.Future of (typ, data)
+		"""
+		return asyncio.run_coroutine_threadsafe(self.__execute(name, args, literal, result), self.loop)
+
+	def _simple(self, name, *args, literal=None, result=None):
+		return self.submit(name, *args, literal=literal, result=result).result()
+
+	def _quote(self, arg):
+		arg = arg.replace('\\', '\\\\').replace('"', '\\"')
+		return '"' + arg + '"'
+
+	def capability(self):
+		typ, dat = self._simple('CAPABILITY', result='CAPABILITY')
+		if typ == 'OK' and dat[-1]:
+			self.capabilities = tuple(dat[-1].decode('ascii').upper().split())
+		return typ, dat
+
+	def login(self, user, password):
+		typ, dat = self._simple('LOGIN', user, self._quote(password))
+		if typ != 'OK':
+			raise self.error(dat[-1])
+		self.state = 'AUTH'
+		return typ, dat
+
+	def logout(self):
+		self.state = 'LOGOUT'
+		try:
+			typ, dat = self._simple('LOGOUT', result='BYE')
+		except (self.error, self.abort, OSError):
+			typ, dat = 'NO', [None]
+		self.__call(self.__close())
+		self.__stop()
+		return typ, dat
+
+	def enable(self, capability):
+		if 'ENABLE' not in self.capabilities:
+			raise self.error("Server does not support ENABLE")
+		return self._simple('ENABLE', capability)
+
+	def compress(self):
+		""" Starts COMPRESS=DEFLATE, no other command may be in flight """
+		return self._simple('COMPRESS', 'DEFLATE')
+
+	def response(self, code):
+		with self.lock:
+			return code, self.untagged_responses.pop(code.upper(), [None])
+
+	def noop(self):
+		return self._simple('NOOP')
+
+	def list(self, directory='""', pattern='*'):
+		return self._simple('LIST', directory, pattern, result='LIST')
+
+	def create(self, mailbox):
+		return self._simple('CREATE', mailbox)
+
+	def status(self, mailbox, names):
+		return self._simple('STATUS', mailbox, names, result='STATUS')
+
+	def select(self, mailbox='INBOX', readonly=False):
+		with self.lock:
+			self.untagged_responses = {}
+		self.is_readonly = readonly
+		typ, dat = self._simple('EXAMINE' if readonly else 'SELECT', mailbox)
+		if typ != 'OK':
+			self.state = 'AUTH'
+			return typ, dat
+		self.state = 'SELECTED'
+		return typ, self.untagged_responses.get('EXISTS', [None])
+
+	def search(self, charset, *criteria):
+		if charset:
+			criteria = ('CHARSET', charset) + criteria
+		return self._simple('SEARCH', *criteria, result='SEARCH')
+
+	def fetch(self, message_set, message_parts):
+		return self._simple('FETCH', message_set, message_parts, result='FETCH')
+
+	def store(self, message_set, command, flags):
+		return self._simple('STORE', message_set, command, flags, result='FETCH')
+
+	def expunge(self):
+		return self._simple('EXPUNGE', result='EXPUNGE')
+
+	def uid_async(self, command, *args):
+		""" Like uid(), but returns a Future instead of waiting """
+		command = command.upper()
+		result = command if command in ('SEARCH', 'SORT', 'THREAD') else 'FETCH'
+		return self.submit('UID', command, *args, result=result)
+
+	def uid(self, command, *args):
+		return self.uid_async(command, *args).result()
+
+	def append_async(self, mailbox, flags, date_time, message):
+		"""
+		Like append(), but returns a Future instead of waiting.
+		message may also be a file object, which is streamed as is.
+		"""
+		if flags and (flags[0], flags[-1]) != ('(', ')'):
+			flags = '(%s)' % flags
+		if date_time:
+			date_time = imaplib.Time2Internaldate(date_time)
+		literal = message
+		if isinstance(message, bytes):
+			literal = imaplib.MapCRLF.sub(imaplib.CRLF, message)
+		return self.submit('APPEND', mailbox or 'INBOX', flags or None, date_time or None, literal=literal)
+
+	def append(self, mailbox, flags, date_time, message):
+		return self.append_async(mailbox, flags, date_time, message).result()
+
+
+class LocalIMAP4:
+	"""
+	Base of the imaplib.IMAP4 look-alikes on local storage: it answers the
+	commands syncimap sends with the (typ, data) imaplib would return, so
+	the sync code runs unchanged, but without sockets or a server.
+
+	A subclass keeps the selected folder in self.folder, a dict with
+	'uidvalidity', 'uidnext', 'order' and 'messages', a dict{ uid: entry },
+	and implements the storage side: _folder(), _flags(), _size(), _time(),
+	_internaldate(), _read(), _header(), _setflags(), _remove() and the
+	list(), create() and append() commands.
+	"""
+
+	error = imaplib.IMAP4.error
+	abort = imaplib.IMAP4.abort
+	readonly = imaplib.IMAP4.readonly
+
+	PERMANENTFLAGS = ('\\Answered', '\\Deleted', '\\Draft', '\\Flagged', '\\Seen')
+
+	def __init__(self, host, capabilities):
+		self.host = host
+		self.capabilities = capabilities
+		self.welcome = ('* OK [CAPABILITY %s] %s' % (' '.join(capabilities), host)).encode('utf-8')
+		self.state = 'AUTH'
+		self.is_readonly = False
+		self.untagged_responses = {}
+		self.folder = None
+
+	def _quote(self, arg):
+		arg = arg.replace('\\', '\\\\').replace('"', '\\"')
+		return '"' + arg + '"'
+
+	def _name(self, mailbox):
+		""" returns a mailbox name without its quotes """
+		if mailbox.startswith('"'):
+			mailbox = re.sub(r'\\(.)', r'\1', mailbox[1:-1])
+		return mailbox
+
+	def login(self, user, password):
+		return 'OK', [b'LOGIN completed']
+
+	def logout(self):
+		self.state = 'LOGOUT'
+		self.folder = None
+		return 'BYE', [b'closed']
+
+	def capability(self):
+		return 'OK', [' '.join(self.capabilities).encode('ascii')]
+
+	def response(self, code):
+		return code, self.untagged_responses.pop(code.upper(), [None])
+
+	def noop(self):
+		return 'OK', [None]
+
+	def status(self, mailbox, names):
+		folder = self._folder(mailbox)
+		if folder is None:
+			return 'NO', [b'[NONEXISTENT] Unknown mailbox']
+		messages = folder['messages'].values()
+		values = {'MESSAGES': len(messages), 'UIDNEXT': folder['uidnext'], 'UIDVALIDITY': folder['uidvalidity'],
+			'SIZE': sum(self._size(e) for e in messages),
+			'UNSEEN': sum('\\Seen' not in self._flags(e) for e in messages)}
+		items = ' '.join('%s %d' % (n, values[n]) for n in names.strip('()').upper().split() if n in values)
+		return 'OK', [('%s (%s)' % (self._quote(self._name(mailbox)), items)).encode('utf-8')]
+
+	def select(self, mailbox='INBOX', readonly=False):
+		self.untagged_responses = {}
+		self.folder = self._folder(mailbox)
+		if self.folder is None:
+			self.state = 'AUTH'
+			return 'NO', [b'[NONEXISTENT] Unknown mailbox']
+		self.is_readonly = readonly
+		self.state = 'SELECTED'
+		exists = str(len(self.folder['messages'])).encode()
+		self.untagged_responses = {
+			'EXISTS': [exists],
+			'UIDVALIDITY': [str(self.folder['uidvalidity']).encode()],
+			'UIDNEXT': [str(self.folder['uidnext']).encode()],
+			'PERMANENTFLAGS': [('(%s)' % ' '.join(self.PERMANENTFLAGS)).encode()],
+		}
+		return 'OK', [exists]
+
+	def uid(self, command, *args):
+		if self.folder is None:
+			raise self.error('UID command in state ' + self.state)
+		command = command.upper()
+		if command == 'SEARCH':
+			return self.__search(args[-1])
+		if command == 'FETCH':
+			return self.__fetch(self.__uids(args[0]), args[1])
+		if command == 'STORE':
+			return self.__store(self.__uids(args[0]), args[1], args[2])
+		if command == 'EXPUNGE':
+			return self.__expunge(self.__uids(args[0]))
+		raise self.error('UID %s not supported by %s' % (command, self.host))
+
+	def expunge(self):
+		if self.folder is None:
+			raise self.error('EXPUNGE in state ' + self.state)
+		return self.__expunge(sorted(self.folder['messages']))
+
+	def __uids(self, uidset):
+		""" returns the UIDs of the selected folder in an IMAP UID set, in order """
+		messages = self.folder['messages']
+		if isinstance(uidset, bytes):
+			uidset = uidset.decode('ascii')
+		top = max(messages) if messages else 0
+		uids = set()
+		for part in uidset.split(','):
+			a, sep, b = part.partition(':')
+			a = top if a == '*' else int(a)
+			b = a if not sep else top if b == '*' else int(b)
+			low, high = min(a, b), max(a, b)
+			if high - low < len(messages):
+				uids.update(u for u in range(low, high + 1) if u in messages)
+			else:
+				uids.update(u for u in messages if low <= u <= high)
+		return sorted(uids)
+
+	def __search(self, criteria):
+		""" Runs the SEARCH keys syncimap sends; SENTSINCE and SENTBEFORE look at the internal date """
+		tokens = criteria.strip('()').split()
+		tests = []
+		while tokens:
+			key = tokens.pop(0).upper()
+			if key == 'ALL':
+				continue
+			if key == 'UNDELETED':
+				tests.append(lambda e: '\\Deleted' not in self._flags(e))
+			elif key in ('SMALLER', 'LARGER'):
+				n = int(tokens.pop(0))
+				tests.append((lambda e, n=n: self._size(e) < n) if key == 'SMALLER' else (lambda e, n=n: self._size(e) > n))
+			elif key in ('SENTSINCE', 'SINCE', 'SENTBEFORE', 'BEFORE'):
+				day = time.mktime(time.strptime(tokens.pop(0), '%d-%b-%Y'))
+				tests.append((lambda e, d=day: self._time(e) >= d) if key.endswith('SINCE') else (lambda e, d=day: self._time(e) < d))
+			else:
+				raise self.error('SEARCH %s not supported by %s' % (key, self.host))
+		uids = [uid for (uid, e) in sorted(self.folder['messages'].items()) if all(t(e) for t in tests)]
+		return 'OK', [' '.join(str(u) for u in uids).encode('ascii')]
+
+	def __fetch(self, uids, items):
+		items = items.upper()
+		partial = re.search(r'BODY(?:\.PEEK)?\[\]<(\d+)\.(\d+)>', items)
+		fields = re.search(r'HEADER\.FIELDS \(([^)]*)\)', items)
+		if self.folder['order'] is None:
+			self.folder['order'] = dict((uid, i + 1) for (i, uid) in enumerate(sorted(self.folder['messages'])))
+		order = self.folder['order']
+		data = []
+		for uid in uids:
+			entry = self.folder['messages'][uid]
+			head = '%d (UID %d' % (order[uid], uid)
+			if 'FLAGS' in items:
+				head += ' FLAGS (%s)' % ' '.join(self._flags(entry))
+			if 'RFC822.SIZE' in items:
+				head += ' RFC822.SIZE %d' % self._size(entry)
+			if 'INTERNALDATE' in items:
+				head += ' INTERNALDATE %s' % self._internaldate(entry)
+			literal = None
+			if fields:
+				literal = self._header(entry, fields.group(1).split())
+				head += ' BODY[HEADER.FIELDS (%s)]' % fields.group(1)
+			elif partial:
+				literal = self._read(entry, int(partial.group(1)), int(partial.group(2)))
+				head += ' BODY[]<%s>' % partial.group(1)
+			elif 'BODY' in items or 'RFC822' in items.replace('RFC822.SIZE', ''):
+				literal = self._read(entry)
+				head += ' BODY[]'
+			if literal is None:
+				data.append((head + ')').encode('utf-8'))
+			else:
+				data.append(((head + ' {%d}' % len(literal)).encode('utf-8'), literal))
+				data.append(b')')
+		return 'OK', data
+
+	def __store(self, uids, command, flags):
+		if self.is_readonly:
+			return 'NO', [b'Mailbox is read-only']
+		command = command.upper()
+		flags = flags.strip('()').split()
+		for uid in uids:
+			entry = self.folder['messages'][uid]
+			current = self._flags(entry)
+			if command.startswith('+'):
+				flags_now = current + [f for f in flags if f.lower() not in set(g.lower() for g in current)]
+			elif command.startswith('-'):
+				flags_now = [f for f in current if f.lower() not in set(g.lower() for g in flags)]
+			else:
+				flags_now = flags
+			self._setflags(uid, entry, flags_now)
+		return 'OK', [b'STORE completed']
+
+	def __expunge(self, uids):
+		if self.is_readonly:
+			return 'NO', [b'Mailbox is read-only']
+		gone = [uid for uid in uids if '\\Deleted' in self._flags(self.folder['messages'][uid])]
+		if gone:
+			self._remove(gone)
+			self.folder['order'] = None
+		return 'OK', [b'EXPUNGE completed']
+
+
+class MaildirIMAP4(LocalIMAP4):
+	"""
+	imaplib.IMAP4 look-alike on top of a local Maildir++ directory, used for
+	a host given as maildir:<path>.
+
+	INBOX is the Maildir itself and every other folder a .<name> subfolder,
+	'.' being the hierarchy delimiter. Messages are read and written as
+	files: no parsing on the server side, one rename per flag change.
+
+	IMAP needs UIDs, which Maildir has not: each folder keeps them in a
+	syncimap-index file together with the size, the arrival time and the
+	Message-ID of every message, so a folder is indexed by listing its
+	directories and only reading the files which are new since the last run.
+	The index is only appended to while syncing and compacted when
+	messages are expunged.
+	"""
+
+	INDEX = 'syncimap-index'
+	# Maildir info letters of the flags IMAP knows
+	FLAGS = (('D', '\\Draft'), ('F', '\\Flagged'), ('P', '$Forwarded'), ('R', '\\Answered'), ('S', '\\Seen'), ('T', '\\Deleted'))
+	PERMANENTFLAGS = tuple(f for (l, f) in FLAGS)
+	CHUNK = 1024 * 1024
+
+	def __init__(self, path):
+		self.path = os.path.abspath(os.path.expanduser(path))
+		for sub in ('cur', 'new', 'tmp'):
+			os.makedirs(os.path.join(self.path, sub), exist_ok=True)
+		LocalIMAP4.__init__(self, 'maildir:' + self.path, ('IMAP4REV1', 'UIDPLUS', 'STATUS=SIZE'))
+		self.delivered = 0
+		self.converted = (None, None)
+
+	# -- folder index ---------------------------------------------
+
+	def __dir(self, mailbox):
+		""" returns the directory of a mailbox name, quoted or not """
+		mailbox = self._name(mailbox)
+		if mailbox.upper() == 'INBOX':
+			return self.path
+		return os.path.join(self.path, '.' + mailbox.replace('/', '.'))
+
+	def __scan(self, path):
+		"""
+		Brings the index of the folder in path up to date with its files
+		@return dict with 'path', 'uidvalidity', 'uidnext' and 'messages',
+		a dict{ uid: [basename, subdir/filename, size, mtime, message-id] }
+		"""
+		folder = {'path': path, 'uidvalidity': int(time.time()), 'uidnext': 1, 'messages': {}, 'order': None}
+		index = os.path.join(path, self.INDEX)
+		known = {}
+		rebuild = not os.path.exists(index)
+		try:
+			with open(index, 'r', encoding='utf-8', errors='surrogateescape') as f:
+				head = f.readline().split()
+				folder['uidvalidity'], folder['uidnext'] = int(head[1]), int(head[3])
+				for line in f:
+					fields = line.rstrip('\n').split('\t')
+					if len(fields) == 5:
+						known[fields[1]] = [int(fields[0]), int(fields[2]), float(fields[3]), fields[4]]
+		except (OSError, IndexError, ValueError):
+			# unreadable, every message gets a new UID under a new UIDVALIDITY
+			folder['uidvalidity'], folder['uidnext'] = int(time.time()), 1
+			known = {}
+			rebuild = True
+		files = {}
+		for sub in ('cur', 'new'):
+			with os.scandir(os.path.join(path, sub)) as entries:
+				for entry in entries:
+					if not entry.name.startswith('.'):
+						files[entry.name.split(':')[0]] = (sub + '/' + entry.name, entry)
+		new = []
+		for base, (name, entry) in files.items():
+			if base in known:
+				uid, size, mtime, mid = known.pop(base)
+				folder['messages'][uid] = [base, name, size, mtime, mid]
+			else:
+				new.append((entry.stat().st_mtime, base, name))
+		if known or rebuild:
+			# messages were removed behind our back
+			self.__compact(folder)
+		# UIDs in arrival order, as a server would have given them
+		for mtime, base, name in sorted(new):
+			size, mid = self.__inspect(os.path.join(path, name), base)
+			self.__add(folder, [base, name, size, mtime, mid])
+		return folder
+
+	def __inspect(self, filename, base):
+		""" returns (size with CRLF line ends, Message-ID) of a message file """
+		m = re.search(r',W=(\d+)', base)
+		with open(filename, 'rb') as f:
+			data = f.read(self.CHUNK)
+			mid = message_id(data)
+			if m:
+				size = int(m.group(1))
+			else:
+				size = 0
+				while data:
+					size += len(data) + data.count(b'\n') - data.count(b'\r\n')
+					data = f.read(self.CHUNK)
+		return size, mid
+
+	def __add(self, folder, entry):
+		""" Gives a message the next UID, recording it at the end of the index """
+		uid = folder['uidnext']
+		folder['uidnext'] += 1
+		folder['messages'][uid] = entry
+		folder['order'] = None
+		with open(os.path.join(folder['path'], self.INDEX), 'a', encoding='utf-8', errors='surrogateescape') as f:
+			f.write('%d\t%s\t%d\t%.3f\t%s\n' % (uid, entry[0], entry[2], entry[3], entry[4]))
+		return uid
+
+	def __compact(self, folder):
+		""" Rewrites the index of a folder from its current messages """
+		index = os.path.join(folder['path'], self.INDEX)
+		with open(index + '.tmp', 'w', encoding='utf-8', errors='surrogateescape') as f:
+			# UIDNEXT is kept: an UID is never given twice
+			f.write('V %d N %d\n' % (folder['uidvalidity'], folder['uidnext']))
+			for uid, entry in sorted(folder['messages'].items()):
+				f.write('%d\t%s\t%d\t%.3f\t%s\n' % (uid, entry[0], entry[2], entry[3], entry[4]))
+		os.replace(index + '.tmp', index)
+
+	def __info(self, flags):
+		""" returns the Maildir info letters of IMAP flags """
+		flags = set(f.lower() for f in flags)
+		return ''.join(letter for (letter, flag) in self.FLAGS if flag.lower() in flags)
+
+	# -- LocalIMAP4 storage side ----------------------------------
+
+	def _folder(self, mailbox):
+		path = self.__dir(mailbox)
+		if not os.path.isdir(os.path.join(path, 'cur')):
+			return None
+		return self.__scan(path)
+
+	def _flags(self, entry):
+		info = entry[1].split(':2,', 1)[1] if ':2,' in entry[1] else ''
+		return [flag for (letter, flag) in self.FLAGS if letter in info]
+
+	def _size(self, entry):
+		return entry[2]
+
+	def _time(self, entry):
+		return entry[3]
+
+	def _internaldate(self, entry):
+		return imaplib.Time2Internaldate(entry[3])
+
+	def _read(self, entry, offset=0, length=None):
+		""" returns the message of an index entry, or a part of it, with CRLF line ends """
+		filename = os.path.join(self.folder['path'], entry[1])
+		sizes = re.findall(r',([SW])=(\d+)', entry[0])
+		if len(sizes) == 2 and sizes[0][1] == sizes[1][1]:
+			# the file size is the size with CRLF, so the file has CRLF
+			with open(filename, 'rb') as f:
+				f.seek(offset)
+				return f.read() if length is None else f.read(length)
+		if self.converted[0] != filename:
+			# LF line ends, converted once for all the partial FETCHes
+			with open(filename, 'rb') as f:
+				self.converted = (filename, imaplib.MapCRLF.sub(imaplib.CRLF, f.read()))
+		data = self.converted[1]
+		if offset + (length or 0) >= len(data) or length is None:
+			self.converted = (None, None)
+		return data[offset:] if length is None else data[offset:offset + length]
+
+	def _header(self, entry, fields):
+		""" returns the header lines of an index entry named in fields """
+		if fields == ['MESSAGE-ID']:
+			return ('Message-ID: %s\r\n\r\n' % entry[4] if entry[4] else '\r\n').encode('utf-8', 'surrogateescape')
+		with open(os.path.join(self.folder['path'], entry[1]), 'rb') as f:
+			return header_fields(f.read(self.CHUNK), fields)
+
+	def _setflags(self, uid, entry, flags):
+		name = 'cur/%s:2,%s' % (entry[0], self.__info(flags))
+		if name != entry[1]:
+			os.rename(os.path.join(self.folder['path'], entry[1]), os.path.join(self.folder['path'], name))
+			entry[1] = name
+
+	def _remove(self, uids):
+		messages = self.folder['messages']
+		for uid in uids:
+			with contextlib.suppress(FileNotFoundError):
+				os.unlink(os.path.join(self.folder['path'], messages.pop(uid)[1]))
+		self.__compact(self.folder)
+
+	# -- commands -------------------------------------------------
+
+	def list(self, directory='""', pattern='*'):
+		names = ['INBOX']
+		for entry in sorted(os.listdir(self.path)):
+			if entry.startswith('.') and entry not in ('.', '..') and os.path.isdir(os.path.join(self.path, entry, 'cur')):
+				names.append(entry[1:])
+		return 'OK', [('(\\HasNoChildren) "." %s' % self._quote(n)).encode('utf-8') for n in names]
+
+	def create(self, mailbox):
+		path = self.__dir(mailbox)
+		if os.path.isdir(os.path.join(path, 'cur')):
+			return 'NO', [b'[ALREADYEXISTS] Mailbox exists']
+		for sub in ('cur', 'new', 'tmp'):
+			os.makedirs(os.path.join(path, sub), exist_ok=True)
+		return 'OK', [b'CREATE completed']
+
+	def append(self, mailbox, flags, date_time, message):
+		"""
+		Delivers a message, bytes or a file object, through tmp/ into cur/
+		the Maildir way, with its internal date as modification time
+		"""
+		path = self.__dir(mailbox)
+		if not os.path.isdir(os.path.join(path, 'cur')):
+			return 'NO', [b'[TRYCREATE] Unknown mailbox']
+		folder = self.folder if self.folder is not None and self.folder['path'] == path else self.__scan(path)
+		self.delivered += 1
+		base = '%d.M%dP%dQ%d.%s' % (time.time(), time.time() % 1 * 1000000, os.getpid(), self.delivered,
+			socket.gethostname().replace('/', '\\057').replace(':', '\\072'))
+		tmp = os.path.join(path, 'tmp', base)
+		with open(tmp, 'wb') as f:
+			if isinstance(message, bytes):
+				f.write(imaplib.MapCRLF.sub(imaplib.CRLF, message))
+				header = message[:self.CHUNK]
+			else:
+				# a spooled message, already as the server sent it
+				message.seek(0)
+				header = message.read(self.CHUNK)
+				message.seek(0)
+				shutil.copyfileobj(message, f, self.CHUNK)
+			size = f.tell()
+		mtime = time.time()
+		date = date_time and imaplib.Internaldate2tuple(b'INTERNALDATE ' + date_time.encode('ascii'))
+		if date:
+			mtime = time.mktime(date)
+			os.utime(tmp, (mtime, mtime))
+		base += ',S=%d,W=%d' % (size, size)
+		name = 'cur/%s:2,%s' % (base, self.__info((flags or '').strip('()').split()))
+		os.rename(tmp, os.path.join(path, name))
+		uid = self.__add(folder, [base, name, size, mtime, message_id(header)])
+		return 'OK', [('[APPENDUID %d %d] APPEND completed' % (folder['uidvalidity'], uid)).encode('ascii')]
+
+
+class ArchiveIMAP4(LocalIMAP4):
+	"""
+	imaplib.IMAP4 look-alike on top of a packed archive directory, used for
+	a host given as archive:<path>: as host2 it takes snapshots of an
+	account, as host1 it restores one.
+
+	Messages are compressed one by one (zlib or lzma) and appended to
+	segment-NNNNNN files which are never rewritten. The archive.db sqlite
+	index records the folder, UID, Message-ID, flags, internal date and the
+	segment, offset and compressed length of every message, so reading one
+	is an index lookup and a seek, and a message is streamed out of its
+	segment without decompressing it as a whole.
+
+	The connections of a run share one lock around the segment writes and
+	one snapshot, so its workers can write to the archive side by side.
+
+	Every run which changes the archive is a snapshot. Index rows are
+	versioned by the snapshots they were added and removed in instead of
+	being updated, so an expunge or a flag change keeps the earlier state
+	and any snapshot can be restored later: a sync into the archive only
+	writes the new messages.
+	"""
+
+	INDEX = 'archive.db'
+	CHUNK = 1024 * 1024
+	CODECS = {
+		'zlib': (lambda: zlib.compressobj(6), zlib.decompressobj),
+		'lzma': (lzma.LZMACompressor, lzma.LZMADecompressor),
+	}
+
+	def __init__(self, path, codec='zlib', snapshot=None, shared=None):
+		"""
+		@param codec: compression of the messages written, a key of CODECS
+		@param snapshot: the snapshot to read, read-only; None for the
+		latest state, to which a run adds a new snapshot
+		@param shared: the dict{ 'lock', 'snapshot' } of the connections
+		of a run to this archive, from shared_state()
+		"""
+		self.path = os.path.abspath(os.path.expanduser(path))
+		if codec not in self.CODECS:
+			raise ValueError('Unknown archive codec: ' + codec)
+		os.makedirs(self.path, exist_ok=True)
+		LocalIMAP4.__init__(self, 'archive:' + self.path, ('IMAP4REV1', 'UIDPLUS', 'STATUS=SIZE'))
+		self.codec = codec
+		self.db = sqlite3.connect(os.path.join(self.path, self.INDEX))
+		self.db.executescript('''
+			PRAGMA journal_mode=WAL;
+			PRAGMA synchronous=NORMAL;
+			CREATE TABLE IF NOT EXISTS snapshots (
+				id INTEGER PRIMARY KEY, time REAL);
+			CREATE TABLE IF NOT EXISTS folders (
+				name TEXT PRIMARY KEY, uidvalidity INTEGER, uidnext INTEGER, added INTEGER);
+			CREATE TABLE IF NOT EXISTS messages (
+				id INTEGER PRIMARY KEY,
+				folder TEXT, uid INTEGER, mid TEXT, flags TEXT, date TEXT, size INTEGER,
+				segment INTEGER, offset INTEGER, length INTEGER, codec TEXT,
+				added INTEGER, removed INTEGER);
+			CREATE INDEX IF NOT EXISTS messages_folder ON messages (folder, uid);
+			CREATE INDEX IF NOT EXISTS messages_mid ON messages (mid);
+		''')
+		with self.db:
+			# INBOX exists in every snapshot
+			self.db.execute('INSERT OR IGNORE INTO folders VALUES (?,?,?,0)', ('INBOX', int(time.time()), 1))
+		self.latest = self.db.execute('SELECT max(id) FROM snapshots').fetchone()[0] or 0
+		if snapshot is not None and not 0 < snapshot <= self.latest:
+			raise ValueError('No snapshot %d in %s, the latest is %d' % (snapshot, self.path, self.latest))
+		self.view = snapshot
+		self.shared = shared if shared is not None else self.shared_state()
+		self.snapshot = None
+		self.segments = {}
+		self.writer = None
+		self.reading = None
+
+	@staticmethod
+	def shared_state():
+		""" returns the state shared by the connections of a run to one archive """
+		return {'lock': threading.Lock(), 'snapshot': None}
+
+	# -- index ----------------------------------------------------
+
+	def __visible(self):
+		""" returns the WHERE clause and parameters of the rows in the snapshot read """
+		if self.view is None:
+			return 'removed IS NULL', ()
+		return 'added <= ? AND (removed IS NULL OR removed > ?)', (self.view, self.view)
+
+	def __begin(self):
+		""" Starts the snapshot of this run on its first change """
+		if self.view is not None:
+			raise self.readonly('snapshot %d of %s is read-only' % (self.view, self.path))
+		if self.snapshot is None:
+			with self.shared['lock']:
+				if self.shared['snapshot'] is None:
+					with self.db:
+						self.shared['snapshot'] = self.db.execute('INSERT INTO snapshots (time) VALUES (?)',
+							(time.time(),)).lastrowid
+				self.snapshot = self.shared['snapshot']
+		return self.snapshot
+
+	def __load(self, mailbox):
+		"""
+		@return the folder dict of a mailbox, its 'messages' a dict{ uid:
+		[row id, message-id, flags, internal date, size, segment, offset,
+		length, codec, snapshot added] }, None when it does not exist
+		"""
+		name = self._name(mailbox)
+		if name.upper() == 'INBOX':
+			name = 'INBOX'
+		row = self.db.execute('SELECT uidvalidity, uidnext, added FROM folders WHERE name=?', (name,)).fetchone()
+		if row is None or (self.view is not None and row[2] > self.view):
+			return None
+		where, params = self.__visible()
+		messages = {}
+		for values in self.db.execute('SELECT uid, id, mid, flags, date, size, segment, offset, length, codec, added '
+				'FROM messages WHERE folder=? AND ' + where, (name,) + params):
+			messages[values[0]] = list(values[1:])
+		return {'name': name, 'uidvalidity': row[0], 'uidnext': row[1], 'messages': messages, 'order': None}
+
+	# -- segments -------------------------------------------------
+
+	def __segment(self, number):
+		""" returns the segment file of a number, opened for reading """
+		if number not in self.segments:
+			self.segments[number] = open(os.path.join(self.path, 'segment-%06d' % number), 'rb')
+		return self.segments[number]
+
+	def __output(self):
+		"""
+		returns (number, file) of the segment to append to, starting a new
+		one past ARCHIVE_SEGMENT bytes; called under the shared lock
+		"""
+		if self.writer is not None and os.fstat(self.writer[1].fileno()).st_size >= ARCHIVE_SEGMENT:
+			self.writer[1].close()
+			self.writer = (self.writer[0] + 1, None)
+		if self.writer is None:
+			numbers = [int(n[8:]) for n in os.listdir(self.path) if re.match(r'segment-\d+$', n)]
+			number = max(numbers or [1])
+			if os.path.exists(os.path.join(self.path, 'segment-%06d' % number)) and \
+					os.path.getsize(os.path.join(self.path, 'segment-%06d' % number)) >= ARCHIVE_SEGMENT:
+				number += 1
+			self.writer = (number, None)
+		if self.writer[1] is None:
+			self.writer = (self.writer[0], open(os.path.join(self.path, 'segment-%06d' % self.writer[0]), 'ab'))
+		return self.writer
+
+	def __chunks(self, entry):
+		""" yields the message of an index entry decompressed piece by piece """
+		f = self.__segment(entry[5])
+		position, left = entry[6], entry[7]
+		decompressor = self.CODECS[entry[8]][1]()
+		while left > 0:
+			f.seek(position)
+			data = f.read(min(self.CHUNK, left))
+			if not data:
+				raise RuntimeError('Truncated archive segment %d' % entry[5])
+			position += len(data)
+			left -= len(data)
+			data = decompressor.decompress(data)
+			if data:
+				yield data
+		if hasattr(decompressor, 'flush'):
+			data = decompressor.flush()
+			if data:
+				yield data
+
+	# -- LocalIMAP4 storage side ----------------------------------
+
+	def _folder(self, mailbox):
+		return self.__load(mailbox)
+
+	def _flags(self, entry):
+		return entry[2].split()
+
+	def _size(self, entry):
+		return entry[4]
+
+	def _time(self, entry):
+		return time.mktime(imaplib.Internaldate2tuple(b'INTERNALDATE ' + entry[3].encode('ascii')))
+
+	def _internaldate(self, entry):
+		return entry[3]
+
+	def _read(self, entry, offset=0, length=None):
+		"""
+		returns the message of an index entry, or a part of it; consecutive
+		partial FETCHes of a message go on with the same decompressor
+		"""
+		if length is None:
+			return b''.join(self.__chunks(entry))[offset:]
+		if self.reading is None or self.reading[0] != entry[0] or offset < self.reading[2]:
+			# [row id, decompressed pieces, offset of the buffer, buffer]
+			self.reading = [entry[0], self.__chunks(entry), 0, b'']
+		reading = self.reading
+		pieces = [reading[3]]
+		available = reading[2] + len(reading[3])
+		while available < offset + length:
+			piece = next(reading[1], None)
+			if piece is None:
+				break
+			pieces.append(piece)
+			available += len(piece)
+		buffer = b''.join(pieces)
+		start = offset - reading[2]
+		data = buffer[start:start + length]
+		reading[2], reading[3] = offset + len(data), buffer[start + len(data):]
+		if len(data) < length:
+			self.reading = None
+		return data
+
+	def _header(self, entry, fields):
+		""" returns the header lines of an index entry named in fields """
+		if fields == ['MESSAGE-ID']:
+			return ('Message-ID: %s\r\n\r\n' % entry[1] if entry[1] else '\r\n').encode('utf-8', 'surrogateescape')
+		data = b''
+		for piece in self.__chunks(entry):
+			data += piece
+			if b'\r\n\r\n' in data:
+				break
+		return header_fields(data, fields)
+
+	def _setflags(self, uid, entry, flags):
+		flags = ' '.join(flags)
+		if flags == entry[2]:
+			return
+		snapshot = self.__begin()
+		with self.db:
+			if entry[9] == snapshot:
+				self.db.execute('UPDATE messages SET flags=? WHERE id=?', (flags, entry[0]))
+			else:
+				# the earlier snapshots keep the former flags
+				self.db.execute('UPDATE messages SET removed=? WHERE id=?', (snapshot, entry[0]))
+				entry[0] = self.db.execute('INSERT INTO messages (folder, uid, mid, flags, date, size, segment, offset, length, codec, added) '
+					'SELECT folder, uid, mid, ?, date, size, segment, offset, length, codec, ? FROM messages WHERE id=?',
+					(flags, snapshot, entry[0])).lastrowid
+				entry[9] = snapshot
+		entry[2] = flags
+
+	def _remove(self, uids):
+		snapshot = self.__begin()
+		with self.db:
+			for uid in uids:
+				entry = self.folder['messages'].pop(uid)
+				if entry[9] == snapshot:
+					self.db.execute('DELETE FROM messages WHERE id=?', (entry[0],))
+				else:
+					self.db.execute('UPDATE messages SET removed=? WHERE id=?', (snapshot, entry[0]))
+
+	# -- commands -------------------------------------------------
+
+	def logout(self):
+		for f in self.segments.values():
+			f.close()
+		self.segments = {}
+		if self.writer is not None:
+			self.writer[1].close()
+			self.writer = None
+		self.db.close()
+		return LocalIMAP4.logout(self)
+
+	def list(self, directory='""', pattern='*'):
+		names = [name for (name, added) in self.db.execute('SELECT name, added FROM folders ORDER BY name')
+			if self.view is None or added <= self.view]
+		return 'OK', [('(\\HasNoChildren) "/" %s' % self._quote(n)).encode('utf-8') for n in names]
+
+	def create(self, mailbox):
+		name = self._name(mailbox)
+		if self.db.execute('SELECT 1 FROM folders WHERE name=?', (name,)).fetchone() is not None:
+			return 'NO', [b'[ALREADYEXISTS] Mailbox exists']
+		snapshot = self.__begin()
+		with self.db:
+			self.db.execute('INSERT INTO folders VALUES (?,?,?,?)', (name, int(time.time()), 1, snapshot))
+		return 'OK', [b'CREATE completed']
+
+	def append(self, mailbox, flags, date_time, message):
+		"""
+		Compresses a message, bytes or a file object, to the end of the
+		current segment and indexes it
+		"""
+		folder = self.folder
+		if folder is None or folder['name'] != self._name(mailbox):
+			folder = self.__load(mailbox)
+		if folder is None:
+			return 'NO', [b'[TRYCREATE] Unknown mailbox']
+		if self.view is not None:
+			return 'NO', [b'Snapshot is read-only']
+		snapshot = self.__begin()
+		compressor = self.CODECS[self.codec][0]()
+		# compressed aside, the other connections only wait for the copy
+		compressed = tempfile.SpooledTemporaryFile(self.CHUNK)
+		if isinstance(message, bytes):
+			message = imaplib.MapCRLF.sub(imaplib.CRLF, message)
+			header = message[:self.CHUNK]
+			size = len(message)
+			compressed.write(compressor.compress(message))
+		else:
+			# a spooled message, already as the server sent it
+			message.seek(0)
+			header = b''
+			size = 0
+			for data in iter(lambda: message.read(self.CHUNK), b''):
+				header = header or data
+				size += len(data)
+				compressed.write(compressor.compress(data))
+		compressed.write(compressor.flush())
+		compressed.seek(0)
+		with self.shared['lock']:
+			number, f = self.__output()
+			# the end of the segment, whichever connection wrote last
+			offset = os.fstat(f.fileno()).st_size
+			shutil.copyfileobj(compressed, f, self.CHUNK)
+			f.flush()
+			length = os.fstat(f.fileno()).st_size - offset
+		compressed.close()
+		date = date_time or imaplib.Time2Internaldate(time.time())
+		uid = folder['uidnext']
+		folder['uidnext'] += 1
+		flags = ' '.join((flags or '').strip('()').split())
+		mid = message_id(header)
+		with self.db:
+			self.db.execute('UPDATE folders SET uidnext=? WHERE name=?', (folder['uidnext'], folder['name']))
+			rowid = self.db.execute('INSERT INTO messages (folder, uid, mid, flags, date, size, segment, offset, length, codec, added) '
+				'VALUES (?,?,?,?,?,?,?,?,?,?,?)',
+				(folder['name'], uid, mid, flags, date, size, number, offset, length, self.codec, snapshot)).lastrowid
+		folder['messages'][uid] = [rowid, mid, flags, date, size, number, offset, length, self.codec, snapshot]
+		folder['order'] = None
+		return 'OK', [('[APPENDUID %d %d] APPEND completed' % (folder['uidvalidity'], uid)).encode('ascii')]
+
+	def find(self, mid):
+		"""
+		Looks a message up by Message-ID in the snapshot read
+		@return list of (folder, uid, flags, internal date, message)
+		"""
+		where, params = self.__visible()
+		found = []
+		for row in self.db.execute('SELECT folder, uid, id, mid, flags, date, size, segment, offset, length, codec, added '
+				'FROM messages WHERE mid=? AND ' + where, (mid,) + params).fetchall():
+			entry = list(row[2:])
+			found.append((row[0], row[1], entry[2], entry[3], self._read(entry)))
+		return found
+
+
+class Deflate:
+	"""
+	The raw DEFLATE streams of RFC 4978 for one connection, counting the
+	bytes on the wire against the logical bytes in each direction
+	"""
+
+	def __init__(self):
+		self.compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+		self.decompressor = zlib.decompressobj(-15)
+		self.wire_in = self.wire_out = 0
+		self.bytes_in = self.bytes_out = 0
+
+	def compress(self, data):
+		""" @return data compressed and flushed, ready to be sent """
+		out = self.compressor.compress(data) + self.compressor.flush(zlib.Z_SYNC_FLUSH)
+		self.bytes_out += len(data)
+		self.wire_out += len(out)
+		return out
+
+	def decompress(self, data):
+		out = self.decompressor.decompress(data)
+		self.wire_in += len(data)
+		self.bytes_in += len(out)
+		return out
+
+
+class DeflateSocket:
+	"""
+	Socket wrapper installed as an imaplib connection's sock once COMPRESS
+	DEFLATE succeeded; everything but the data goes to the wrapped socket.
+	"""
+
+	def __init__(self, sock, deflate):
+		self.sock = sock
+		self.deflate = deflate
+		self.pending = b''
+
+	def __getattr__(self, name):
+		return getattr(self.sock, name)
+
+	def recv_into(self, b):
+		while not self.pending:
+			data = self.sock.recv(STREAM_CHUNK)
+			if not data:
+				return 0
+			self.pending = self.deflate.decompress(data)
+		n = min(len(b), len(self.pending))
+		b[:n] = self.pending[:n]
+		self.pending = self.pending[n:]
+		return n
+
+	def sendall(self, data):
+		self.sock.sendall(self.deflate.compress(data))
+
+	def makefile(self, mode='rb'):
+		""" @return a buffered reader of the decompressed stream, for conn.file """
+		return io.BufferedReader(DeflateReader(self), STREAM_CHUNK)
+
+
+class DeflateReader(io.RawIOBase):
+
+	def __init__(self, sock):
+		self.sock = sock
+
+	def readable(self):
+		return True
+
+	def readinto(self, b):
+		return self.sock.recv_into(b)
+
+
+class DeflateWriter:
+	""" asyncio.StreamWriter stand-in compressing what PipelinedIMAP4 writes """
+
+	def __init__(self, writer, deflate):
+		self.writer = writer
+		self.deflate = deflate
+
+	def write(self, data):
+		self.writer.write(self.deflate.compress(data))
+
+	async def drain(self):
+		await self.writer.drain()
+
+	def close(self):
+		self.writer.close()
+
+
+class LiteralStream:
+	"""
+	Feeds a file into an imaplib command literal in STREAM_CHUNK blocks.
+
+	imaplib calls a bound method given as conn.literal (the way AUTHENTICATE
+	works) once the continuation request arrives, sends what it returns and
+	then CRLF; everything before the last block is sent from here.
+	"""
+
+	def __init__(self, conn, fileobj):
+		self.conn = conn
+		self.fileobj = fileobj
+
+	def send(self, continuation):
+		self.fileobj.seek(0)
+		last = b''
+		while True:
+			chunk = self.fileobj.read(STREAM_CHUNK)
+			if not chunk:
+				return last
+			if last:
+				self.conn.send(last)
+			last = chunk
+
+
+class AppendQueue:
+	"""
+	Collects the APPENDs to one mailbox and sends them in as few round trips
+	as the server allows: with MULTIAPPEND several messages go into one
+	command up to budget bytes, with LITERAL+ (or LITERAL- for messages up
+	to 4096 bytes) literals are sent without waiting for a continuation.
+	Otherwise every message is a plain append().
+
+	Messages are added with a key; done lists the (key, destination UID)
+	pairs of the messages the server confirmed, the UID taken from APPENDUID
+	(None without UIDPLUS), confirmed counts them.
+	"""
+
+	def __init__(self, conn, mailbox, budget):
+		self.conn = conn
+		self.mailbox = mailbox
+		self.budget = int(budget)
+		self.multiappend = 'MULTIAPPEND' in conn.capabilities
+		self.literalplus = 'LITERAL+' in conn.capabilities
+		self.literalminus = 'LITERAL-' in conn.capabilities
+		self.pipelined = isinstance(conn, PipelinedIMAP4)
+		self.local = isinstance(conn, LocalIMAP4)
+		self.batch = []
+		self.size = 0
+		self.futures = []
+		self.done = []
+		self.confirmed = 0
+
+	def add(self, flags, date, message, key=None):
+		"""
+		@param flags: '(...)' flag list or None
+		@param date: quoted internal date or None
+		@param message: bytes, or a spooled file which is streamed right away
+		@param key: reported in done once the message is stored
+		"""
+		if self.local:
+			# files are written right away, spooled ones included
+			self.__check(self.conn.append(self.mailbox, flags, date, message), [key])
+			return
+		if not isinstance(message, bytes):
+			self.flush()
+			self.__stream(flags, date, message, key)
+			return
+		message = imaplib.MapCRLF.sub(imaplib.CRLF, message)
+		if not (self.literalplus or (self.literalminus and len(message) <= 4096)):
+			self.flush()
+			self.__check(self.conn.append(self.mailbox, flags, date, message), [key])
+			return
+		if self.batch and (not self.multiappend or self.size + len(message) > self.budget):
+			self.flush()
+		self.batch.append((flags, date, message, key))
+		self.size += len(message)
+		self.__collect(False)
+
+	def flush(self):
+		""" Sends the pending batch as one APPEND command """
+		if not self.batch:
+			return
+		parts = []
+		keys = [key for (flags, date, message, key) in self.batch]
+		for flags, date, message, key in self.batch:
+			part = b''
+			if flags:
+				part += flags.encode('utf-8') + b' '
+			if date:
+				part += date.encode('utf-8') + b' '
+			parts.append(part + b'{%d+}\r\n' % len(message) + message)
+		self.batch = []
+		self.size = 0
+		if self.pipelined:
+			self.futures.append((self.conn.submit('APPEND', self.mailbox, b' '.join(parts)), keys))
+		else:
+			self.__check(self.conn._simple_command('APPEND', self.mailbox, b' '.join(parts)), keys)
+
+	def __stream(self, flags, date, fileobj, key):
+		if self.pipelined:
+			self.__check(self.conn.append_async(self.mailbox, flags, date, fileobj).result(), [key])
+			return
+		self.conn.literal = LiteralStream(self.conn, fileobj).send
+		self.__check(self.conn._simple_command('APPEND', self.mailbox, flags, date,
+			'{%d}' % literal_size(fileobj)), [key])
+
+	def __collect(self, wait):
+		""" Checks the pipelined APPENDs completed so far, in order """
+		while self.futures and (wait or self.futures[0][0].done()):
+			(future, keys) = self.futures.pop(0)
+			self.__check(future.result(), keys)
+
+	def close(self):
+		""" Flushes and waits for every APPEND sent so far """
+		self.flush()
+		self.__collect(True)
+
+	def __check(self, response, keys):
+		(res, data) = response
+		if res != 'OK':
+			raise RuntimeError('Unvalid reply: ' + res)
+		uids = [None] * len(keys)
+		m = APPENDUID_RE.search(data[-1] or b'')
+		if m:
+			assigned = parse_uid_set(m.group(2).decode('ascii'))
+			if len(assigned) == len(keys):
+				uids = assigned
+		self.done.extend(zip(keys, uids))
+		self.confirmed += len(keys)
+
+
+class Journal:
+	"""
+	Checkpoints of a folder copy kept in the state cache so that a sync
+	interrupted by a crash or a dropped connection resumes where it stopped.
+
+	The source UIDs the destination confirmed are journaled under the source
+	UIDVALIDITY and the destination account, each fan-out destination has
+	its own; the destination UIDs learned from APPENDUID go to the
+	destination index so that it does not have to be fetched again.
+	Without a state cache every method does nothing.
+	"""
+
+	def __init__(self, cache, config, srcfolder, srcvalidity, dstfolder, dstvalidity):
+		self.cache = cache
+		self.dst = ('%s:%s' % (config['host2'], config['port2']), config['user2'], dstfolder)
+		self.src = ('%s:%s' % (config['host1'], config['port1']), config['user1'], srcfolder, destination_key(config))
+		self.srcvalidity = srcvalidity
+		self.dstvalidity = dstvalidity
+
+	def enabled(self):
+		return self.cache is not None and self.srcvalidity is not None
+
+	def load(self):
+		""" @return the source UIDs already copied """
+		if not self.enabled():
+			return set()
+		return self.cache.journal(*(self.src + (self.srcvalidity,)))
+
+	def record(self, done):
+		"""
+		Writes and empties done, a list of (source index entry, destination UID)
+		"""
+		if not done or not self.enabled():
+			del done[:]
+			return
+		self.cache.add_journal(*(self.src + (self.srcvalidity, [m['uid'] for (m, uid) in done])))
+		if self.dstvalidity is not None:
+			index = [dict(m, uid=uid) for (m, uid) in done if uid is not None]
+			if index:
+				self.cache.add_messages(*(self.dst + (self.dstvalidity, index)))
+		del done[:]
+
+	def clear(self):
+		if self.cache is not None:
+			self.cache.clear_journal(*self.src)
+
+
+class Destination:
+	"""
+	One account a source is synced into. A fan-out sync has one per --host2
+	given, each with a connection of its own: one failing leaves the others
+	going on.
+	"""
+
+	def __init__(self, label, config):
+		"""
+		@param label: '2' for the first destination, '2.2', '2.3' ... for the others
+		@param config: the config with the host2 options of this destination
+		"""
+		self.label = label
+		self.config = config
+		self.conn = None
+		self.type = None
+		self.status = {}
+		# set once the destination is left out of the sync
+		self.down = False
+
+	def copy(self):
+		""" returns a Destination to the same account, not connected, for a worker """
+		other = Destination(self.label, self.config)
+		other.type = self.type
+		other.status = self.status
+		return other
+
+	def logout(self):
+		if self.conn is not None:
+			with contextlib.suppress(Exception):
+				self.conn.logout()
+			self.conn = None
+
+
+class Rewriter:
+	"""
+	The --regexmess substitutions, in order, and the --skipheader header
+	stripping, applied to messages between their FETCH and their APPEND.
+
+	Messages up to INLINE bytes are rewritten right away, the larger ones in
+	a pool of processes while the next messages are fetched, up to window
+	of them in flight. A message nothing matches is passed on as the very
+	object it came in: re.sub() returns its argument when it substituted
+	nothing and a pool worker answers None instead of sending it back.
+	"""
+
+	INLINE = 65536
+	# a header field, with its continuation lines
+	FIELD_RE = re.compile(rb'^([!-9;-~]+):[^\n]*\n(?:[ \t][^\n]*\n)*', re.M)
+
+	def __init__(self, regexmess, skipheader=None, processes=None):
+		"""
+		@param regexmess: list of s/regex/replacement/ expressions
+		@param skipheader: regex of the names of the header fields to strip
+		@param processes: size of the pool, 0 rewrites every message inline
+		"""
+		self.regexmess = list(regexmess)
+		self.skipheader = skipheader
+		self.rules = [parse_substitution(expr, True) for expr in self.regexmess]
+		self.skip = re.compile(skipheader.encode('utf-8'), re.I) if skipheader else None
+		self.processes = (os.cpu_count() or 1) if processes is None else int(processes)
+		self.window = 2 * self.processes
+		self.lock = threading.Lock()
+		self.pool = None
+
+	def rewrite(self, message):
+		""" returns the rewritten message, message itself when nothing changed """
+		if self.skip is not None:
+			end = message.find(b'\r\n\r\n')
+			end = end + 2 if end >= 0 else message.find(b'\n\n') + 1
+			header = message[:end] if end > 0 else message
+			stripped = self.FIELD_RE.sub(lambda m: b'' if self.skip.fullmatch(m.group(1)) else m.group(0), header)
+			if stripped != header:
+				message = stripped + message[len(header):]
+		for regex, replacement, count in self.rules:
+			message = regex.sub(replacement, message, count)
+		return message
+
+	def __pool(self):
+		with self.lock:
+			if self.pool is None:
+				methods = multiprocessing.get_all_start_methods()
+				# forking a process running the connection threads is not safe
+				context = multiprocessing.get_context('forkserver' if 'forkserver' in methods else 'spawn')
+				self.pool = concurrent.futures.ProcessPoolExecutor(self.processes, context,
+					initializer=rewriter_init, initargs=(self.regexmess, self.skipheader))
+			return self.pool
+
+	def pipeline(self, messages):
+		"""
+		Yields the (index entry, message) pairs of messages rewritten, in
+		the same order
+		"""
+		pending = collections.deque()
+		for m, message in messages:
+			if not isinstance(message, bytes):
+				# the spool is closed when the next message is asked for
+				while pending:
+					yield self.__result(*pending.popleft())
+				spool = self.__rewriteSpool(message)
+				try:
+					yield m, spool
+				finally:
+					if spool is not message:
+						spool.close()
+				continue
+			if len(message) <= self.INLINE or self.processes == 0:
+				pending.append((m, self.rewrite(message), None))
+			else:
+				pending.append((m, message, self.__pool().submit(rewrite_message, message)))
+			while len(pending) > self.window or (pending and pending[0][2] is None):
+				yield self.__result(*pending.popleft())
+		while pending:
+			yield self.__result(*pending.popleft())
+
+	def __result(self, m, message, future):
+		if future is None:
+			return m, message
+		rewritten = future.result()
+		return m, message if rewritten is None else rewritten
+
+	def __rewriteSpool(self, spool):
+		""" returns a spooled message rewritten into a new spool, spool itself when nothing changed """
+		spool.flush()
+		output = tempfile.NamedTemporaryFile()
+		try:
+			if self.processes == 0:
+				changed = rewrite_file(spool.name, output.name, self)
+			else:
+				changed = self.__pool().submit(rewrite_file, spool.name, output.name).result()
+		except BaseException:
+			output.close()
+			raise
+		if not changed:
+			output.close()
+			return spool
+		return output
+
+	def close(self):
+		with self.lock:
+			if self.pool is not None:
+				self.pool.shutdown()
+				self.pool = None
+
+
+# the Rewriter of a pool process
+process_rewriter = None
+
+
+def rewriter_init(regexmess, skipheader):
+	global process_rewriter
+	process_rewriter = Rewriter(regexmess, skipheader, 0)
+
+
+def rewrite_message(message, rewriter=None):
+	""" pool side of Rewriter: returns the rewritten message, None when unchanged """
+	rewritten = (rewriter or process_rewriter).rewrite(message)
+	return None if rewritten is message else rewritten
+
+
+def rewrite_file(source, target, rewriter=None):
+	"""
+	pool side of Rewriter for spooled messages: the --regexmess
+	substitutions may span the whole message, which is then read in
+	memory, --skipheader alone only reads the header block and copies the
+	body through.
+	@return whether target got a rewritten message
+	"""
+	rewriter = rewriter or process_rewriter
+	with open(source, 'rb') as f:
+		if rewriter.rules:
+			message = f.read()
+		else:
+			message = b''
+			for line in iter(f.readline, b''):
+				message += line
+				if line in (b'\r\n', b'\n'):
+					break
+		rewritten = rewrite_message(message, rewriter)
+		if rewritten is None:
+			return False
+		with open(target, 'wb') as output:
+			output.write(rewritten)
+			shutil.copyfileobj(f, output)
+	return True
+
+
+class TokenBucket:
+	"""
+	Thread safe token bucket of rate tokens per second, holding up to burst.
+
+	reserve() takes the tokens right away and returns how long the caller
+	must wait for them, so a request larger than burst is paid afterwards
+	and concurrent callers line up behind each other.
+	"""
+
+	def __init__(self, rate, burst=None):
+		self.rate = float(rate)
+		self.burst = float(burst or rate)
+		self.tokens = self.burst
+		self.stamp = time.monotonic()
+		self.lock = threading.Lock()
+
+	def reserve(self, n):
+		""" @return seconds to wait before using n tokens """
+		with self.lock:
+			now = time.monotonic()
+			self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+			self.stamp = now
+			self.tokens -= n
+			return max(0.0, -self.tokens / self.rate)
+
+
+class Throttle:
+	"""
+	Rate limits and throttling backoff of one host, shared by all the
+	connections to it.
+
+	Commands and bytes (sent and received, before compression) go through
+	token buckets when --commandrate/--bandwidth are set. A command the
+	server refuses with NO [THROTTLED] or [UNAVAILABLE] is sent again after
+	the delay the server suggests, or 1, 2, 4... up to 60 seconds.
+	A BYE drops the connection, which the folder retry reconnects.
+	"""
+
+	def __init__(self, typ, bandwidth=None, commandrate=None):
+		self.typ = typ
+		bandwidth = float(bandwidth or 0)
+		commandrate = float(commandrate or 0)
+		self.bytes = TokenBucket(bandwidth) if bandwidth > 0 else None
+		self.commands = TokenBucket(commandrate, max(1.0, commandrate)) if commandrate > 0 else None
+		self.lock = threading.Lock()
+		self.throttled = 0
+		self.waited = 0.0
+
+	def delay(self, commands, size):
+		""" @return seconds to wait before sending commands or moving size bytes """
+		delay = 0.0
+		if commands and self.commands is not None:
+			delay = self.commands.reserve(commands)
+		if size and self.bytes is not None:
+			delay = max(delay, self.bytes.reserve(size))
+		return delay
+
+	def pace(self, commands, size):
+		delay = self.delay(commands, size)
+		if delay:
+			time.sleep(delay)
+
+	def backoff(self, typ, data, attempt):
+		"""
+		@return seconds to wait before sending again a command answered with
+		typ and data, None when it was not throttled or is out of retries
+		"""
+		if typ != 'NO' or attempt >= THROTTLE_RETRIES:
+			return None
+		text = b' '.join(d for d in data if isinstance(d, bytes))
+		if not THROTTLE_RE.search(text):
+			return None
+		m = BACKOFF_RE.search(text)
+		delay = int(m.group(1)) / 1000.0 if m else min(60, 2 ** attempt)
+		with self.lock:
+			self.throttled += 1
+			self.waited += delay
+		print ("Host%s throttled (%s), retrying in %.1f s" % (self.typ, text.decode('utf-8', 'replace'), delay))
+		return delay
+
+	def attach(self, conn):
+		"""
+		Makes conn honour the limits: PipelinedIMAP4 does it itself, local
+		storage has none, an imaplib connection gets pacing wrappers of
+		send/read/readline and a retrying one of _simple_command.
+		"""
+		if isinstance(conn, (PipelinedIMAP4, LocalIMAP4)):
+			conn.throttle = self
+			return
+		send, read, readline, simple = conn.send, conn.read, conn.readline, conn._simple_command
+
+		def paced_send(data):
+			self.pace(0, len(data))
+			return send(data)
+
+		def paced_read(size):
+			data = read(size)
+			self.pace(0, len(data))
+			return data
+
+		def paced_readline():
+			line = readline()
+			self.pace(0, len(line))
+			return line
+
+		def retried_command(name, *args):
+			# APPEND sets its message in conn.literal, which sending consumes
+			literal = conn.literal
+			attempt = 0
+			while True:
+				self.pace(1, 0)
+				(typ, data) = simple(name, *args)
+				delay = self.backoff(typ, data, attempt)
+				if delay is None:
+					return typ, data
+				attempt += 1
+				time.sleep(delay)
+				conn.literal = literal
+
+		if self.bytes is not None:
+			conn.send = paced_send
+			conn.read = paced_read
+			conn.readline = paced_readline
+		conn._simple_command = retried_command
+
+
+class Metrics:
+	"""
+	Run metrics: count, bytes in/out and latency histogram per IMAP command
+	type, time spent in each sync phase and the message counters. Phases are
+	summed over all threads. Snapshots are appended as JSON lines and/or
+	written as a Prometheus textfile, periodically and at the end.
+	"""
+
+	# latency histogram upper bounds in seconds, as Prometheus' defaults
+	BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.start = time.time()
+		self.commands = {}
+		self.phases = collections.OrderedDict()
+		self.counters = collections.OrderedDict()
+		self.stopped = threading.Event()
+		self.thread = None
+
+	def command(self, name, seconds, bytes_in, bytes_out, ok=True):
+		""" Records one completed command """
+		with self.lock:
+			c = self.commands.get(name)
+			if c is None:
+				c = self.commands[name] = {'count': 0, 'errors': 0, 'bytes_in': 0, 'bytes_out': 0,
+					'seconds': 0.0, 'buckets': [0] * len(self.BUCKETS)}
+			c['count'] += 1
+			c['errors'] += not ok
+			c['bytes_in'] += bytes_in
+			c['bytes_out'] += bytes_out
+			c['seconds'] += seconds
+			for i, bound in enumerate(self.BUCKETS):
+				if seconds <= bound:
+					c['buckets'][i] += 1
+
+	@contextlib.contextmanager
+	def phase(self, name):
+		""" Adds the time spent in the with block to phase name """
+		t0 = time.time()
+		try:
+			yield
+		finally:
+			with self.lock:
+				self.phases[name] = self.phases.get(name, 0.0) + time.time() - t0
+
+	def count(self, name, n=1):
+		with self.lock:
+			self.counters[name] = self.counters.get(name, 0) + n
+
+	def instrument(self, conn):
+		"""
+		Makes conn report its commands: PipelinedIMAP4 does it itself, local
+		storage has no commands to report, an imaplib connection gets
+		counting wrappers of send/read/readline and of _simple_command,
+		which every command goes through.
+		"""
+		if isinstance(conn, (PipelinedIMAP4, LocalIMAP4)):
+			conn.metrics = self
+			return
+		counts = [0, 0]
+		send, read, readline, simple = conn.send, conn.read, conn.readline, conn._simple_command
+
+		def counted_send(data):
+			counts[1] += len(data)
+			return send(data)
+
+		def counted_read(size):
+			data = read(size)
+			counts[0] += len(data)
+			return data
+
+		def counted_readline():
+			line = readline()
+			counts[0] += len(line)
+			return line
+
+		def timed_command(name, *args):
+			label = name
+			if name == 'UID':
+				label = 'UID ' + args[0].upper()
+			t0, before = time.time(), list(counts)
+			ok = False
+			try:
+				(typ, data) = simple(name, *args)
+				ok = typ == 'OK'
+				return typ, data
+			finally:
+				self.command(label, time.time() - t0, counts[0] - before[0], counts[1] - before[1], ok)
+
+		conn.send = counted_send
+		conn.read = counted_read
+		conn.readline = counted_readline
+		conn._simple_command = timed_command
+
+	def snapshot(self, final=False):
+		""" @return the metrics as a dict ready for JSON """
+		with self.lock:
+			return {
+				'time': datetime.datetime.now().isoformat(),
+				'elapsed': round(time.time() - self.start, 3),
+				'final': final,
+				'phases': dict((k, round(v, 3)) for (k, v) in self.phases.items()),
+				'counters': dict(self.counters),
+				'commands': dict((k, dict(v, buckets=list(v['buckets']))) for (k, v) in self.commands.items()),
+			}
+
+	def prometheus(self, snapshot):
+		""" @return the snapshot in the Prometheus text exposition format """
+		def label(value):
+			return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+		lines = ['# TYPE syncimap_elapsed_seconds gauge',
+			'syncimap_elapsed_seconds %s' % snapshot['elapsed'],
+			'# TYPE syncimap_phase_seconds_total counter']
+		for name, seconds in snapshot['phases'].items():
+			lines.append('syncimap_phase_seconds_total{phase="%s"} %s' % (label(name), seconds))
+		for name, value in snapshot['counters'].items():
+			if name.startswith('total_'):
+				name = name[len('total_'):]
+			lines.append('# TYPE syncimap_%s_total counter' % name)
+			lines.append('syncimap_%s_total %d' % (name, value))
+		for metric, key in (('commands_total', 'count'), ('command_errors_total', 'errors'),
+				('command_bytes_in_total', 'bytes_in'), ('command_bytes_out_total', 'bytes_out')):
+			lines.append('# TYPE syncimap_%s counter' % metric)
+			for name, c in snapshot['commands'].items():
+				lines.append('syncimap_%s{command="%s"} %d' % (metric, label(name), c[key]))
+		lines.append('# TYPE syncimap_command_duration_seconds histogram')
+		for name, c in snapshot['commands'].items():
+			for bound, n in zip(self.BUCKETS, c['buckets']):
+				lines.append('syncimap_command_duration_seconds_bucket{command="%s",le="%s"} %d' % (label(name), bound, n))
+			lines.append('syncimap_command_duration_seconds_bucket{command="%s",le="+Inf"} %d' % (label(name), c['count']))
+			lines.append('syncimap_command_duration_seconds_sum{command="%s"} %.6f' % (label(name), c['seconds']))
+			lines.append('syncimap_command_duration_seconds_count{command="%s"} %d' % (label(name), c['count']))
+		return '\n'.join(lines) + '\n'
+
+	def write(self, config, final=False):
+		""" Writes a snapshot to the --metricsfile and --promfile outputs """
+		snapshot = self.snapshot(final)
+		if config.get('metricsfile'):
+			with open(config['metricsfile'], 'a') as f:
+				f.write(json.dumps(snapshot) + '\n')
+		if config.get('promfile'):
+			# renamed into place so a collector never reads half a file
+			tmp = config['promfile'] + '.tmp'
+			with open(tmp, 'w') as f:
+				f.write(self.prometheus(snapshot))
+			os.replace(tmp, config['promfile'])
+
+	def begin(self, config):
+		""" Starts writing snapshots every --metricsinterval seconds """
+		interval = float(config['metricsinterval'])
+		if not (config.get('metricsfile') or config.get('promfile')) or interval <= 0:
+			return
+
+		def writer():
+			while not self.stopped.wait(interval):
+				self.write(config)
+
+		self.thread = threading.Thread(target=writer, daemon=True)
+		self.thread.start()
+
+	def end(self, config):
+		""" Stops the periodic writer and writes the final snapshot """
+		self.stopped.set()
+		if self.thread is not None:
+			self.thread.join()
+		if config.get('metricsfile') or config.get('promfile'):
+			self.write(config, True)
+
+
+class ThreadOutput:
+	"""
+	sys.stdout replacement for batch mode: a thread named "<account>" or
+	"<account>/..." writes to the stream registered for <account>.
+	"""
+
+	def __init__(self, default):
+		self.default = default
+		self.streams = {}
+
+	def __stream(self):
+		return self.streams.get(threading.current_thread().name.split('/')[0], self.default)
+
+	def write(self, data):
+		return self.__stream().write(data)
+
+	def flush(self):
+		self.__stream().flush()
+
+
+class Batch:
+	"""
+	Runs main.run() for every account of a manifest, up to maxaccounts at a
+	time and without exceeding maxperhost connections to any host. Each
+	account is a row of a CSV file with a header line or an object of a JSON
+	list, keyed by option names (host1, user1, password1, host2, ...);
+	passwords are in clear text. Options given on the command line apply to
+	every account.
+
+	The outcome of every account is appended to a JSON lines state file;
+	rerunning the batch skips the accounts already synced successfully.
+	"""
+
+	def __init__(self, config):
+		self.config = dict((k, v) for (k, v) in config.items()
+			if k not in ('batch', 'batchstate', 'batchlogs', 'maxaccounts', 'maxperhost'))
+		self.manifest = config['batch']
+		self.statefile = config.get('batchstate') or self.manifest + '.state'
+		self.logdir = config.get('batchlogs') or self.manifest + '.logs'
+		self.maxaccounts = int(config['maxaccounts'])
+		self.maxperhost = int(config['maxperhost'])
+		self.cond = threading.Condition()
+		self.connections = collections.Counter()
+		self.pending = []
+		self.results = []
+
+	def load(self):
+		"""
+		@return the accounts of the manifest as a list of partial configs
+		"""
+		with open(self.manifest, newline='') as f:
+			if self.manifest.lower().endswith('.json'):
+				rows = json.load(f)
+			else:
+				rows = list(csv.DictReader(f))
+		accounts = []
+		for row in rows:
+			account = {}
+			for key, value in row.items():
+				key = key.strip().lstrip('-')
+				if isinstance(value, str):
+					value = value.strip()
+					if value.lower() in ('true', 'yes'):
+						value = True
+					elif value.lower() in ('false', 'no'):
+						value = False
+				if value is None or value == '':
+					continue
+				if not isinstance(value, bool):
+					value = str(value)
+				account[key] = value
+			accounts.append(account)
+		return accounts
+
+	def endpoint(self, account, typ):
+		""" returns host:port of host typ of an account, the bare path of a local store """
+		host = account.get('host'+typ, self.config.get('host'+typ, ''))
+		if host.startswith(LOCAL_STORES):
+			return host
+		port = account.get('port'+typ, self.config.get('port'+typ))
+		if port is None:
+			port = 993 if account.get('ssl'+typ, self.config.get('ssl'+typ)) else 143
+		return '%s:%s' % (host.lower(), port)
+
+	def key(self, account):
+		""" returns the name identifying an account in the state file and logs """
+		return '%s@%s-%s@%s' % (account.get('user1'), self.endpoint(account, '1'), account.get('user2'), self.endpoint(account, '2'))
+
+	def done(self):
+		""" returns the keys of the accounts synced successfully by earlier runs """
+		finished = set()
+		if not os.path.exists(self.statefile):
+			return finished
+		with open(self.statefile) as f:
+			for line in f:
+				try:
+					result = json.loads(line)
+				except ValueError:
+					# last line of an interrupted run
+					continue
+				if result['outcome'] == 'ok':
+					finished.add(result['account'])
+				else:
+					finished.discard(result['account'])
+		return finished
+
+	def run(self):
+		"""
+		Syncs the accounts not done yet
+		@return exit status, 0 when every account succeeded
+		"""
+		accounts = self.load()
+		finished = self.done()
+		self.pending = [a for a in accounts if self.key(a) not in finished]
+		print ("Batch %s: %d accounts, %d already done" % (self.manifest, len(accounts), len(accounts) - len(self.pending)))
+		if not os.path.isdir(self.logdir):
+			os.makedirs(self.logdir)
+		self.state = open(self.statefile, 'a')
+		self.metrics = Metrics()
+		self.metrics.begin(self.config)
+		self.output = ThreadOutput(sys.stdout)
+		sys.stdout = self.output
+		try:
+			threads = [threading.Thread(target=self.worker) for i in range(max(1, self.maxaccounts))]
+			for t in threads:
+				t.start()
+			for t in threads:
+				t.join()
+		finally:
+			sys.stdout = self.output.default
+			self.state.close()
+			self.metrics.end(self.config)
+
+		print ("++++ Batch results")
+		failed = 0
+		for result in self.results:
+			if result['outcome'] != 'ok':
+				failed += 1
+			print ("%-60s %-6s %8.1f s  transferred %d  exit %s %s" % (result['account'], result['outcome'],
+				result['seconds'], result['transferred'], result['exit'], result.get('error', '')))
+		print ("Accounts synced: %d, failed: %d" % (len(self.results) - failed, failed))
+		if failed:
+			return 6
+		return 0
+
+	def __hosts(self, account):
+		""" returns dict{ host: connections } an account needs """
+		workers = int(account.get('workers', self.config['workers']))
+		hosts = collections.Counter()
+		hosts[self.endpoint(account, '1')] += workers
+		hosts[self.endpoint(account, '2')] += workers
+		return hosts
+
+	def __next(self):
+		"""
+		Waits for a pending account whose hosts have room and reserves its
+		connections; returns None when no account is left
+		"""
+		with self.cond:
+			while self.pending:
+				for account in self.pending:
+					hosts = self.__hosts(account)
+					if not self.maxperhost or all(self.connections[h] == 0 or self.connections[h] + n <= self.maxperhost
+							for (h, n) in hosts.items()):
+						self.pending.remove(account)
+						self.connections.update(hosts)
+						return account
+				self.cond.wait()
+			return None
+
+	def __release(self, account):
+		with self.cond:
+			self.connections.subtract(self.__hosts(account))
+			self.cond.notify_all()
+
+	def worker(self):
+		while True:
+			account = self.__next()
+			if account is None:
+				return
+			try:
+				self.sync(account)
+			finally:
+				self.__release(account)
+
+	def sync(self, account):
+		""" Runs main.run() for one account, its output going to its own log """
+		name = self.key(account)
+		config = dict(self.config)
+		config.update(account)
+		thread = threading.current_thread()
+		thread.name = re.sub(r'[^\w@.-]', '_', name)
+		log = open(os.path.join(self.logdir, thread.name + '.log'), 'a')
+		self.output.streams[thread.name] = log
+		result = {'account': name, 'started': datetime.datetime.now().isoformat(), 'exit': 0}
+		t0 = time.time()
+		app = main()
+		app.metrics = self.metrics
+		try:
+			for typ in ('1', '2'):
+				# check_config gives local stores their empty password, an
+				# IMAP password missing would be prompted for
+				if 'password'+typ not in config and not config.get('host'+typ, '').startswith(LOCAL_STORES):
+					raise RuntimeError('no password%s in the manifest' % typ)
+			app.run(config)
+		except SystemExit as e:
+			result['exit'] = e.code or 0
+		except Exception as e:
+			print ("ERROR", e)
+			result['exit'] = 1
+			result['error'] = str(e)
+		finally:
+			del self.output.streams[thread.name]
+			log.close()
+		result['outcome'] = 'ok' if result['exit'] == 0 else 'failed'
+		result['seconds'] = round(time.time() - t0, 1)
+		for counter in ('transferred', 'skipped', 'deleted'):
+			result[counter] = getattr(app, 'msg_' + counter, 0)
+		with self.cond:
+			self.results.append(result)
+			self.state.write(json.dumps(result) + '\n')
+			self.state.flush()
 
 
 class main:
@@ -40,9 +3130,17 @@ class main:
 	NAME = 'syncimap'
 	VERSION = '0.4'
 		
-	def run(self):
+	def run(self, config=None):
+		"""
+		Syncs one account, configured from the command line unless a complete
+		config is given (batch mode)
+		"""
 		
-		config = self.get_config()
+		config = self.get_config(config)
+		if 'batch' in config:
+			sys.exit(Batch(config).run())
+		if config.get('findmessage'):
+			sys.exit(self.__findMessage(config))
 		safemode=config['safemode']
 
 		# Parse exclude list
@@ -50,26 +3148,73 @@ class main:
 		self.excludes.append(re.compile(config['exclude']))
 		self.excluded_folders = []
 
+		self.key = MessageKey(config)
+		self.flagfilter = None
+		if config.get('regexflag'):
+			self.flagfilter = perl_substitution(config['regexflag'])
+		self.rewriter = None
+		regexmess = config.get('regexmess') or []
+		if isinstance(regexmess, str):
+			# a batch manifest column
+			regexmess = [regexmess]
+		if regexmess or config.get('skipheader'):
+			self.rewriter = Rewriter(regexmess, config.get('skipheader'), config.get('rewriteworkers'))
+		self.cache = None
+		if config.get('statefile'):
+			self.cache = StateCache(config['statefile'], self.key.spec)
+
+		self.lock = threading.Lock()
+		self.compressed = []
+		# archive path -> ArchiveIMAP4.shared_state() of its connections
+		self.archives = {}
+		# batch mode shares one Metrics between its accounts
+		owner = getattr(self, 'metrics', None) is None
+		if owner:
+			self.metrics = Metrics()
+			self.metrics.begin(config)
+		self.throttles = dict((typ, Throttle(typ, config.get('bandwidth'+typ), config.get('commandrate'+typ)))
+			for typ in ('1', '2'))
+		dests = self.__destinations(config)
+		self.fanout = len(dests) > 1
+		for d in dests[1:]:
+			# each fan-out destination is a host of its own
+			self.throttles[d.label] = Throttle(d.label, config.get('bandwidth2'), config.get('commandrate2'))
+
 		self.t0 = time.time()
 		self.timestart = self.t0
 		
-		srcconn = self.connect_and_login('1',config)
-		srctype = self.__getServerType(srcconn)
-		#print "Source server type is", srctype
-		print ("Banner: %s" % srcconn.welcome.decode('utf-8'))
-		(typ, data) = srcconn.capability()
-		print ("Host1 capability: %s" % data[0].decode('utf-8'))
+		with self.metrics.phase('connect'):
+			srcconn = self.connect_and_login('1',config)
+			srctype = self.__getServerType(srcconn)
+			#print "Source server type is", srctype
+			print ("Banner: %s" % srcconn.welcome.decode('utf-8'))
+			(typ, data) = srcconn.capability()
+			print ("Host1 capability: %s" % data[0].decode('utf-8'))
+			self.__enableExtensions(srcconn, '1', data[0], config)
 		
-		dstconn = self.connect_and_login('2',config)					
-		dsttype = self.__getServerType(dstconn)
-		#print "Destination server type is", dsttype
-		print ("Banner: %s" % dstconn.welcome.decode('utf-8'))
-		(typ, data) = dstconn.capability()
-		print ("Host2 capability: %s" % data[0].decode('utf-8'))
+			for d in dests:
+				try:
+					d.conn = self.connect_and_login('2', d.config, d.label)
+				except SystemExit:
+					if len(dests) == 1:
+						raise
+					# connect_and_login already reported why, the other destinations go on
+					d.down = True
+					continue
+				d.type = self.__getServerType(d.conn)
+				#print "Destination server type is", d.type
+				print ("Banner: %s" % d.conn.welcome.decode('utf-8'))
+				(typ, data) = d.conn.capability()
+				print ("Host%s capability: %s" % (d.label, data[0].decode('utf-8')))
+				self.__enableExtensions(d.conn, d.label, data[0], d.config)
+			if all(d.down for d in dests):
+				print ("ERROR: no destination to sync into")
+				sys.exit(5)
 		
 		totsize=0
 		tmess=0
-		srcfolders = self.__listMailboxes(srcconn,config['nofoldersizes'])
+		with self.metrics.phase('list'):
+			srcfolders = self.__listMailboxes(srcconn,config['nofoldersizes'])
 		
 		if len(self.excluded_folders)>0:
 			print ("Excluding folders matching pattern '%s': %s" % (config['exclude'],self.excluded_folders))
@@ -77,10 +3222,18 @@ class main:
 		separator=srcfolders[0]['delimiter']
 		print ("Host1 separator: [%s]" %  separator)
 							
-		dstfolders = self.__listMailboxes(dstconn,config['nofoldersizes'])
-		separator=dstfolders[0]['delimiter']
-		print ("Host2 separator: [%s]" %  separator)
+		dstfolders = {}
+		for d in dests:
+			if d.down:
+				continue
+			with self.metrics.phase('list'):
+				dstfolders[d.label] = self.__listMailboxes(d.conn,config['nofoldersizes'])
+			separator=dstfolders[d.label][0]['delimiter']
+			print ("Host%s separator: [%s]" %  (d.label, separator))
+			d.status = dict((f['mailbox'], f['status']) for f in dstfolders[d.label])
 		
+		self.srcstatus = dict((f['mailbox'], f['status']) for f in srcfolders)
+
 		p='OFF'
 		if config['safemode']:	p='ON'
 		print ("Safe mode: %s" % p)
@@ -99,148 +3252,826 @@ class main:
 		print ("Total messages: %d" % tmess)
 		print ("Time: %.1f s" % self.timenext())
 
-		totsize=0
-		tmess=0
-		print ("Destination mailboxes:")
-		print ("++++ Calculating sizes ++++")
-		for item in dstfolders:
-			if not config['nofoldersizes']:
-				totsize += int(item['size'])
-				tmess += int(item['messages'])
-				print ("Host2 folder %-35s Size: %9s Messages: %5s" % ('['+item['mailbox']+']',item['size'],item['messages']))
-			else:
-				print ("Host2 folder %-35s" % ('['+item['mailbox']+']'))
-		print ("Total size: %d" % totsize)
-		print ("Total messages: %d" % tmess)
-		print ("Time: %.1f s" % self.timenext())
+		for d in dests:
+			if d.down:
+				continue
+			totsize=0
+			tmess=0
+			print ("Destination mailboxes:" if len(dests) == 1 else "Destination mailboxes on host%s:" % d.label)
+			print ("++++ Calculating sizes ++++")
+			for item in dstfolders[d.label]:
+				if not config['nofoldersizes']:
+					totsize += int(item['size'])
+					tmess += int(item['messages'])
+					print ("Host%s folder %-35s Size: %9s Messages: %5s" % (d.label, '['+item['mailbox']+']',item['size'],item['messages']))
+				else:
+					print ("Host%s folder %-35s" % (d.label, '['+item['mailbox']+']'))
+			print ("Total size: %d" % totsize)
+			print ("Total messages: %d" % tmess)
+			print ("Time: %.1f s" % self.timenext())
 
 		self.msg_skipped = 0
 		self.msg_deleted = 0
 		self.msg_transferred  = 0
 		self.total_bytes_transferred = 0
 		self.msg_flags = 0
+		self.msg_flags_updated = 0
+		self.folders_skipped = 0
+		self.errors = []
+		for d in dests:
+			if d.down:
+				self.errors.append("host%s %s: cannot connect, nothing synced" % (d.label, d.config['host2']))
 		
 		# Syncing every source folder
-		for f in srcfolders:
+		conns = [srcconn, [d for d in dests if not d.down]]
+		if config.get('justfoldersizes'):
+			print ("++++ Just folder sizes, nothing synced")
+		elif config.get('plan'):
+			self.__plan(conns, srcfolders, srctype, config)
+		elif int(config['workers']) > 1:
+			self.__syncParallel(conns, srcfolders, srctype, config)
+		else:
+			for f in srcfolders:
+				# as the parallel workers do, a folder failing for good is
+				# reported at the end and the next ones are still synced
+				try:
+					self.__syncFolderRetry(conns, f, srctype, config)
+				except Exception as e:
+					self.errors.append("folder %s: %s" % (f['mailbox'], e))
+
+		print ("++++ End looping on each folder")
+		for error in self.errors:
+			print ("ERROR", error)
+
+		self.timediff = time.time() - self.timestart
+		self.stats()
+
+		# Logout
+		conns[0].logout()
+		for d in conns[1]:
+			if d.conn is not None:
+				d.conn.logout()
+		if self.rewriter is not None:
+			self.rewriter.close()
+		if self.cache is not None:
+			self.cache.close()
+		if owner:
+			self.metrics.end(config)
+		if self.errors:
+			sys.exit(6)
+	
+	def __destinations(self, config):
+		""" returns the Destinations of config, the first --host2 and those of config['fanout'] """
+		dests = [Destination('2', config)]
+		for i, extra in enumerate(config.get('fanout') or []):
+			dests.append(Destination('2.%d' % (i + 2), dict(config, **extra)))
+		return dests
+
+	def __syncFolder(self, srcconn, dests, f, srctype, config, progress=None):
+		"""
+		Syncs one source folder into its folder on every destination, each
+		message missing somewhere fetched once and appended wherever it is
+		missing
+		@param dests: the Destinations, one failing is left out of the rest of
+		the folder while the others go on
+		@param progress: dict whose 'copied' counts the messages the destinations confirmed
+		@return list of (Destination, exception) of the destinations which failed
+		"""
+		safemode=config['safemode']
+		failed = []
             
-			# Translate folder name
-			srcfolder = f['mailbox']
-			dstfolder = self.__translateFolderName(srcfolder, srctype, dsttype)
+		# Translate folder name
+		srcfolder = f['mailbox']
             
-			# Check for folder in exclusion list
-			'''
-			skip = False
-			for e in self.excludes:
-				if e.match(srcfolder):
-					skip = True
-					break
-			if skip:
-				print "Skipping", srcfolder, "(excluded)"
+		# Check for folder in exclusion list
+		'''
+		skip = False
+		for e in self.excludes:
+			if e.match(srcfolder):
+				skip = True
+				break
+		if skip:
+			print "Skipping", srcfolder, "(excluded)"
+			continue
+		'''
+		targets = []
+		for d in dests:
+			dstfolder = self.__translateFolderName(srcfolder, srctype, d.type)
+			if self.__folderUnchanged(srcfolder, d, dstfolder, config):
+				print ("++++ Skipping", srcfolder, "(unchanged since last run)" + self.__on(d))
+				self.__count('folders_skipped')
 				continue
-			'''
-			print ("++++ Syncing", srcfolder, 'into', dstfolder)
+			print ("++++ Syncing", srcfolder, 'into', dstfolder + self.__on(d))
+			targets.append({'dest': d, 'folder': dstfolder, 'error': None})
+		if not targets:
+			return failed
 
-			# Create dst mailbox when missing
-			if not safemode:
-				dstconn.create(dstfolder)
-            
+		with self.metrics.phase('select'):
 			# Select source mailbox readonly
 			(res, data) = srcconn.select(srcfolder, True)
 			if res == 'NO' and srctype == 'exchange' and 'special mailbox' in data[0]:
 				print ("Skipping special Microsoft Exchange Mailbox", srcfolder)
-				continue
-			dstconn.select(dstfolder, False)
-            
-			# Fetch all destination messages imap IDS
-			dstids = self.__listMessages(dstconn,config)
-			print ("Found", len(dstids), "messages in destination folder")
+				return failed
+			# Create dst mailbox when missing
+			for t in targets:
+				self.__isolated(t, failed, self.__selectTarget, t, safemode)
             
-			# Fetch destination messages ID
+		with self.metrics.phase('index'):
+			# Fetch and index all destination messages
 			print ("Acquiring message IDs...")
-			dstmexids = []
-			for did in dstids:
-				dstmexids.append(self.__getMessageId(dstconn, did)[0])
-			print (len(dstmexids), "message IDs acquired.")
+			for t in targets:
+				self.__isolated(t, failed, self.__indexTarget, t)
+
+			# Fetch and index all source messages
+			srcids, srcindex, srcvalidity = self.__indexFolder(srcconn, '1', srcfolder, config)
 
-			# Fetch all source messages imap IDS
-			srcids = self.__listMessages(srcconn,config)
+		for t in targets:
+			self.__isolated(t, failed, self.__diffTarget, t, srcfolder, srcindex, srcvalidity, config)
+		print ("Found", len(srcids), "messages in source folder")
+		for t in targets:
+			self.__isolated(t, failed, self.__updateTarget, t, config)
+
+		# Each message is fetched once for all the destinations lacking it
+		live = [t for t in targets if t['error'] is None]
+		for t in live:
+			t['appends'] = AppendQueue(t['dest'].conn, t['folder'], config['appendsize'])
+		tocopy = IndexSelection.union(srcindex, [t['tocopy'] for t in live])
+		messages = self.__fetchMessages(srcconn, tocopy, config)
+		if self.rewriter is not None:
+			messages = self.rewriter.pipeline(messages)
+		try:
+			self.__copyMessages(messages, live, failed, config)
+		finally:
+			# whatever the destinations confirmed is not copied again
+			for t in live:
+				t['journal'].record(t['appends'].done)
+				if progress is not None:
+					progress['copied'] += t['appends'].confirmed
 			
-			srcmexids = []
-			srcflags = []
-			for sid in srcids:
-				mid,flags = self.__getMessageId(srcconn, sid)
-				srcmexids.append(mid)
+		'''
+		if config['expunge1']:
+			print "Expunging host1 folder %s" % srcfolder
+			if not safemode:
+				srcconn.expunge()
+		'''	
+		for t in targets:
+			self.__isolated(t, failed, self.__finishTarget, t, srcconn, srcfolder, config)
+		return failed
+
+	def __on(self, d):
+		""" returns what tells destination d from the others in messages, nothing without fan-out """
+		return ' on host%s' % d.label if self.fanout else ''
+
+	def __isolated(self, t, failed, function, *args):
+		"""
+		Runs function(*args) for the target t of a folder sync unless t
+		already failed; an exception leaves t out of the rest of the folder,
+		recorded in failed, instead of stopping the other destinations
+		@return what function returned, None when t failed
+		"""
+		if t['error'] is not None:
+			return None
+		try:
+			return function(*args)
+		except Exception as e:
+			t['error'] = e
+			failed.append((t['dest'], e))
+			if self.fanout:
+				print ("ERROR: host%s failed syncing %s: %s" % (t['dest'].label, t['folder'], e))
+			return None
+
+	def __selectTarget(self, t, safemode):
+		""" Creates when missing and selects the folder of a target """
+		conn = t['dest'].conn
+		if not safemode:
+			conn.create(t['folder'])
+		conn.select(t['folder'], False)
+		t['permanent'] = self.__permanentFlags(conn)
+
+	def __indexTarget(self, t):
+		d = t['dest']
+		dstids, t['index'], t['validity'] = self.__indexFolder(d.conn, '2', t['folder'], d.config)
+		print ("Found", len(dstids), "messages in destination folder" + self.__on(d))
+		print (len(t['index']), "message IDs acquired.")
+
+	def __diffTarget(self, t, srcfolder, srcindex, srcvalidity, config):
+		"""
+		Compares the source index with the index of a target, sets its
+		'tocopy', 'todelete', 'unchanged' and 'journal'
+		"""
+		d = t['dest']
+		# Compare both sides
+		with self.metrics.phase('diff'):
+			tocopy, t['todelete'], t['unchanged'] = diff_indexes(srcindex, t['index'], limit=int(config['diffmemory']))
+
+		# SMALLER in the SEARCH does not cover cached indexes nor every server
+		if config.get('maxsize') is not None:
+			fitting = tocopy.select(lambda m: m['size'] <= int(config['maxsize']))
+			if len(fitting) < len(tocopy):
+				print ("Skipping", len(tocopy) - len(fitting), "messages larger than", config['maxsize'], "bytes" + self.__on(d))
+				tocopy = fitting
+
+		# Messages an interrupted run already copied
+		t['journal'] = Journal(self.cache, d.config, srcfolder, srcvalidity, t['folder'], t['validity'])
+		if not config['safemode']:
+			done = t['journal'].load()
+			if done:
+				print ("Resuming", srcfolder + ":", len(done), "messages already copied by the last run" + self.__on(d))
+				tocopy = tocopy.select(lambda m: int(m['uid']) not in done)
+		t['tocopy'] = tocopy
+
+	def __updateTarget(self, t, config):
+		""" Deletes the unknown messages of a target and syncs the flags of those it has """
+		d = t['dest']
+		todelete = t['todelete']
+		#delete unknown dst messages
+		print ("Found", len(todelete), "messages in destination folder for delete" + self.__on(d))
+		if todelete and not (config['safemode']) and config['delete2']:
+			for m in todelete:
+				print ("Delete %s/%s message" % (t['folder'],m['uid']))
+			with self.metrics.phase('delete'):
+				self.__deleteMessages(d.conn, [m['uid'] for m in todelete], config)
+			self.__count('msg_deleted', len(todelete))
+
+		# Sync data
+		for m, dm in t['unchanged']:
+			self.__count('msg_skipped')
+			print ("Skipping message", m['uid'].decode('ascii'))
+		if t['unchanged'] and not config.get('nosyncflags'):
+			with self.metrics.phase('flags'):
+				self.__syncFlags(d.conn, t['unchanged'], t['permanent'], config)
+
+	def __finishTarget(self, t, srcconn, srcfolder, config):
+		""" Expunges the folder of a target and records its sync as complete """
+		d = t['dest']
+		if config['expunge2']:
+			print ("Expunging host%s folder %s" % (d.label, t['folder']))
+			if not config['safemode']:
+				with self.metrics.phase('expunge'):
+					d.conn.expunge()
+		if not config['safemode']:
+			self.__saveSynced(srcconn, d, srcfolder, t['folder'], config)
+			t['journal'].clear()
+
+	def __copyMessages(self, messages, targets, failed, config):
+		"""
+		Appends each fetched message to the targets whose 'tocopy' holds it,
+		checkpointing the confirmed ones to their journal every
+		JOURNAL_MESSAGES messages or JOURNAL_SECONDS seconds. Stops fetching
+		once every target failed.
+		"""
+		safemode = config['safemode']
+		checkpoint = time.time()
+		while True:
+			if all(t['error'] is not None for t in targets):
+				messages.close()
+				return
+			with self.metrics.phase('fetch'):
 				try:
-					if config['nosyncflags']:
-						pass
-				except:
-					srcflags.append(flags)
-					
-			dstdelids = []
-			
-			for did in dstids:
-				mid = self.__getMessageId(dstconn,did)[0]
-				if not mid in srcmexids:
-					# Message not found, prepare to delete it
-					#print "Delete message", mid
-					dstdelids.append(did)
-					
-			#delete unknown dst messages
-			print ("Found", len(dstdelids), "messages in destination folder for delete")
-			for did in dstdelids:
-				if not (safemode) and config['delete2']:
-					print ("Delete %s/%s message" % (dstfolder,did))
-					self.msg_deleted += 1
-					dstconn.store(did,'+FLAGS','\Deleted')
-				
-			
-			
-			print ("Found", len(srcids), "messages in source folder")
-			# Sync data
-			for index, mid in enumerate(srcmexids):			
-				if not mid in dstmexids:
-					# Message not found, syncing it
-					self.msg_transferred += 1
-					print ("Copying message", mid)
-					mex = self.__getMessage(srcconn, srcids[index])
-					if not safemode:
-						try:
-							flags = srcflags[index]
-							dstconn.append(dstfolder, flags, None, mex)
-							self.msg_flags += 1
-						except:
-							dstconn.append(dstfolder, None, None, mex)
+					item = next(messages, None)
+				except Exception:
+					# the destinations still take the messages fetched so far
+					for t in targets:
+						with contextlib.suppress(Exception):
+							t['appends'].close()
+					raise
+			if item is None:
+				break
+			m, mex = item
+			receivers = [t for t in targets if t['error'] is None and m in t['tocopy']]
+			if not receivers:
+				continue
+			# Message not found, syncing it
+			described = "%s (UID %s)" % (message_id(literal_head(mex)) or 'without Message-ID', m['uid'].decode('ascii'))
+			if self.fanout:
+				print ("Copying message", described, "to", ', '.join('host' + t['dest'].label for t in receivers))
+			else:
+				print ("Copying message", described)
+			for t in receivers:
+				self.__count('msg_transferred')
+				self.__count('total_bytes_transferred', literal_size(mex))
+				if safemode:
+					continue
+				flags = None
+				if not config.get('nosyncflags'):
+					flags = self.__targetFlags(m['flags'], t['permanent'])
+					if flags:
+						flags = '(' + ' '.join(flags) + ')'
+						self.__count('msg_flags')
+					else:
+						flags = None
+				date = None
+				if m['date']:
+					date = '"' + m['date'] + '"'
+				with self.metrics.phase('append'):
+					self.__isolated(t, failed, t['appends'].add, flags, date, mex, m)
+			if not safemode and (max(len(t['appends'].done) for t in targets) >= JOURNAL_MESSAGES
+					or time.time() - checkpoint > JOURNAL_SECONDS):
+				for t in targets:
+					t['journal'].record(t['appends'].done)
+				checkpoint = time.time()
+		with self.metrics.phase('append'):
+			for t in targets:
+				self.__isolated(t, failed, t['appends'].close)
+
+	def __permanentFlags(self, conn):
+		"""
+		returns the lowercased flags the selected mailbox can store, None
+		when any keyword can be stored
+		"""
+		typ, data = conn.response('PERMANENTFLAGS')
+		if not data or data[-1] is None:
+			return None
+		flags = data[-1].decode('utf-8', 'replace').strip('()').split()
+		if '\\*' in flags:
+			return None
+		return set(f.lower() for f in flags)
+
+	def __targetFlags(self, flags, permanent, rewrite=True):
+		"""
+		returns the list of flags a message with the given source flags gets
+		on the destination: --regexflag applied unless not rewrite, without
+		\\Recent, \\Deleted and the flags the destination cannot store
+		"""
+		if rewrite and self.flagfilter is not None:
+			flags = self.flagfilter(flags)
+		target = []
+		for flag in flags.split():
+			lower = flag.lower()
+			if lower in ('\\recent', '\\deleted') or (permanent is not None and lower not in permanent):
+				continue
+			if lower not in (f.lower() for f in target):
+				target.append(flag)
+		return target
+
+	def __syncFlags(self, conn, pairs, permanent, config):
+		"""
+		Gives destination messages the flags of their source message,
+		one UID STORE FLAGS.SILENT per distinct set of flags.
+		@param pairs: (source, destination) index entries of the same message
+		"""
+		for flags, uids in self.__flagGroups(pairs, permanent).items():
+			print ("Setting flags (%s) on %d messages" % (flags, len(uids)))
+			if not config['safemode']:
+				self.__uidCommand(conn, 'STORE', uid_set_chunks(uids), 'FLAGS.SILENT', '(' + flags + ')')
+			self.__count('msg_flags_updated', len(uids))
+
+	def __flagGroups(self, pairs, permanent):
+		"""
+		returns dict{ flags: destination UIDs } of the messages whose flags
+		differ from their source message's
+		"""
+		groups = {}
+		for m, d in pairs:
+			target = self.__targetFlags(m['flags'], permanent)
+			current = set(f.lower() for f in self.__targetFlags(d['flags'], permanent, False))
+			if set(f.lower() for f in target) != current:
+				groups.setdefault(' '.join(sorted(target)), []).append(int(d['uid']))
+		return groups
+
+	def __plan(self, conns, srcfolders, srctype, config):
+		"""
+		Indexes and diffs every folder without changing anything, fetches a
+		short calibration sample (copies it for real with --plancopy) and
+		writes the work found and its ETA as one JSON object to the --plan
+		file ('-' for stdout).
+		A fan-out sync is planned for its first destination.
+		"""
+		srcconn = conns[0]
+		dest = conns[1][0]
+		t0 = time.time()
+		folders = []
+		for f in srcfolders:
+			with self.metrics.phase('index'):
+				folders.append(self.__planFolder(srcconn, dest, f, srctype, config))
+		index_seconds = time.time() - t0
+
+		rtt = dict((typ, self.__roundTrip(conn)) for (typ, conn) in (('1', srcconn), ('2', dest.conn)))
+		calibration = None
+		candidates = [p for p in folders if p['tocopy']]
+		if candidates and int(config['plansample']) > 0:
+			copy = bool(config.get('plancopy')) and not config['safemode']
+			calibration = self.__calibrate(srcconn, dest, max(candidates, key=lambda p: p['copy_bytes']), config, copy)
+
+		fields = ('source_messages', 'source_bytes', 'copy_messages', 'copy_bytes', 'delete_messages', 'delete_bytes',
+			'reflag_messages', 'too_large_messages')
+		# the work found, the messages of a --plancopy sample included
+		total = dict((name, sum(p[name] for p in folders)) for name in fields)
+		total['folders'] = len(folders)
+		total['unchanged_folders'] = sum(p['unchanged'] for p in folders)
+		# commands which do not move messages, one round trip each
+		commands = sum(p['commands'] for p in folders)
+		eta = index_seconds + commands * (rtt['1'] + rtt['2']) / 2
+		workers = max(1, min(int(config['workers']), len(candidates)))
+		if calibration is not None:
+			seconds = calibration['fetch_seconds'] + calibration['append_seconds']
+			copied = calibration['messages'] if calibration['copied'] else 0, calibration['bytes'] if calibration['copied'] else 0
+
+			def copying(messages, size):
+				# scaled by bytes or by messages, whichever gives the longer copy
+				return seconds * max(size / float(calibration['bytes'] or 1), messages / float(calibration['messages']))
+			# the calibration was serial, the sync copies folders over the
+			# workers, and takes at least as long as its largest folder
+			largest = max(copying(p['copy_messages'], p['copy_bytes']) for p in candidates)
+			eta += max(copying(total['copy_messages'] - copied[0], total['copy_bytes'] - copied[1]) / workers, largest)
+		elif total['copy_messages']:
+			eta = None
+		plan = {
+			'host1': config['host1'], 'user1': config['user1'], 'host2': dest.config['host2'], 'user2': dest.config['user2'],
+			'time': datetime.datetime.now().isoformat(timespec='seconds'),
+			'folders': [dict((k, v) for (k, v) in p.items() if k not in ('tocopy', 'commands', 'srcvalidity', 'dstvalidity'))
+				for p in folders],
+			'total': total,
+			'index_seconds': round(index_seconds, 3),
+			'round_trip_seconds': dict((typ, round(v, 4)) for (typ, v) in rtt.items()),
+			'calibration': calibration,
+			'workers': workers,
+			'eta_seconds': None if eta is None else round(eta, 1),
+		}
+		print ("++++ Plan")
+		for p in folders:
+			print ("Folder %-35s copy %6d msgs %12d bytes, delete %6d, reflag %6d" % ('[' + p['folder'] + ']',
+				p['copy_messages'], p['copy_bytes'], p['delete_messages'], p['reflag_messages']))
+		print ("Total to copy                : %d messages, %d bytes" % (total['copy_messages'], total['copy_bytes']))
+		print ("Total to delete              : %d messages, %d bytes" % (total['delete_messages'], total['delete_bytes']))
+		print ("Total to reflag              : %d messages" % total['reflag_messages'])
+		if calibration is not None and calibration['copied']:
+			print ("Copied to calibrate          : %d messages, %d bytes" % (calibration['messages'], calibration['bytes']))
+		if eta is None:
+			print ("ETA                          : unknown, no calibration")
+		else:
+			print ("ETA                          : %.0f s over %d worker%s%s" % (eta, workers, 's' if workers > 1 else '',
+				'' if calibration is None or calibration['copied'] else ', APPENDs estimated from the FETCHes'))
+		line = json.dumps(plan, sort_keys=True)
+		if config['plan'] == '-':
+			print (line)
+		else:
+			# one object per account, batch mode appends them all to one file:
+			# a single write on an O_APPEND descriptor keeps the lines of
+			# accounts planned at the same time whole
+			fd = os.open(config['plan'], os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o666)
+			try:
+				os.write(fd, (line + '\n').encode('utf-8'))
+			finally:
+				os.close(fd)
+
+	def __planFolder(self, srcconn, dest, f, srctype, config):
+		"""
+		Indexes and diffs one folder pair, both selected read-only
+		@return dict of the counts of __plan, 'tocopy' and the round trips
+		a sync would spend on other commands than FETCH and APPEND
+		"""
+		srcfolder = f['mailbox']
+		dstfolder = self.__translateFolderName(srcfolder, srctype, dest.type)
+		dstconn = dest.conn
+		plan = {'folder': srcfolder, 'destination': dstfolder, 'unchanged': False, 'source_messages': 0, 'source_bytes': 0,
+			'copy_messages': 0, 'copy_bytes': 0, 'delete_messages': 0, 'delete_bytes': 0, 'reflag_messages': 0,
+			'too_large_messages': 0, 'tocopy': [], 'commands': 0, 'srcvalidity': None, 'dstvalidity': None}
+		if self.__folderUnchanged(srcfolder, dest, dstfolder, config):
+			plan['unchanged'] = True
+			return plan
+		print ("++++ Planning", srcfolder, 'into', dstfolder)
+		(res, data) = srcconn.select(srcfolder, True)
+		if res != 'OK':
+			print ("Cannot select", srcfolder)
+			return plan
+		srcids, srcindex, plan['srcvalidity'] = self.__indexFolder(srcconn, '1', srcfolder, config)
+		dstindex = CompactIndex()
+		permanent = None
+		(res, data) = dstconn.select(dstfolder, True)
+		if res == 'OK':
+			dstids, dstindex, plan['dstvalidity'] = self.__indexFolder(dstconn, '2', dstfolder, dest.config)
+			permanent = self.__permanentFlags(dstconn)
+		tocopy, todelete, unchanged = diff_indexes(srcindex, dstindex, limit=int(config['diffmemory']))
+		if config.get('maxsize') is not None:
+			fitting = tocopy.select(lambda m: m['size'] <= int(config['maxsize']))
+			plan['too_large_messages'] = len(tocopy) - len(fitting)
+			tocopy = fitting
+		journal = Journal(self.cache, dest.config, srcfolder, plan['srcvalidity'], dstfolder, plan['dstvalidity'])
+		done = journal.load()
+		if done:
+			tocopy = tocopy.select(lambda m: int(m['uid']) not in done)
+		plan['source_messages'] = len(srcindex)
+		plan['source_bytes'] = sum(srcindex.sizes)
+		plan['copy_messages'] = len(tocopy)
+		plan['copy_bytes'] = sum(m['size'] for m in tocopy)
+		plan['tocopy'] = tocopy
+		# SELECTs, SEARCHes and at least one index FETCH per side
+		plan['commands'] = 6 + (len(srcindex) + len(dstindex)) // int(config['fetchchunk'])
+		if config['delete2'] and todelete:
+			plan['delete_messages'] = len(todelete)
+			plan['delete_bytes'] = sum(m['size'] for m in todelete)
+			plan['commands'] += len(uid_set_chunks([int(m['uid']) for m in todelete])) * (2 if config.get('uidexpunge2') else 1)
+		if unchanged and not config.get('nosyncflags'):
+			groups = self.__flagGroups(unchanged, permanent)
+			plan['reflag_messages'] = sum(len(uids) for uids in groups.values())
+			plan['commands'] += sum(len(uid_set_chunks(uids)) for uids in groups.values())
+		return plan
+
+	def __roundTrip(self, conn, count=3):
+		""" returns the shortest NOOP round trip of count, in seconds """
+		best = None
+		for i in range(count):
+			t = time.time()
+			conn.noop()
+			t = time.time() - t
+			best = t if best is None else min(best, t)
+		return best
+
+	def __calibrate(self, srcconn, dest, plan, config, copy=False):
+		"""
+		Fetches an evenly spread sample of up to --plansample bytes of the
+		messages of plan, read-only, the APPENDs taken to last as long as
+		the FETCHes. With copy the sample is copied for real instead: the
+		messages are copied anyway, and the sync skips them afterwards.
+		The sample is timed on the connections the sync uses, pipelined
+		with --pipeline.
+		@return dict{ 'folder', 'messages', 'bytes', 'copied', 'fetch_seconds', 'append_seconds' }
+		"""
+		budget = int(config['plansample'])
+		tocopy = plan['tocopy']
+		step = max(1, int(plan['copy_bytes'] / float(budget)))
+		sample = []
+		size = 0
+		for m in itertools.islice(tocopy, 0, None, step):
+			if sample and size + m['size'] > budget:
+				break
+			sample.append(m)
+			size += m['size']
+		print ("++++ Calibrating with %d messages, %d bytes of %s%s" % (len(sample), size, plan['folder'],
+			', copied for real' if copy else ''))
+		srcconn.select(plan['folder'], True)
+		fetching = [0.0]
+
+		def timed(messages):
+			while True:
+				t = time.time()
+				item = next(messages, None)
+				fetching[0] += time.time() - t
+				if item is None:
+					return
+				yield item
+
+		messages = self.__fetchMessages(srcconn, sample, config)
+		if self.rewriter is not None:
+			messages = self.rewriter.pipeline(messages)
+		if not copy:
+			for item in timed(messages):
+				pass
+			return {'folder': plan['folder'], 'messages': len(sample), 'bytes': size, 'copied': False,
+				'fetch_seconds': round(fetching[0], 3), 'append_seconds': round(fetching[0], 3)}
+		dstconn = dest.conn
+		dstconn.create(plan['destination'])
+		dstconn.select(plan['destination'], False)
+		permanent = self.__permanentFlags(dstconn)
+		if plan['dstvalidity'] is None:
+			plan['dstvalidity'] = self.__folderState(dstconn)[0]
+		journal = Journal(self.cache, dest.config, plan['folder'], plan['srcvalidity'], plan['destination'], plan['dstvalidity'])
+		appends = AppendQueue(dstconn, plan['destination'], config['appendsize'])
+		target = {'dest': dest, 'folder': plan['destination'], 'error': None, 'permanent': permanent,
+			'journal': journal, 'appends': appends}
+		mask = bytearray(len(tocopy.index))
+		for m in sample:
+			mask[m['pos']] = 1
+		target['tocopy'] = IndexSelection(tocopy.index, mask)
+		failed = []
+		t = time.time()
+		try:
+			self.__copyMessages(timed(messages), [target], failed, config)
+		finally:
+			journal.record(appends.done)
+		if failed:
+			raise failed[0][1]
+		seconds = time.time() - t
+		return {'folder': plan['folder'], 'messages': len(sample), 'bytes': size, 'copied': True,
+			'fetch_seconds': round(fetching[0], 3), 'append_seconds': round(seconds - fetching[0], 3)}
+
+	def __syncFolderRetry(self, conns, f, srctype, config):
+		"""
+		Syncs a folder, reconnecting and resuming from the journal when a
+		connection drops, up to config['retries'] times in a row without
+		progress, with exponential backoff. Only the connections which
+		dropped are opened again; a fan-out destination failing for good is
+		left out while the others go on.
+		@param conns: [srcconn, Destinations], the connections replaced in place on reconnect
+		"""
+		attempt = 0
+		progress = {'copied': 0}
+		dests = [d for d in conns[1] if not d.down]
+		while dests:
+			copied = progress['copied']
+			try:
+				failed = self.__syncFolder(conns[0], dests, f, srctype, config, progress)
+			except (imaplib.IMAP4.abort, OSError, EOFError) as e:
+				# only attempts in a row that copied nothing count
+				attempt = 1 if progress['copied'] > copied else attempt + 1
+				if attempt > int(config['retries']):
+					raise
+				delay = min(60, 2 ** (attempt - 1))
+				print ("Connection lost syncing %s (%s), reconnecting in %d s" % (f['mailbox'], e, delay))
+				time.sleep(delay)
+				self.__reconnect(conns, config)
+				continue
+			if not failed:
+				return
+			attempt = 1 if progress['copied'] > copied else attempt + 1
+			dests = []
+			for (d, e) in failed:
+				lost = isinstance(e, (imaplib.IMAP4.abort, OSError, EOFError))
+				if lost and attempt <= int(config['retries']):
+					dests.append(d)
+				elif len(conns[1]) == 1:
+					raise e
 				else:
-					self.msg_skipped += 1
-					print ("Skipping message", mid)
-				
-			'''
-			if config['expunge1']:
-				print "Expunging host1 folder %s" % srcfolder
-				if not safemode:
-					srcconn.expunge()
-			'''	
-			if config['expunge2']:
-				print ("Expunging host2 folder %s" % dstfolder)
-				if not safemode:
-					dstconn.expunge()
-					
-				
-		print ("++++ End looping on each folder")
+					self.__leaveOut(d, f, e, lost)
+			if not dests:
+				return
+			delay = min(60, 2 ** (attempt - 1))
+			for (d, e) in failed:
+				if d in dests:
+					print ("Connection lost syncing %s%s (%s), reconnecting in %d s" % (f['mailbox'], self.__on(d), e, delay))
+			time.sleep(delay)
+			for d in list(dests):
+				try:
+					self.__reconnectDestination(d)
+				except OSError as e:
+					if len(conns[1]) == 1:
+						raise
+					self.__leaveOut(d, f, e, True)
+					dests.remove(d)
 
-		self.timediff = time.time() - self.timestart
-		self.stats()
+	def __leaveOut(self, d, f, e, lost):
+		"""
+		Records the failure of a fan-out destination on folder f; a lost
+		connection leaves it out of the rest of the sync
+		"""
+		with self.lock:
+			self.errors.append("folder %s on host%s: %s" % (f['mailbox'], d.label, e))
+		if lost:
+			print ("ERROR: host%s is left out of the rest of the sync" % d.label)
+			d.down = True
+			d.logout()
+
+	def __reconnect(self, conns, config):
+		""" Replaces the source connection of a pair by a new logged in one """
+		try:
+			conns[0].logout()
+		except Exception:
+			pass
+		try:
+			conns[0] = self.__openConnection('1', config)
+		except SystemExit:
+			# connect_and_login exits on failure, here it is one more failed attempt
+			raise OSError('cannot reconnect')
+
+	def __reconnectDestination(self, d):
+		""" Replaces the connection to a destination by a new logged in one """
+		d.logout()
+		try:
+			d.conn = self.__openConnection('2', d.config, d.label)
+		except SystemExit:
+			# connect_and_login exits on failure, here it is one more failed attempt
+			raise OSError('cannot reconnect to host%s' % d.label)
+
+	def __syncParallel(self, conns, srcfolders, srctype, config):
+		"""
+		Syncs folders over config['workers'] connection pairs, largest folders first.
+		The given pair is used by the first worker, the others log in on their own,
+		to the source and to every destination.
+		"""
+		folders = queue.Queue()
+		for f in sorted(srcfolders, key=lambda f: -int(f['size'])):
+			folders.put(f)
+
+		def worker(conns):
+			while True:
+				try:
+					f = folders.get_nowait()
+				except queue.Empty:
+					return
+				try:
+					self.__syncFolderRetry(conns, f, srctype, config)
+				except Exception as e:
+					with self.lock:
+						self.errors.append("folder %s: %s" % (f['mailbox'], e))
+
+		def connected_worker():
+			pair = [None, [d.copy() for d in conns[1] if not d.down]]
+			try:
+				pair[0] = self.__openConnection('1', config)
+				for d in pair[1]:
+					try:
+						d.conn = self.__openConnection('2', d.config, d.label)
+					except SystemExit:
+						if len(pair[1]) == 1:
+							raise
+						d.down = True
+			except SystemExit:
+				# connect_and_login already reported why, the other workers go on
+				if pair[0] is not None:
+					pair[0].logout()
+				return
+			try:
+				worker(pair)
+			finally:
+				pair[0].logout()
+				for d in pair[1]:
+					if d.conn is not None:
+						d.conn.logout()
+
+		# named after the current thread so batch mode logs them with their account
+		threads = [threading.Thread(target=connected_worker, name='%s/worker%d' % (threading.current_thread().name, i + 1))
+			for i in range(int(config['workers']) - 1)]
+		for t in threads:
+			t.start()
+		worker(conns)
+		for t in threads:
+			t.join()
+
+	def __count(self, counter, n=1):
+		""" Adds n to a statistics counter, safe to call from worker threads """
+		with self.lock:
+			setattr(self, counter, getattr(self, counter) + n)
+		self.metrics.count(counter, n)
+
+	def __findMessage(self, config):
+		"""
+		Prints where the archive host1 holds the messages of Message-ID
+		config['findmessage'], an index lookup
+		@return exit status, 1 when none is found
+		"""
+		mid = config['findmessage']
+		archive = ArchiveIMAP4(config['host1'][len('archive:'):], config.get('archivecodec', 'zlib'), config.get('snapshot1'))
+		try:
+			found = archive.find(mid)
+			if not found and not mid.startswith('<'):
+				found = archive.find('<%s>' % mid)
+			for (folder, uid, flags, date, message) in found:
+				print ("Host1 folder %-35s UID: %6d Size: %9d Flags: [%s] Date: %s" % ('['+folder+']', uid, len(message), flags, (date or '').strip('"')))
+		finally:
+			archive.logout()
+		if not found:
+			print ("Message %s not found in %s" % (mid, config['host1']))
+			return 1
+		return 0
+
+	def __openConnection(self, typ, config, label=None):
+		""" Opens one more logged in connection to host typ (or label) for a worker """
+		with self.metrics.phase('connect'):
+			conn = self.connect_and_login(typ, config, label)
+			(res, data) = conn.capability()
+			self.__enableExtensions(conn, label or typ, data[0], config)
+		return conn
+
+	def __enableExtensions(self, conn, typ, capability, config):
+		"""
+		Records the post-login capabilities, starts compression and enables
+		QRESYNC when offered
+		"""
+		conn.capabilities = tuple(capability.decode('utf-8').upper().split())
+		if 'COMPRESS=DEFLATE' in conn.capabilities and not config.get('nocompress'):
+			self.__startCompression(conn, typ)
+		if config.get('nocondstore') or self.cache is None:
+			return
+		if 'QRESYNC' in conn.capabilities and 'ENABLE' in conn.capabilities:
+			(typ, data) = conn.enable('QRESYNC')
+			if typ != 'OK':
+				conn.capabilities = tuple(c for c in conn.capabilities if c != 'QRESYNC')
+
+	def __startCompression(self, conn, typ):
+		""" Negotiates COMPRESS=DEFLATE (RFC 4978) on a logged in connection """
+		if isinstance(conn, PipelinedIMAP4):
+			(res, data) = conn.compress()
+		else:
+			(res, data) = conn._simple_command('COMPRESS', 'DEFLATE')
+			if res == 'OK':
+				conn.deflate = Deflate()
+				conn.sock = DeflateSocket(conn.sock, conn.deflate)
+				conn.file = conn.sock.makefile('rb')
+		if res != 'OK':
+			print ("Host%s refused COMPRESS: %s" % (typ, data[-1]))
+			return
+		print ("Host%s compression: DEFLATE" % typ)
+		with self.lock:
+			self.compressed.append((typ, conn.deflate))
 
-		# Logout
-		srcconn.logout()
-		dstconn.logout()
-	
 	def __listMailboxes(self, conn,nofoldersize=True):
 		"""
+		Lists the folders with their STATUS, taken from LIST-STATUS in the same
+		round trip when supported. Sizes come from STATUS=SIZE, only servers
+		without it need getMailboxSize().
+
 		@param conn: Active IMAP connection
-		@return Returns a list of dict{ 'flags', 'delimiter', 'mailbox') }
+		@return Returns a list of dict{ 'flags', 'delimiter', 'mailbox', 'messages', 'size', 'status' }
 		"""
-		(res, data) = conn.list()
+		withstatus = not nofoldersize or self.cache is not None
+		items = self.__statusItems(conn)
+		statuses = {}
+		if withstatus and 'LIST-STATUS' in conn.capabilities:
+			(res, data) = conn.list('""', '* RETURN (STATUS %s)' % items)
+			statuses = parse_status(conn.response('STATUS')[1])
+		else:
+			(res, data) = conn.list()
 		if res != 'OK':
 			raise RuntimeError('Unvalid reply: ' + res)
 		list_re = re.compile(r'\((?P<flags>.*)\)\s+"(?P<delimiter>.*)"\s+"?(?P<name>[^"]*)"?')
@@ -257,22 +4088,86 @@ class main:
 				else:
 					mcount=-1
 					msize=-1
+					status = None
+					if withstatus and '\\Noselect' not in flags:
+						status = statuses.get(mailbox)
+						if status is None and 'LIST-STATUS' not in conn.capabilities:
+							(res, sdata) = conn.status(conn._quote(mailbox), items)
+							if res == 'OK':
+								status = parse_status(sdata).get(mailbox)
 					if not nofoldersize:
-						mcount,msize = self.getMailboxSize(conn,mailbox)
+						if status is not None and 'SIZE' in status:
+							mcount,msize = status['MESSAGES'],status['SIZE']
+						else:
+							mcount,msize = self.getMailboxSize(conn,mailbox)
 					folders.append({
 						'flags': flags,
 						'delimiter': delimiter,
 						'mailbox': mailbox,
 						'messages': mcount,
-						'size': msize
+						'size': msize,
+						'status': status
 			})
 		return folders
 
-	def __listMessages(self, conn, config):
+	def __statusItems(self, conn):
+		""" returns the STATUS data items asked for folders on this server """
+		items = 'MESSAGES UIDNEXT UIDVALIDITY'
+		if 'STATUS=SIZE' in conn.capabilities:
+			items += ' SIZE'
+		if 'CONDSTORE' in conn.capabilities:
+			items += ' HIGHESTMODSEQ'
+		return '(' + items + ')'
+
+	def __syncOptions(self, config):
+		""" returns the options a folder sync result depends on """
+		return '%s delete2=%s nosyncflags=%s key=%s' % (self.__searchCriteria(config),
+			bool(config['delete2']), bool(config.get('nosyncflags')), self.key.spec)
+
+	def __folderUnchanged(self, srcfolder, d, dstfolder, config):
 		"""
-		List all messages in the given conn and current mailbox.
-            
-		@returns a list of message imap identifiers
+		returns True when both folders still have the MESSAGES, UIDNEXT,
+		UIDVALIDITY (and HIGHESTMODSEQ) recorded after their last sync, the
+		source folder's recorded for its sync to destination d. Flag changes
+		only show in HIGHESTMODSEQ: without it on both sides a folder is
+		only skipped when flags are not synced.
+		"""
+		srcstatus = self.srcstatus.get(srcfolder)
+		dststatus = d.status.get(dstfolder)
+		if self.cache is None or srcstatus is None or dststatus is None or config.get('noskipunchanged'):
+			return False
+		if not config.get('nosyncflags') and (srcstatus.get('HIGHESTMODSEQ') is None or dststatus.get('HIGHESTMODSEQ') is None):
+			return False
+		options = self.__syncOptions(config)
+		for typ, folder, status, dest in (('1', srcfolder, srcstatus, destination_key(d.config)), ('2', dstfolder, dststatus, '')):
+			host = '%s:%s' % (d.config['host'+typ], d.config['port'+typ])
+			synced = self.cache.synced(host, d.config['user'+typ], folder, dest)
+			if synced is None or tuple(synced) != status_key(status) + (options,):
+				return False
+		return True
+
+	def __saveSynced(self, srcconn, d, srcfolder, dstfolder, config):
+		"""
+		Records the source STATUS seen when listing and the destination STATUS
+		after the sync, so an unchanged pair can be skipped next time
+		"""
+		srcstatus = self.srcstatus.get(srcfolder)
+		if self.cache is None or srcstatus is None:
+			return
+		(res, data) = d.conn.status(d.conn._quote(dstfolder), self.__statusItems(d.conn))
+		if res != 'OK':
+			return
+		dststatus = parse_status(data).get(dstfolder)
+		if dststatus is None:
+			return
+		options = self.__syncOptions(config)
+		for typ, folder, status, dest in (('1', srcfolder, srcstatus, destination_key(d.config)), ('2', dstfolder, dststatus, '')):
+			host = '%s:%s' % (d.config['host'+typ], d.config['port'+typ])
+			self.cache.save_synced(host, d.config['user'+typ], folder, status_key(status), options, dest)
+
+	def __searchCriteria(self, config):
+		"""
+		returns the SEARCH criteria selecting the messages to sync
 		"""
 		#(res, data) = conn.search(None, 'ALL')
 		cmd = '(undeleted'
@@ -301,38 +4196,309 @@ class main:
 			pass
 		'''	
 		cmd += ')'
+		return cmd
+
+	def __listMessages(self, conn, config):
+		"""
+		List all messages in the given conn and current mailbox.
+            
+		@returns an array of message imap UIDs
+		"""
+		cmd = self.__searchCriteria(config)
 		#print (cmd)
+		# a failed listing must not pass for an empty folder: a lost
+		# connection goes to the retry, a refused SEARCH fails the folder
+		(res, data) = conn.uid('SEARCH', None, cmd)
+		if res != 'OK':
+			raise RuntimeError('Unvalid reply: ' + res)
+		return parse_uids(data[0])
+
+	def __folderState(self, conn):
+		"""
+		returns (UIDVALIDITY, UIDNEXT, HIGHESTMODSEQ) of the selected mailbox, None when unknown
+		"""
+		state = []
+		for name in ('UIDVALIDITY', 'UIDNEXT', 'HIGHESTMODSEQ'):
+			typ, data = conn.response(name)
+			try:
+				state.append(int(data[-1]))
+			except (TypeError, ValueError, IndexError):
+				state.append(None)
+		return tuple(state)
+
+	def __indexFolder(self, conn, typ, folder, config):
+		"""
+		Lists and indexes the selected mailbox, reusing the state cache when enabled.
+		With a cached HIGHESTMODSEQ and CONDSTORE/QRESYNC only changes since the
+		last run are fetched.
+            
+		@returns (uids, index, UIDVALIDITY)
+		"""
+		uidvalidity, uidnext, highestmodseq = self.__folderState(conn)
+		if self.cache is None or uidvalidity is None:
+			uids = self.__listMessages(conn, config)
+			return uids, self.__indexMessages(conn, uids, config), uidvalidity
+
+		host = '%s:%s' % (config['host'+typ], config['port'+typ])
+		cached, lastmodseq = self.cache.load(host, config['user'+typ], folder, uidvalidity)
+		condstore = lastmodseq is not None and highestmodseq is not None \
+			and 'CONDSTORE' in conn.capabilities and not config.get('nocondstore')
+		# the cache only holds every undeleted message when no filter is set
+		unfiltered = self.__searchCriteria(config) == '(undeleted)'
 		try:
-				(res, data) = conn.search(None, cmd)
-				if res != 'OK':
-					raise RuntimeError('Unvalid reply: ' + res)
-				msgids = data[0].split()
-		except Exception as e:
-			msgids = []
-			print (" Exception __listMessages: ",str(e))
-        
-		return msgids
+			if condstore and unfiltered and 'QRESYNC' in conn.capabilities:
+				index = self.__indexChanges(conn, config, cached, lastmodseq, highestmodseq)
+				uids = index.uids
+			else:
+				uids = self.__listMessages(conn, config)
+				if condstore:
+					self.__fetchChanges(conn, cached, lastmodseq)
+				index = self.__indexMessages(conn, uids, config, cached, not condstore)
+		except BaseException:
+			# the cached flags may be half refreshed, and a partial index
+			# saved with this HIGHESTMODSEQ would be trusted from then on
+			self.cache.forget(host, config['user'+typ], folder)
+			raise
+		if not unfiltered:
+			highestmodseq = None
+		self.cache.save(host, config['user'+typ], folder, uidvalidity, uidnext, highestmodseq, index)
+		return uids, index, uidvalidity
 
-	def __getMessageId(self, conn, imapid):
+	def __fetchChanges(self, conn, cached, modseq, vanished=False):
 		"""
-		returns "Message-ID"
+		Updates the flags of cached messages changed since modseq (CONDSTORE).
+		With vanished (QRESYNC) the UIDs expunged since are asked for too.
+            
+		@returns (the UIDs changed since modseq which were not in cached,
+		the set of expunged UIDs)
 		"""
-		(res, data) = conn.fetch(imapid, '(BODY.PEEK[HEADER] FLAGS)')
+		modifiers = '(CHANGEDSINCE %d%s)' % (modseq, ' VANISHED' if vanished else '')
+		(res, data) = conn.uid('FETCH', '1:*', '(UID FLAGS)', modifiers)
 		if res != 'OK':
 			raise RuntimeError('Unvalid reply: ' + res)
-		headers = email.message_from_string(data[0][1].decode('UTF-8'))
-		#return headers['Message-ID'],imaplib.ParseFlags(data[1].replace('\Recent',''))
-		return headers['Message-ID'],data[1]
+		unknown = []
+		for m in parse_fetch_response(data):
+			if m['uid'] is None:
+				continue
+			pos = cached.position(int(m['uid']))
+			if pos is not None:
+				cached.set_flags(pos, m['flags'])
+			else:
+				unknown.append(m['uid'])
+		gone = set()
+		if vanished:
+			typ, data = conn.response('VANISHED')
+			for line in data or []:
+				if line is None:
+					continue
+				gone.update(parse_uid_set(line.decode('UTF-8').replace('(EARLIER)', '').strip()))
+		return unknown, gone
+
+	def __indexChanges(self, conn, config, cached, lastmodseq, highestmodseq):
+		"""
+		Rebuilds the index of the selected mailbox from cached and the changes
+		reported by QRESYNC, without listing the whole folder.
+            
+		@returns a CompactIndex in UID order
+		"""
+		unknown, gone = [], set()
+		if highestmodseq != lastmodseq:
+			unknown, gone = self.__fetchChanges(conn, cached, lastmodseq, True)
+		fetched = sorted(self.__indexMessages(conn, unknown, config), key=lambda m: int(m['uid']))
+		index = CompactIndex()
+		index.extend(m for m in heapq.merge(cached, fetched, key=lambda m: int(m['uid']))
+			if int(m['uid']) not in gone and '\\Deleted' not in m['flags'].split())
+		return index
+
+	def __indexMessages(self, conn, uids, config, cached=None, refresh=True):
+		"""
+		Fetches the comparison key, FLAGS, RFC822.SIZE and INTERNALDATE for the given
+		UIDs of the current mailbox, several messages per FETCH command.
+		UIDs found in the cached CompactIndex are reused, with their FLAGS
+		refreshed if refresh.
+            
+		@returns a CompactIndex
+		"""
+		index = CompactIndex()
+		chunk = int(config['fetchchunk'])
+		# positions in cached of the known UIDs, the others to fetch
+		known = array.array('I')
+		if cached:
+			missing = array.array('I')
+			for u in uids:
+				pos = cached.position(int(u))
+				if pos is None:
+					missing.append(int(u))
+				else:
+					known.append(pos)
+			uids = missing
+		if known and refresh:
+			# flags are tiny, so refresh them in much larger batches
+			for i in range(0, len(known), chunk * 10):
+				(res, data) = conn.uid('FETCH', uid_set([cached.uids[p] for p in known[i:i+chunk*10]]), '(UID FLAGS)')
+				if res != 'OK':
+					raise RuntimeError('Unvalid reply: ' + res)
+				for m in parse_fetch_response(data):
+					pos = None if m['uid'] is None else cached.position(int(m['uid']))
+					if pos is not None:
+						cached.set_flags(pos, m['flags'])
+		index.extend(cached[p] for p in known)
+		for i in range(0, len(uids), chunk):
+			(res, data) = conn.uid('FETCH', uid_set(uids[i:i+chunk]), self.key.fetch)
+			if res != 'OK':
+				raise RuntimeError('Unvalid reply: ' + res)
+			for m in parse_fetch_response(data):
+				if m['uid'] is None:
+					# unsolicited FETCH, e.g. a flag change by another client
+					continue
+				index.append({
+					'uid': m['uid'],
+					'mid': self.key(m['header'], m['size'], m['date']),
+					'flags': m['flags'],
+					'size': m['size'],
+					'date': m['date']
+				})
+		return index
+
+	def __uidCommand(self, conn, command, sets, *args):
+		"""
+		Runs one UID command per sequence set, all in flight at once on a
+		pipelined connection
+		"""
+		if isinstance(conn, PipelinedIMAP4):
+			responses = [conn.uid_async(command, s, *args) for s in sets]
+			responses = [r.result() for r in responses]
+		else:
+			responses = [conn.uid(command, s, *args) for s in sets]
+		for (res, data) in responses:
+			if res != 'OK':
+				raise RuntimeError('Unvalid reply: ' + res)
+
+	def __deleteMessages(self, conn, uids, config):
+		"""
+		Flags the given UIDs \\Deleted with a few UID STORE commands over
+		compressed UID sets; with --uidexpunge2 and UIDPLUS only these UIDs
+		are then removed by UID EXPUNGE.
+		"""
+		sets = uid_set_chunks(uids)
+		self.__uidCommand(conn, 'STORE', sets, '+FLAGS.SILENT', '(\\Deleted)')
+		if config.get('uidexpunge2'):
+			if 'UIDPLUS' in conn.capabilities:
+				self.__uidCommand(conn, 'EXPUNGE', sets)
+			else:
+				print ("Server has no UIDPLUS capability, UID EXPUNGE skipped")
 
-	def __getMessage(self, conn, imapid):
+	def __getMessage(self, conn, uid):
 		"""
 		returns full RFC822 message
 		"""
-		(res, data) = conn.fetch(imapid, '(RFC822)')
+		return self.__messageBody(conn.uid('FETCH', uid, '(BODY.PEEK[])'))
+
+	def __messageBody(self, response):
+		(res, data) = response
 		if res != 'OK':
 			raise RuntimeError('Unvalid reply: ' + res)
 		return data[0][1]
 
+	def __spoolMessage(self, conn, uid, config):
+		"""
+		Fetches a message in --buffersize partial FETCHes into a temporary file.
+		@returns the file, to be closed by the caller
+		"""
+		# named, a Rewriter process reads it by name
+		spool = tempfile.NamedTemporaryFile()
+		chunk = int(config['buffersize'])
+		offset = 0
+		try:
+			while True:
+				data = self.__messageBody(conn.uid('FETCH', uid, '(BODY.PEEK[]<%d.%d>)' % (offset, chunk)))
+				if not isinstance(data, bytes):
+					# NIL or an empty string past the end of the message
+					break
+				spool.write(data)
+				offset += len(data)
+				if len(data) < chunk:
+					break
+		except BaseException:
+			spool.close()
+			raise
+		return spool
+
+	def __fetchMessages(self, conn, messages, config):
+		"""
+		Yields (message, full RFC822 message) for the given index entries.
+		Messages up to --fetchsize bytes come first, as many per FETCH as fit
+		in --fetchsize bytes, then the larger ones one per FETCH, so that a
+		huge message doesn't hold back the small ones.
+		Messages above --streamsize are yielded as a temporary file instead of
+		bytes and closed once the consumer is done with them.
+		On a pipelined connection up to conn.depth FETCHes are kept in flight.
+		"""
+		budget = int(config['fetchsize'])
+		streamsize = int(config['streamsize'])
+		pipelined = isinstance(conn, PipelinedIMAP4)
+		# messages is gone through twice rather than split in two lists,
+		# the ones to spool never go in a batch
+		batched = min(budget, streamsize)
+		small = (m for m in messages if m['size'] <= batched)
+		large = (m for m in messages if m['size'] > batched)
+		pending = collections.deque()
+		for batch in fetch_batches(small, budget, int(config['fetchchunk'])):
+			fetch = (uid_set([m['uid'] for m in batch]), '(UID BODY.PEEK[])')
+			if not pipelined:
+				for item in self.__fetchedBatch(batch, conn.uid('FETCH', *fetch)):
+					yield item
+				continue
+			pending.append((batch, conn.uid_async('FETCH', *fetch)))
+			if len(pending) >= conn.depth:
+				batch, response = pending.popleft()
+				for item in self.__fetchedBatch(batch, response.result()):
+					yield item
+		while pending:
+			batch, response = pending.popleft()
+			for item in self.__fetchedBatch(batch, response.result()):
+				yield item
+
+		for m in large:
+			if m['size'] > streamsize:
+				while pending:
+					p, response = pending.popleft()
+					yield p, self.__messageBody(response.result())
+				spool = self.__spoolMessage(conn, m['uid'], config)
+				try:
+					yield m, spool
+				finally:
+					spool.close()
+				continue
+			if not pipelined:
+				yield m, self.__getMessage(conn, m['uid'])
+				continue
+			pending.append((m, conn.uid_async('FETCH', m['uid'], '(BODY.PEEK[])')))
+			if len(pending) >= conn.depth:
+				m, response = pending.popleft()
+				yield m, self.__messageBody(response.result())
+		while pending:
+			m, response = pending.popleft()
+			yield m, self.__messageBody(response.result())
+
+	def __fetchedBatch(self, batch, response):
+		"""
+		Yields (message, full RFC822 message) from the reply to a FETCH of a
+		whole batch, in batch order
+		"""
+		(res, data) = response
+		if res != 'OK':
+			raise RuntimeError('Unvalid reply: ' + res)
+		bodies = dict((int(f['uid']), f['header']) for f in parse_fetch_response(data)
+			if f['uid'] is not None and f['header'])
+		for m in batch:
+			body = bodies.pop(int(m['uid']), None)
+			if body is None:
+				# expunged by another client since it was indexed
+				print ("Message %s vanished from the source, not copied" % m['uid'].decode('ascii'))
+				continue
+			yield m, body
+
 	def __getServerType(self, conn):
 		""" Try to guess IMAP server type
 		@return One of: unknown, exchange, dovecot
@@ -390,7 +4556,7 @@ class main:
 				#for i in range(m[0],m[-1]): 
 				for i in range(len(m)): 
 					tmp = sizes_response[i].split() 
-					size_folder += int(tmp[-1].replace(')', ''))
+					size_folder += int(tmp[-1].rstrip(b')'))
 			else: 
 				size_folder = 0
 		
@@ -426,11 +4592,29 @@ class main:
 		#print   
 		print ("Messages skipped             : %d" % self.msg_skipped)
 		print ("Messages flags recovery      : %d" % self.msg_flags)
+		print ("Messages flags updated       : %d" % self.msg_flags_updated)
 		print ("Messages deleted on host2    : %d" % self.msg_deleted)
+		print ("Folders skipped unchanged    : %d" % self.folders_skipped)
 		print ("Total bytes transferred      : %d" % self.total_bytes_transferred)
+		for typ in sorted(set(t for (t, d) in self.compressed)):
+			streams = [d for (t, d) in self.compressed if t == typ]
+			if not streams:
+				continue
+			wire = sum(d.wire_in + d.wire_out for d in streams)
+			logical = sum(d.bytes_in + d.bytes_out for d in streams)
+			print ("Host%s bytes on wire/logical  : %d / %d (%.1fx)" % (typ, wire, logical, logical / float(wire or 1)))
+		for typ, throttle in sorted(self.throttles.items()):
+			if throttle.throttled:
+				print ("Host%s throttled              : %d times, waited %.1f s" % (typ, throttle.throttled, throttle.waited))
 		if self.timediff==0:
 			self.timediff=1
 		print ("Message rate                 : %.1f %s" % (self.msg_transferred / self.timediff,'messages/s'))
+		snapshot = self.metrics.snapshot()
+		for name, seconds in snapshot['phases'].items():
+			print ("Time %-24s: %.1f %s" % (name, seconds, 'sec'))
+		for name, c in sorted(snapshot['commands'].items()):
+			print ("Command %-21s: %6d  in %10d  out %10d  avg %.1f ms" % (name, c['count'], c['bytes_in'], c['bytes_out'],
+				1000 * c['seconds'] / c['count']))
 
 
 	def print_usage(self):
@@ -440,12 +4624,28 @@ class main:
 		print('''
 Usage: syncimap [OPTIONS]
 
- --host1       <string>    source imap server. Mandatory
+ --host1       <string>    source imap server. Mandatory. maildir:<path>
+                           reads a local Maildir++ directory instead, INBOX
+                           being the Maildir and folders its .<name>
+                           subdirectories; archive:<path> restores an
+                           archive written as host2. --user1 and --password1
+                           are then not needed.
  --port1       <int>       port to connect on host1. Default is 143..
  --user1       <string>    user to login on host1.
  --password1   <string>    password for the user1. 
  --passfile1   <string>    password file for the user1. Contains the password.
  --host2       <string>    destination imap server. Mandatory.
+                           maildir:<path> writes to a local Maildir++
+                           directory, created when missing. archive:<path>
+                           adds a snapshot of host1 to a compressed archive
+                           directory: append-only segment files indexed by
+                           folder, UID and Message-ID.
+                           Given again, host1 is also synced into that
+                           server, each message fetched once for all of
+                           them (fan-out). The --port2, --user2,
+                           --password2, --passfile2, --ssl2, --authmech2,
+                           --prefix2 and --sep2 options following it apply
+                           to it, those not given are the first host2's.
  --port2       <int>       port to connect on host2. Default is 143.
  --user2       <string>    user to login on host2.
  --password2   <string>    password for the user2. 
@@ -455,6 +4655,7 @@ Usage: syncimap [OPTIONS]
                            PLAIN, LOGIN, CRAM-MD5 etc. Use UPPERCASE.
  --authmech2   <string>    auth mechanism to use with host2. See --authmech1
  --ssl1                    use an SSL connection on host1.
+ --nossl1                  use a plain connection on host1, SSL is the default.
  --ssl2                    use an SSL connection on host2.
  --include     <regex>     sync folders matching this regular expression
  --include     <regex>     or this one, etc.
@@ -477,6 +4678,13 @@ Usage: syncimap [OPTIONS]
                            Then, when happy, remove --dry, remove --justfolders
  --regexmess   <regex>     Apply the whole regex to each message before transfer.
                            Example: 's/000/ /g'  to replace null by space.
+                           Repeat it to apply several, in order. Messages
+                           larger than --streamsize are read whole in memory
+                           to be rewritten, --skipheader alone streams them.
+ --rewriteworkers <int>    processes rewriting the messages larger than 64 KiB
+                           for --regexmess and --skipheader, 0 rewrites them
+                           all in the syncing thread. Default is the number
+                           of CPUs.
  --regexflag   <regex>     Apply the whole regex to each flags list.
                            Example: 's/\"Junk\"//g'  to remove \"Junk\" flag.
  --sep1        <string>    separator in case namespace is not supported.
@@ -502,20 +4710,121 @@ Usage: syncimap [OPTIONS]
                            past|+++++++++++++++minage---->now
                            past|----maxage+++++minage---->now (intersection)
                            past|++++minage-----maxage++++>now (union)
- --skipheader  <regex>     Don't take into account header keyword
-                           matching <string> ex: --skipheader 'X.*'
+ --skipheader  <regex>     strip the header fields whose name matches
+                           <regex> from the copied messages,
+                           ex: --skipheader 'X-Spam-.*'
  --useheader   <string>    Use this header to compare messages on both sides.
-                           Ex: Message-ID or Subject or Date.
+                           Ex: Message-ID or Subject or Date. Repeat it to
+                           compare several headers, RFC822.SIZE and
+                           INTERNALDATE compare the size and arrival date.
+                           Default is Message-ID. Messages with none of the
+                           headers are compared by size and arrival date.
  --skipsize                Don't take message size into account to compare
                            messages on both sides. On by default.
                            Use --no-skipsize for using size comparaison.
  --allowsizemismatch       allow RFC822.SIZE != fetched msg size
                            consider also --skipsize to avoid duplicate messages
                            when running syncs more than one time per mailbox
- --nosyncflags             just does not sync flags of messages already transfered
+ --nosyncflags             don't sync flags: new messages are copied without
+                           flags and the flags of messages already on host2
+                           are left alone. By default host2 messages get the
+                           flags of their host1 message, --regexflag applied.
  --safemode                do nothing, just  what would be done.
  --nofoldersizes           Do not calculate the size of each folder in bytes
                            and message counts. Default is to calculate them.
+ --justfoldersizes         only print the sizes and message counts of the
+                           folders of both hosts, sync nothing.
+ --plan        <file>      index and compare every folder without syncing
+                           and append the messages and bytes to copy,
+                           delete and reflag per folder and in total, with an
+                           ETA, as one JSON object per account to <file>
+                           ('-' for stdout). The ETA comes from fetching a
+                           sample of the messages to copy, read-only, the
+                           APPENDs being assumed as fast as the FETCHes, and
+                           spreads the copies over --workers.
+ --plansample  <int>       bytes fetched to measure the throughput in --plan,
+                           0 for no ETA. Default is 4194304.
+ --plancopy                copy the --plansample messages to host2 for real
+                           to time the APPENDs too; the sync skips them
+                           afterwards. Not with --safemode.
+ --fetchchunk  <int>       number of messages indexed or copied per FETCH
+                           command.
+                           Default is 500.
+ --statefile   <file>      keep a cache of indexed messages per folder in this
+                           sqlite file, so reruns only fetch headers of new
+                           messages. Reset when UIDVALIDITY changes. Also
+                           journals the messages copied so far, a sync that
+                           was interrupted resumes without copying them again.
+ --diffmemory  <int>       compare folders whose host2 side holds up to <int>
+                           messages with a hash join in memory, larger ones
+                           are sorted in runs of <int> spilled to temporary
+                           files and merged. This caps the memory of the
+                           comparison only: the indexes of both folders stay
+                           in memory, about 60 to 110 bytes a message.
+                           Default is 1000000.
+ --nocondstore             don't use CONDSTORE/QRESYNC to fetch only the
+                           changes since the last run, see --statefile.
+ --noskipunchanged         sync folders even if STATUS shows neither side
+                           changed since the last run, see --statefile.
+                           Without HIGHESTMODSEQ on both sides folders are
+                           only skipped with --nosyncflags.
+ --workers     <int>       sync <int> folders in parallel, each worker logs in
+                           on both hosts. Largest folders go first. Default is 1.
+ --retries     <int>       reconnect up to <int> times in a row when a
+                           connection drops while syncing a folder, waiting
+                           1, 2, 4... up to 60 seconds in between. Attempts
+                           that copied messages don't count. Default is 3.
+ --pipeline    <int>       use the asyncio IMAP engine keeping up to <int>
+                           commands in flight per connection. Default is 0,
+                           one command at a time with imaplib.
+ --appendsize  <int>       maximum bytes of messages sent in one APPEND when
+                           host2 supports MULTIAPPEND. Default is 1048576.
+ --fetchsize   <int>       maximum bytes of messages fetched by one FETCH
+                           command, messages up to <int> bytes are fetched
+                           together and before the larger ones.
+                           Default is 1048576.
+ --buffersize  <int>       size of the partial FETCHes used for messages
+                           above --streamsize. Default is 1048576.
+ --streamsize  <int>       messages larger than <int> bytes are copied through
+                           a temporary file instead of memory.
+                           Default is 10485760.
+ --nocompress              don't use COMPRESS=DEFLATE even if a server
+                           supports it.
+ --archivecodec <string>   compression of the messages written to an archive
+                           host2: zlib or lzma. Default is zlib.
+ --snapshot1   <int>       restore the archive host1 as it was after snapshot
+                           <int> instead of its latest state.
+ --findmessage <string>    look a Message-ID up in the archive host1 (at
+                           --snapshot1 if given) and print the folder, UID,
+                           size, flags and date of every copy, sync nothing.
+ --bandwidth1  <int>       send and receive at most <int> bytes per second
+                           over all the connections to host1.
+ --bandwidth2  <int>       same for host2.
+ --commandrate1 <float>    send at most <float> commands per second over all
+                           the connections to host1. Commands refused with
+                           NO [THROTTLED] or [UNAVAILABLE] are always sent
+                           again after the delay the server asks for, or
+                           1, 2, 4... up to 60 seconds.
+ --commandrate2 <float>    same for host2.
+ --batch       <file>      sync every account of a manifest, a CSV file with
+                           a header line or a JSON list of objects, with the
+                           columns host1, user1, password1, host2, user2,
+                           password2 and optionally any other option name.
+                           Other command line options apply to all accounts.
+ --batchstate  <file>      outcome of every account, accounts synced
+                           successfully are skipped when the batch is rerun.
+                           Default is <manifest>.state.
+ --batchlogs   <dir>       directory of the per-account logs.
+                           Default is <manifest>.logs.
+ --maxaccounts <int>       accounts synced at once in batch mode. Default is 4.
+ --maxperhost  <int>       connections to one host at once in batch mode,
+                           0 for no limit. Default is 0.
+ --metricsfile <file>      append per-phase timings, counters and per-command
+                           counts, bytes and latency histograms to <file> as
+                           JSON lines, periodically and at the end.
+ --promfile    <file>      write the same metrics as a Prometheus textfile.
+ --metricsinterval <int>   seconds between metrics snapshots, 0 for the
+                           final one only. Default is 60.
  --debugimap               imap debug mode for host1 and host2.
  --version                 software version.
  --timeout     <int>       imap connect timeout. 
@@ -544,24 +4853,29 @@ syncimap \\
 		# read command line
 		try:
 			short_args = "v:h"
-			long_args = ["host1=", "port1=", "user1=", "password1=", "passfile1=", "ssl1", "authmech1=","prefix1=","sep1=","delete1","expunge1",
+			long_args = ["host1=", "port1=", "user1=", "password1=", "passfile1=", "ssl1", "nossl1", "authmech1=","prefix1=","sep1=","delete1","expunge1",
 			"host2=", "port2=", "user2=", "password2=", "passfile2=", "ssl2", "authmech2=","prefix2=","sep2=","delete2","expunge2", "regextrans2=","uidexpunge2",
-			"noauthmd5", "include=", "exclude=", "regexmess=","regexflag=","syncinternaldates","idatefromheader","buffersize=",
-			"maxsize=","minage=","maxage=","skipheader=","useheader=","skipsize","allowsizemismatch","nosyncflags","safemode","nofoldersizes",
-			"justfoldersizes","debugimap1","debugimap2","debugimap","version","timeout=","help"]
+			"noauthmd5", "include=", "exclude=", "regexmess=","regexflag=","rewriteworkers=","syncinternaldates","idatefromheader","buffersize=",
+			"maxsize=","minage=","maxage=","skipheader=","useheader=","skipsize","no-skipsize","allowsizemismatch","nosyncflags","safemode","nofoldersizes",
+			"justfoldersizes","plan=","plansample=","plancopy","diffmemory=","fetchchunk=","fetchsize=","statefile=","nocondstore","noskipunchanged","workers=","retries=","pipeline=","appendsize=","streamsize=","nocompress","archivecodec=","snapshot1=","findmessage=","bandwidth1=","bandwidth2=","commandrate1=","commandrate2=","batch=","batchstate=","batchlogs=","maxaccounts=","maxperhost=","metricsfile=","promfile=","metricsinterval=","debugimap1","debugimap2","debugimap","version","timeout=","help"]
 			opts, extraargs = getopt.gnu_getopt(sys.argv[1:], short_args, long_args)
 		except Exception as e:
 			print ('\nError:', e)
 			self.print_usage()
 				
 		warnings = []
-		config = {'host2': 'localhost', 'ssl1':True, 'ssl2':False, 'safemode':False, 'timeout':30,'nofoldersizes':False}
+		config = {'host2': 'localhost', 'ssl1':True, 'ssl2':False, 'safemode':False, 'timeout':30,'nofoldersizes':False,'fetchchunk':500,'fetchsize':1048576,'workers':1,'retries':3,'pipeline':0,'appendsize':1048576,
+			'buffersize':1048576,'streamsize':10485760,'maxaccounts':4,'maxperhost':0,'metricsinterval':60,
+			'archivecodec':'zlib','plansample':4194304,'diffmemory':DIFF_MEMORY}
 		errors = []
 		
 		# empty command line
 		if not len(opts) and not len(extraargs):
 			self.print_usage()
 			
+		# the host2 options apply to the last --host2 given, the fan-out ones go to config['fanout']
+		dest = config
+		hosts2 = 0
 		# process each command line option, save in config
 		for option, value in opts:
 			# host1
@@ -578,6 +4892,8 @@ syncimap \\
 				config['passfile1'] = value
 			elif option in ("--ssl1"):
 				config['ssl1'] = True
+			elif option in ("--nossl1"):
+				config['ssl1'] = False
 			elif option in ("--authmech1"):
 				config['authmech1'] = value
 			elif option in ("--prefix1"):
@@ -590,23 +4906,27 @@ syncimap \\
 				config['expunge1'] = True
 			# host2	
 			elif option in ("--host2"):
-				config['host2'] = value
+				if hosts2:
+					dest = {}
+					config.setdefault('fanout', []).append(dest)
+				hosts2 += 1
+				dest['host2'] = value
 			elif option in ("--port2"):
-				config["port2"] = value
+				dest["port2"] = value
 			elif option in ("--user2"):
-				config['user2'] = value
+				dest['user2'] = value
 			elif option in ("--password2"):
-				config['password2'] = self.decode5t(value)
+				dest['password2'] = self.decode5t(value)
 			elif option in ("--passfile2"):
-				config['passfile2'] = value
+				dest['passfile2'] = value
 			elif option in ("--ssl2"):
-				config['ssl2'] = True
+				dest['ssl2'] = True
 			elif option in ("--authmech2"):
-				config['authmech2'] = value
+				dest['authmech2'] = value
 			elif option in ("--prefix2"):
-				config['prefix2'] = value
+				dest['prefix2'] = value
 			elif option in ("--sep2"):
-				config['sep2'] = value
+				dest['sep2'] = value
 			elif option in ("--delete2"):
 				config['delete2'] = True
 			elif option in ("--expunge2"):
@@ -623,7 +4943,9 @@ syncimap \\
 			elif option in ("--exclude"):
 				config['exclude'] = value
 			elif option in ("--regexmess"):
-				config['regexmess'] = value
+				config.setdefault('regexmess', []).append(value)
+			elif option in ("--rewriteworkers"):
+				config['rewriteworkers'] = value
 			elif option in ("--regexflag"):
 				config['regexflag'] = value
 			elif option in ("--syncinternaldates"):
@@ -639,9 +4961,11 @@ syncimap \\
 			elif option in ("--skipheader"):
 				config['skipheader'] = value
 			elif option in ("--useheader"):
-				config['useheader'] = value
+				config.setdefault('useheader', []).append(value)
 			elif option in ("--skipsize"):
 				config['skipsize'] = True
+			elif option in ("--no-skipsize"):
+				config['skipsize'] = False
 			elif option in ("--allowsizemismatch"):
 				config['allowsizemismatch'] = True
 			elif option in ("--nosyncflags"):
@@ -652,6 +4976,68 @@ syncimap \\
 				config['nofoldersizes'] = True
 			elif option in ("--justfoldersizes"):
 				config['justfoldersizes'] = True
+			elif option in ("--plan"):
+				config['plan'] = value
+			elif option in ("--plansample"):
+				config['plansample'] = value
+			elif option in ("--plancopy"):
+				config['plancopy'] = True
+			elif option in ("--fetchchunk"):
+				config['fetchchunk'] = value
+			elif option in ("--fetchsize"):
+				config['fetchsize'] = value
+			elif option in ("--diffmemory"):
+				config['diffmemory'] = value
+			elif option in ("--statefile"):
+				config['statefile'] = value
+			elif option in ("--nocondstore"):
+				config['nocondstore'] = True
+			elif option in ("--noskipunchanged"):
+				config['noskipunchanged'] = True
+			elif option in ("--workers"):
+				config['workers'] = value
+			elif option in ("--retries"):
+				config['retries'] = value
+			elif option in ("--pipeline"):
+				config['pipeline'] = value
+			elif option in ("--appendsize"):
+				config['appendsize'] = value
+			elif option in ("--buffersize"):
+				config['buffersize'] = value
+			elif option in ("--streamsize"):
+				config['streamsize'] = value
+			elif option in ("--nocompress"):
+				config['nocompress'] = True
+			elif option in ("--archivecodec"):
+				config['archivecodec'] = value
+			elif option in ("--snapshot1"):
+				config['snapshot1'] = value
+			elif option in ("--findmessage"):
+				config['findmessage'] = value
+			elif option in ("--bandwidth1"):
+				config['bandwidth1'] = value
+			elif option in ("--bandwidth2"):
+				config['bandwidth2'] = value
+			elif option in ("--commandrate1"):
+				config['commandrate1'] = value
+			elif option in ("--commandrate2"):
+				config['commandrate2'] = value
+			elif option in ("--batch"):
+				config['batch'] = value
+			elif option in ("--batchstate"):
+				config['batchstate'] = value
+			elif option in ("--batchlogs"):
+				config['batchlogs'] = value
+			elif option in ("--maxaccounts"):
+				config['maxaccounts'] = value
+			elif option in ("--maxperhost"):
+				config['maxperhost'] = value
+			elif option in ("--metricsfile"):
+				config['metricsfile'] = value
+			elif option in ("--promfile"):
+				config['promfile'] = value
+			elif option in ("--metricsinterval"):
+				config['metricsinterval'] = value
 			elif option in ("--debugimap1"):
 				config['debugimap1'] = True
 			elif option in ("--debugimap2"):
@@ -678,11 +5064,16 @@ syncimap \\
 		
 		if 'host1' not in config :
 			errors.append("No source server specified, use --host1")
-		if 'host2' not in config :
+		if 'host2' not in config and not config.get('findmessage'):
 			errors.append("No destination server specified, use --host2")
+		for (typ, entry) in [('1', config), ('2', config)] + [('2', extra) for extra in config.get('fanout') or []]:
+			if entry.get('host'+typ, '').startswith(LOCAL_STORES):
+				# a local directory, nobody to log in as
+				entry.setdefault('user'+typ, os.path.basename(entry['host'+typ].split(':', 1)[1].rstrip('/')))
+				entry.setdefault('password'+typ, '')
 		if 'user1' not in config:
 			errors.append("No username specified, use --user1")
-		if 'user2' not in config:
+		if 'user2' not in config and not config.get('findmessage'):
 			errors.append("No username specified, use --user2")
 		if 'port1' in config:
 			if len(config['port1']) > 0:
@@ -693,23 +5084,73 @@ syncimap \\
 					config['port1'] = port
 				except ValueError:
 					errors.append("Invalid port1.  Port must be an integer between 0 and 65535.")
-		if 'port2' in config:
-			if len(config['port2']) > 0:
-				try:
-					port = int(config['port2'])
-					if port > 65535 or port < 0:
-						raise ValueError
-					config['port2'] = port
-				except ValueError:
-					errors.append("Invalid port2.  Port must be an integer between 0 and 65535.")
+		for entry in [config] + (config.get('fanout') or []):
+			if 'port2' in entry and isinstance(entry['port2'], str):
+				if len(entry['port2']) > 0:
+					try:
+						port = int(entry['port2'])
+						if port > 65535 or port < 0:
+							raise ValueError
+						entry['port2'] = port
+					except ValueError:
+						errors.append("Invalid port2.  Port must be an integer between 0 and 65535.")
+		if config.get('regexflag'):
+			try:
+				perl_substitution(config['regexflag'])
+			except (ValueError, re.error) as e:
+				errors.append("Invalid regexflag: %s" % e)
+		for expr in config.get('regexmess') or []:
+			try:
+				parse_substitution(expr, True)
+			except (ValueError, re.error) as e:
+				errors.append("Invalid regexmess: %s" % e)
+		if config.get('skipheader'):
+			try:
+				re.compile(config['skipheader'])
+			except re.error as e:
+				errors.append("Invalid skipheader: %s" % e)
+		if config.get('archivecodec', 'zlib') not in ArchiveIMAP4.CODECS:
+			errors.append("Invalid archivecodec, use one of: %s" % ', '.join(sorted(ArchiveIMAP4.CODECS)))
+		if config.get('snapshot1') is not None:
+			if not config.get('host1', '').startswith('archive:'):
+				errors.append("--snapshot1 needs an archive:<path> host1")
+			try:
+				config['snapshot1'] = int(config['snapshot1'])
+			except ValueError:
+				errors.append("Invalid snapshot1, it must be an integer")
+		if config.get('findmessage') and not config.get('host1', '').startswith('archive:'):
+			errors.append("--findmessage needs an archive:<path> host1")
+		positive, natural = "a positive integer", "a non-negative integer"
+		for (option, parse, least, kind) in (
+				('fetchchunk', int, 1, positive), ('fetchsize', int, 1, positive), ('workers', int, 1, positive),
+				('buffersize', int, 1, positive), ('streamsize', int, 1, positive), ('appendsize', int, 1, positive),
+				('maxaccounts', int, 1, positive), ('diffmemory', int, 1, positive),
+				('pipeline', int, 0, natural), ('plansample', int, 0, natural), ('rewriteworkers', int, 0, natural),
+				('retries', int, 0, natural), ('maxperhost', int, 0, natural),
+				('metricsinterval', float, 0, "a non-negative number"), ('bandwidth1', float, 0, "a non-negative number"),
+				('bandwidth2', float, 0, "a non-negative number"), ('commandrate1', float, 0, "a non-negative number"),
+				('commandrate2', float, 0, "a non-negative number"), ('timeout', float, 0.001, "a positive number")):
+			if config.get(option) is None:
+				continue
+			try:
+				if parse(config[option]) < least:
+					raise ValueError
+			except (TypeError, ValueError):
+				errors.append("Invalid %s, it must be %s" % (option, kind))
 				
 		return (config, warnings, errors)
 
 
-	def get_config(self):
-		"""Gets config from command line and console, returns config"""
+	def get_config(self, config=None):
+		"""Gets config from command line and console (or checks the given one), returns config"""
 	
-		config, warnings, errors = self.process_cline()
+		if config is None:
+			config, warnings, errors = self.process_cline()
+			if 'batch' in config:
+				# hosts and users come from the manifest
+				return config
+		else:
+			warnings, errors = [], []
 		config, warnings, errors = self.check_config(config, warnings, errors)
 		# show warnings
 		for warning in warnings:
@@ -742,21 +5183,48 @@ syncimap \\
 				config['port2'] = 993
 			else:
 				config['port2'] = 143
+		for extra in config.get('fanout') or []:
+			if 'port2' not in extra and 'ssl2' in extra:
+				extra['port2'] = 993
  
 		# done!
 		
 		return config
 
 
-	def connect_and_login(self,typ,config):
+	def connect_and_login(self,typ,config,label=None):
+		"""
+		@param label: what the host is called in messages and which Throttle
+		it gets, typ by default; fan-out destinations have labels of their own
+		"""
+		label = label or typ
 		try:
 			socket.setdefaulttimeout(float(config['timeout']))
-			if config['ssl'+typ]:
+			if config['host'+typ].startswith('maildir:'):
+				print ("Opening Maildir '%s'" % config['host'+typ][len('maildir:'):])
+				server = MaildirIMAP4(config['host'+typ][len('maildir:'):])
+			elif config['host'+typ].startswith('archive:'):
+				print ("Opening archive '%s'" % config['host'+typ][len('archive:'):])
+				path = os.path.abspath(os.path.expanduser(config['host'+typ][len('archive:'):]))
+				with self.lock:
+					# the worker connections of the run write one snapshot
+					shared = self.archives.setdefault(path, ArchiveIMAP4.shared_state())
+				server = ArchiveIMAP4(path, config.get('archivecodec', 'zlib'),
+					config.get('snapshot1') if typ == '1' else None, shared)
+				print ("Archive has %d snapshots%s" % (server.latest,
+					', reading snapshot %d' % server.view if server.view is not None else ''))
+			elif int(config['pipeline']) > 0:
+				print ("Connecting to '%s' TCP port %d%s, pipelined" % (config['host'+typ], config['port'+typ], ', SSL' if config['ssl'+typ] else ''))
+				server = PipelinedIMAP4(config['host'+typ], config['port'+typ], config['ssl'+typ],
+					config['pipeline'], float(config['timeout']))
+			elif config['ssl'+typ]:
 				print ("Connecting to '%s' TCP port %d, SSL" % (config['host'+typ], config['port'+typ]))
 				server = imaplib.IMAP4_SSL(config['host'+typ], config['port'+typ])
 			else:
 				print ("Connecting to '%s' TCP port %d" % (config['host'+typ], config['port'+typ]))
 				server = imaplib.IMAP4(config['host'+typ], config['port'+typ])
+			self.metrics.instrument(server)
+			self.throttles[label].attach(server)
 				
 			server.login(config['user'+typ], config['password'+typ])
 			print ("Success login on [%s] with user [%s]" % (config['host'+typ],config['user'+typ]))
@@ -768,7 +5236,7 @@ syncimap \\
 			print ("ERROR: could not connect to '%s' (%s)" % (config['host'+typ], e))
 			sys.exit(4)
 		except Exception as e:
-			print ("ERROR: Host%s, user%s=%s, password%s=****" % (typ,typ,config['user'+typ],typ))
+			print ("ERROR: Host%s, user%s=%s, password%s=****" % (label,typ,config['user'+typ],typ))
 			print (str(e))
 			sys.exit(5)
  